@@ -0,0 +1,31 @@
+"""thin-edge.io Modbus operations handlers"""
+
+import importlib
+
+# handler module of every Cloud Fieldbus operation, imported on first use
+OPERATIONS = {
+    "c8y_Coils": "c8y_coils",
+    "c8y_ModbusConfiguration": "c8y_modbus_configuration",
+    "c8y_ModbusDevice": "c8y_modbus_device",
+    "c8y_Registers": "c8y_registers",
+    "c8y_SerialConfiguration": "c8y_serial_configuration",
+}
+# handler module of every write command, imported on first use
+WRITE_OPERATIONS = {
+    "modbus_SetRegister": "set_register",
+    "modbus_SetCoil": "set_coil",
+}
+
+
+def load_operation(command):
+    """Import the handler module of an operation"""
+    if command not in OPERATIONS:
+        raise ValueError(f"Unknown operation {command}")
+    return importlib.import_module(f"{__name__}.{OPERATIONS[command]}")
+
+
+def load_write_operation(command):
+    """Import the handler module of a write command"""
+    if command not in WRITE_OPERATIONS:
+        raise ValueError(f"Unknown write command {command}")
+    return importlib.import_module(f"{__name__}.{WRITE_OPERATIONS[command]}")
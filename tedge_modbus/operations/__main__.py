@@ -1,29 +1,19 @@
-# pylint: disable=R0801, duplicate-code
-"""thin-edge.io Modbus operations handlers"""
+"""thin-edge.io Modbus operations handlers
+
+Only the handler of the requested operation is imported, so a single
+operation does not pay for the dependencies of all others.
+"""
 
 import sys
 
-from . import c8y_coils
-from . import c8y_modbus_configuration
-from . import c8y_modbus_device
-from . import c8y_registers
-from . import c8y_serial_configuration
+from . import load_operation
 from .context import Context
 
 
 def main():
     """main"""
     command = sys.argv[1]
-    if command == "c8y_Coils":
-        run = c8y_coils.run
-    elif command == "c8y_ModbusConfiguration":
-        run = c8y_modbus_configuration.run
-    elif command == "c8y_ModbusDevice":
-        run = c8y_modbus_device.run
-    elif command == "c8y_Registers":
-        run = c8y_registers.run
-    elif command == "c8y_SerialConfiguration":
-        run = c8y_serial_configuration.run
+    run = load_operation(command).run
 
     arguments = sys.argv[2:]
     context = Context()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+# pylint: disable=duplicate-code
 """Cumulocity IoT c8y_Coils operation handler"""
 from .context import Context
 
@@ -7,5 +8,7 @@ def run(arguments, context: Context):
     """Run c8y_Coils operation handler"""
     config_file = context.config_dir / f"{__name__}.toml"
     context.config_dir.mkdir(parents=True, exist_ok=True)
+    if not isinstance(arguments, str):
+        arguments = ",".join(arguments)
     with open(config_file, mode="w", newline="", encoding="utf8") as file:
         file.write(arguments)
@@ -2,9 +2,8 @@
 """Cumulocity ModbusConfiguration operation handler"""
 import json
 import logging
-import toml
-from paho.mqtt.publish import single as mqtt_publish
 
+from .config_store import publish, update_config
 from .context import Context
 
 logger = logging.getLogger(__name__)
@@ -28,14 +27,14 @@ def run(arguments, context: Context):
     polling_rate = data["pollingRate"]
     logger.debug("transmitRate: %d, pollingRate: %d", transmit_rate, polling_rate)
 
-    # Update configuration
-    modbus_config["modbus"]["transmitinterval"] = transmit_rate
-    modbus_config["modbus"]["pollinterval"] = polling_rate
+    def apply(modbus_config):
+        # Update configuration
+        modbus_config["modbus"]["transmitinterval"] = transmit_rate
+        modbus_config["modbus"]["pollinterval"] = polling_rate
 
     # Save to file
     logger.info("Saving new modbus configuration to %s", context.base_config_path)
-    with open(context.base_config_path, "w", encoding="utf8") as f:
-        toml.dump(modbus_config, f)
+    update_config(context.base_config_path, apply, context)
 
     # Update managedObject
     logger.debug("Updating managedObject with new configuration")
@@ -45,12 +44,11 @@ def run(arguments, context: Context):
         "pollingRate": polling_rate,
     }
     # pylint: disable=duplicate-code
-    mqtt_publish(
-        topic="te/device/main///twin/c8y_ModbusConfiguration",
-        payload=json.dumps(config),
+    publish(
+        context,
+        "te/device/main///twin/c8y_ModbusConfiguration",
+        json.dumps(config),
         qos=1,
         retain=True,
-        hostname=context.broker,
-        port=context.port,
         client_id="c8y_ModbusConfiguration-operation-client",
     )
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 """Cumulocity Modbus device operation handler"""
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import json
 import requests
-import toml
 
+from .config_store import update_config
 from .context import Context
 
 logger = logging.getLogger("c8y_ModbusDevice")
@@ -15,6 +17,12 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
 )
 
+# default number of concurrent HTTP requests when provisioning several devices
+DEFAULT_PROVISIONING_WORKERS = 4
+# fetched mapping templates by path: (ETag, mapping)
+_MAPPING_CACHE: dict = {}
+_MAPPING_CACHE_LOCK = threading.Lock()
+
 
 @dataclass
 class ModebusDevice:
@@ -50,7 +58,7 @@ def get_device_from_mapping(target: ModebusDevice, mapping):
     device["littlewordendian"] = True
 
     # Registers
-    device["registers"] = [{}] * len(mapping["c8y_Registers"])
+    device["registers"] = [{} for _ in mapping["c8y_Registers"]]
 
     for i, c8y_register in enumerate(mapping["c8y_Registers"]):
         device["registers"][i]["number"] = c8y_register["number"]
@@ -75,9 +83,8 @@ def get_device_from_mapping(target: ModebusDevice, mapping):
     return device
 
 
-def parse_arguments(arguments) -> ModebusDevice:
-    """Parse operation arguments"""
-    data = json.loads(arguments[0])
+def parse_device(data: dict) -> ModebusDevice:
+    """Parse the details of a device"""
     return ModebusDevice(
         modbus_type=data["protocol"],
         modbus_address=data["address"],
@@ -88,18 +95,19 @@ def parse_arguments(arguments) -> ModebusDevice:
     )
 
 
-def run(arguments, context: Context):
-    """main"""
-    loglevel = context.base_config["modbus"]["loglevel"] or "INFO"
-    logger.setLevel(getattr(logging, loglevel.upper(), logging.INFO))
-    logger.info("New c8y_ModbusDevice operation")
-    # Check and store arguments
-    if len(arguments) != 1:
-        raise ValueError("Expected 1 argument. Got " + str(len(arguments)) + ".")
-    config_path = context.config_dir / "devices.toml"
-    target = parse_arguments(arguments)
+def parse_devices(arguments) -> list[ModebusDevice]:
+    """Parse operation arguments of one device or of several devices
 
-    # Update external id of child device
+    Several devices are given as {"devices": [<device>, ...]}.
+    """
+    data = json.loads(arguments[0])
+    if "devices" in data:
+        return [parse_device(device) for device in data["devices"]]
+    return [parse_device(data)]
+
+
+def create_external_id(target: ModebusDevice, context: Context):
+    """Create the external id of a child device"""
     logger.debug("Create external id for child device %s", target.device_id)
     url = f"{context.c8y_proxy}/identity/globalIds/{target.device_id}/externalIds"
     data = {
@@ -118,40 +126,97 @@ def run(arguments, context: Context):
         data["externalId"],
     )
 
-    # Get the mapping json via rest
-    url = f"{context.c8y_proxy}{target.mapping_path}"
+
+def fetch_mapping(mapping_path: str, context: Context):
+    """Get a mapping json via rest
+
+    Mappings are cached by path. A cached mapping is revalidated with its
+    ETag, so an unchanged mapping is not transferred again.
+    """
+    url = f"{context.c8y_proxy}{mapping_path}"
+    with _MAPPING_CACHE_LOCK:
+        cached = _MAPPING_CACHE.get(mapping_path)
+    headers = {"If-None-Match": cached[0]} if cached and cached[0] else {}
     logger.debug("Getting mapping json from %s", url)
-    response = requests.get(url, timeout=60)
+    response = requests.get(url, headers=headers, timeout=60)
     logger.info("Got mapping json from %s with response %d", url, response.status_code)
+    if response.status_code == 304 and cached:
+        return cached[1]
     if response.status_code != 200:
         raise ValueError(
-            f"Error getting mapping at {target.mapping_path}. "
+            f"Error getting mapping at {mapping_path}. "
             f"Got response {response.status_code} from {url}. Expected 200."
         )
-    new_mapping = response.json()
+    mapping = response.json()
+    with _MAPPING_CACHE_LOCK:
+        _MAPPING_CACHE[mapping_path] = (response.headers.get("ETag"), mapping)
+    return mapping
+
+
+def provision_devices(targets: list[ModebusDevice], context: Context, workers: int):
+    """Create the external ids and get the mappings of several devices
+
+    The HTTP requests run concurrently with at most workers requests at a
+    time, every mapping path is fetched once. Returns the mapping of every
+    device and the errors of the devices which failed.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as pool:
+        mappings = {
+            path: pool.submit(fetch_mapping, path, context)
+            for path in {target.mapping_path for target in targets}
+        }
+        external_ids = [
+            pool.submit(create_external_id, target, context) for target in targets
+        ]
+    provisioned = []
+    errors = []
+    for target, external_id in zip(targets, external_ids):
+        try:
+            external_id.result()
+            provisioned.append((target, mappings[target.mapping_path].result()))
+        except Exception as err:
+            logger.error("Failed to provision %s: %s", target.child_name, err)
+            errors.append(f"{target.child_name}: {err}")
+    return provisioned, errors
 
-    # Read the mapping toml from pathToConfig
-    logger.debug("Reading mapping toml from %s", config_path)
-    mapping = toml.load(config_path)
-    logger.info("Read mapping toml from %s", config_path)
 
-    # Update or create device data for the device with the same childName
-    logger.debug(
-        "Updating or creating device data for device with childName %s",
-        target.child_name,
-    )
-    update_or_create_device_mapping(
-        target,
-        mapping,
-        new_mapping,
+def run(arguments, context: Context):
+    """main"""
+    modbus_config = context.base_config["modbus"]
+    loglevel = modbus_config["loglevel"] or "INFO"
+    logger.setLevel(getattr(logging, loglevel.upper(), logging.INFO))
+    logger.info("New c8y_ModbusDevice operation")
+    # Check and store arguments
+    if len(arguments) != 1:
+        raise ValueError("Expected 1 argument. Got " + str(len(arguments)) + ".")
+    config_path = context.config_dir / "devices.toml"
+    targets = parse_devices(arguments)
+
+    provisioned, errors = provision_devices(
+        targets,
+        context,
+        modbus_config.get("provisioningworkers", DEFAULT_PROVISIONING_WORKERS),
     )
 
-    logger.debug("Created mapping toml: %s", mapping)
+    if provisioned:
 
-    # Store the mapping toml:
-    logger.debug("Storing mapping toml at %s", config_path)
+        def apply(mapping):
+            # Update or create device data for the devices with the same childName
+            for target, new_mapping in provisioned:
+                logger.debug(
+                    "Updating or creating device data for device with childName %s",
+                    target.child_name,
+                )
+                update_or_create_device_mapping(target, mapping, new_mapping)
+            logger.debug("Created mapping toml: %s", mapping)
 
-    toml_str = toml.dumps(mapping)
-    with open(config_path, "w", encoding="utf8") as file:
-        file.write(toml_str)
-    logger.info("Stored mapping toml at %s", config_path)
+        # Store all devices with a single atomic update of the mapping toml
+        logger.debug("Storing mapping toml at %s", config_path)
+        update_config(config_path, apply, context)
+        logger.info("Stored mapping toml at %s", config_path)
+
+    if errors:
+        raise ValueError(
+            f"Failed to provision {len(errors)} of {len(targets)} devices: "
+            + "; ".join(errors)
+        )
@@ -2,9 +2,8 @@
 """Cumulocity SerialConfiguration operation handler"""
 import json
 import logging
-import toml
-from paho.mqtt.publish import single as mqtt_publish
 
+from .config_store import publish, update_config
 from .context import Context
 
 logger = logging.getLogger(__name__)
@@ -37,16 +36,16 @@ def run(arguments, context: Context):
         data_bits,
     )
 
-    # Update configuration
-    modbus_config["serial"]["baudrate"] = baud_rate
-    modbus_config["serial"]["stopbits"] = stop_bits
-    modbus_config["serial"]["parity"] = parity
-    modbus_config["serial"]["databits"] = data_bits
+    def apply(modbus_config):
+        # Update configuration
+        modbus_config["serial"]["baudrate"] = baud_rate
+        modbus_config["serial"]["stopbits"] = stop_bits
+        modbus_config["serial"]["parity"] = parity
+        modbus_config["serial"]["databits"] = data_bits
 
     # Save to file
     logger.info("Saving new serial configuration to %s", context.base_config_path)
-    with open(context.base_config_path, "w", encoding="utf8") as f:
-        toml.dump(modbus_config, f)
+    update_config(context.base_config_path, apply, context)
 
     # Update managedObject
     logger.debug("Updating managedObject with new configuration")
@@ -57,12 +56,11 @@ def run(arguments, context: Context):
         "parity": parity,
         "dataBits": data_bits,
     }
-    mqtt_publish(
-        topic="te/device/main///twin/c8y_SerialConfiguration",
-        payload=json.dumps(config),
+    publish(
+        context,
+        "te/device/main///twin/c8y_SerialConfiguration",
+        json.dumps(config),
         qos=1,
         retain=True,
-        hostname=context.broker,
-        port=context.port,
         client_id="c8y_SerialConfiguration-operation-client",
     )
@@ -6,9 +6,10 @@ import json
 import logging
 import re
 
-import toml
 from pymodbus.client import ModbusSerialClient, ModbusTcpClient
 
+from .device_index import DeviceIndex, as_device_index, load_device_index
+
 
 def parse_json_arguments(arguments: str | list[str]) -> dict:
     """Parse JSON arguments which may be a string or list of segments.
@@ -25,10 +26,18 @@ def parse_json_arguments(arguments: str | list[str]) -> dict:
         raise ValueError(f"Invalid JSON payload: {err}") from err
 
 
-def resolve_target_device(
-    ip_address: str, slave_id: int, devices_path
+def load_devices(devices_path) -> DeviceIndex:
+    """Load the indexed device definitions from devices.toml.
+
+    The file is only parsed again when it changed.
+    """
+    return load_device_index(devices_path)
+
+
+def find_target_device(
+    ip_address: str, slave_id: int, devices: DeviceIndex | list[dict]
 ) -> tuple[dict, str]:
-    """Resolve device connection parameters from ip or devices.toml.
+    """Resolve device connection parameters from ip or the device definitions.
 
     Returns (target_device, protocol).
     """
@@ -41,17 +50,31 @@ def resolve_target_device(
         }
         return target_device, "TCP"
 
-    devices_cfg = toml.load(devices_path)
-    devices = devices_cfg.get("device", []) or []
+    devices = as_device_index(devices).devices
     target_device = next(
         (d for d in devices if d.get("address") == slave_id), None
     ) or next((d for d in devices if d.get("protocol") == "TCP"), None)
 
     if target_device is None:
-        raise ValueError(f"No suitable device found in {devices_path}")
+        raise ValueError(f"No suitable device found for slave {slave_id}")
 
     protocol = target_device.get("protocol", "TCP")
-    return target_device, protocol
+    return dict(target_device), protocol
+
+
+def resolve_target_device(
+    ip_address: str, slave_id: int, devices_path
+) -> tuple[dict, str]:
+    """Resolve device connection parameters from ip or devices.toml.
+
+    Returns (target_device, protocol).
+    """
+    if ip_address:
+        return find_target_device(ip_address, slave_id, [])
+    try:
+        return find_target_device(ip_address, slave_id, load_devices(devices_path))
+    except ValueError as err:
+        raise ValueError(f"No suitable device found in {devices_path}") from err
 
 
 def backfill_serial_defaults(
@@ -166,118 +189,75 @@ def extract_device_from_topic(topic: str) -> str:
     return ""
 
 
-def _match_from_metrics(  # pylint: disable=too-many-arguments
+def _match_from_metrics(  # pylint: disable=too-many-arguments,too-many-locals
     payload: dict,
     device_name: str,
-    devices_path,
+    devices: DeviceIndex | list[dict],
     config_type: str,
     id_key: str,
     value_type,
 ):
-    """Generic function to match register/coil from devices.toml.
+    """Generic function to match all metrics with registers/coils of the device definitions.
 
     Args:
         payload: Payload containing metrics array
         device_name: Name of the device to search
-        devices_path: Path to devices.toml
+        devices: Device definitions of devices.toml, preferably indexed
         config_type: Type of config ("registers" or "coils")
         id_key: ID field name ("name" for registers and coils)
         value_type: Type to convert value to (float or int)
 
     Returns:
-        Tuple of (config_dict, target_device, matched_id, value)
+        Tuple of (target_device, matches) with a (metric_name, config_dict,
+        matched_id, value) tuple per metric, config_dict is None if no
+        register/coil matches the metric
     """
     logger = logging.getLogger(__name__)
 
-    metric_name, value = _extract_metric_from_payload(payload, value_type, logger)
-    target_device = _load_target_device(devices_path, device_name)
+    metrics = _extract_metrics_from_payload(payload, value_type)
+    index = as_device_index(devices)
+    target_device = index.device(device_name)
     if target_device is None:
-        return None, None, None, None
-
-    configs = target_device.get(config_type, []) or []
-    return _match_config_by_id(
-        configs, id_key, metric_name, target_device, value, logger
-    )
+        return None, []
+
+    trie = index.trie(target_device, config_type, id_key)
+    matches = []
+    for metric_name, value in metrics:
+        config, partial = trie.match(metric_name)
+        if config is None:
+            logger.warning(
+                "No matching %s found for metric name '%s'", config_type, metric_name
+            )
+            matches.append((metric_name, None, None, value))
+            continue
+        logger.info(
+            "Matched metric name '%s' with %s '%s'%s",
+            metric_name,
+            id_key,
+            config[id_key],
+            " (partial match)" if partial else "",
+        )
+        matches.append((metric_name, config, config[id_key], value))
+    return target_device, matches
 
 
-def _extract_metric_from_payload(
-    payload: dict, value_type: type, logger
-) -> tuple[str, int | float]:
-    """Extract metric name and value from payload.
+def _extract_metrics_from_payload(
+    payload: dict, value_type: type
+) -> list[tuple[str, int | float]]:
+    """Extract all metric names and values from payload.
 
     Args:
         payload: Payload dictionary
         value_type: Type to convert value to (int or float)
-        logger: Logger instance
 
     Returns:
-        Tuple of (metric_name, converted_value)
+        List of (metric_name, converted_value) tuples
     """
     metrics = payload.get("metrics", [])
     if not metrics:
         raise ValueError("No metrics found in payload")
 
-    if len(metrics) > 1:
-        logger.warning("Multiple metrics found, using first one")
-
-    metric = metrics[0]
-    return metric.get("name", ""), value_type(metric.get("value", 0))
-
-
-def _load_target_device(devices_path, device_name: str) -> dict | None:
-    """Load and find target device from devices.toml by name.
-
-    Args:
-        devices_path: Path to devices.toml file
-        device_name: Name of the device to find
-
-    Returns:
-        Device dictionary or None if not found
-    """
-    devices_cfg = toml.load(devices_path)
-    devices = devices_cfg.get("device", []) or []
-    return next((d for d in devices if d.get("name") == device_name), None)
-
-
-def _match_config_by_id(
-    configs, id_key, metric_name, target_device, value, logger
-):  # pylint: disable=too-many-arguments
-    """Match config by checking if metric name starts with or contains id."""
-    partial_match = None
-
-    for config in configs:
-        config_id = config.get(id_key)
-        if not config_id:
-            continue
-
-        # Exact prefix match (preferred)
-        if metric_name.startswith(config_id):
-            logger.info(
-                "Matched metric name '%s' with %s '%s'",
-                metric_name,
-                id_key,
-                config_id,
-            )
-            return config, target_device, config_id, value
-
-        # Partial match (fallback)
-        if config_id in metric_name and partial_match is None:
-            partial_match = (config, config_id)
-
-    # Return partial match if found
-    if partial_match:
-        config, config_id = partial_match
-        logger.info(
-            "Matched metric name '%s' with %s '%s' (partial match)",
-            metric_name,
-            id_key,
-            config_id,
-        )
-        return config, target_device, config_id, value
-
-    logger.warning(
-        "No matching %s found for metric name '%s'",
-        type(configs).__name__,
-        metric_name,
-    )
-    return None, None, None, None
+    return [
+        (metric.get("name", ""), value_type(metric.get("value", 0)))
+        for metric in metrics
+    ]
@@ -0,0 +1,138 @@
+"""Atomic, lock-protected updates of the configuration files."""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+import toml
+from paho.mqtt.publish import single as mqtt_publish
+
+from .context import Context, load_config
+
+logger = logging.getLogger(__name__)
+
+# topic on which the reader is notified about changed configuration files
+CONFIG_CHANGED_TOPIC = "tedge-modbus-plugin/config/changed"
+
+
+def lock_path(path) -> str:
+    """Get the lock file of a configuration file, it also holds its version"""
+    directory, name = os.path.split(os.fspath(path))
+    return os.path.join(directory, f".{name}.lock")
+
+
+def _parse_version(content: str) -> int:
+    """Parse the version stored in a lock file, an invalid version counts as 0"""
+    try:
+        return int(content.strip() or 0)
+    except ValueError:
+        return 0
+
+
+def read_version(path) -> int:
+    """Get the number of updates made to a configuration file by the store"""
+    try:
+        with open(lock_path(path), encoding="utf8") as file:
+            return _parse_version(file.read())
+    except OSError:
+        return 0
+
+
+def match_owner(fd_or_path, reference: os.stat_result) -> None:
+    """Give a file the owner and group of a reference file
+
+    Files created by the reader (running as root) must stay writable for the
+    operations (running as tedge), so new files take over the owner of the
+    file they replace or belong to.
+    """
+    current = os.stat(fd_or_path)
+    if (current.st_uid, current.st_gid) != (reference.st_uid, reference.st_gid):
+        os.chown(fd_or_path, reference.st_uid, reference.st_gid)
+
+
+def write_atomically(path, content: str) -> None:
+    """Replace a file by renaming a temporary file onto it, keeping its mode and owner"""
+    path = os.fspath(path)
+    directory, name = os.path.split(path)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, prefix=f".{name}.", delete=False, encoding="utf8"
+    ) as file:
+        file.write(content)
+    try:
+        if os.path.exists(path):
+            original = os.stat(path)
+            os.chmod(file.name, original.st_mode & 0o777)
+            match_owner(file.name, original)
+        os.replace(file.name, path)
+    except OSError:
+        os.unlink(file.name)
+        raise
+
+
+def publish(  # pylint: disable=too-many-arguments
+    context: Context, topic: str, payload: str, qos=0, retain=False, client_id=""
+) -> None:
+    """Publish a message with the MQTT client of the context, or with a new connection"""
+    if context.publisher is not None:
+        context.publisher(topic, payload, qos=qos, retain=retain)
+        return
+    mqtt_publish(
+        topic=topic,
+        payload=payload,
+        qos=qos,
+        retain=retain,
+        hostname=context.broker,
+        port=context.port,
+        client_id=client_id,
+    )
+
+
+def notify_change(path, version: int, context: Context) -> None:
+    """Tell the reader that a configuration file changed
+
+    A failed notification is not an error, the reader still detects the
+    change with its file watcher.
+    """
+    try:
+        publish(
+            context,
+            CONFIG_CHANGED_TOPIC,
+            json.dumps({"file": os.path.basename(os.fspath(path)), "version": version}),
+            qos=1,
+        )
+    except Exception as err:
+        logger.warning("Failed to notify the change of %s: %s", path, err)
+
+
+def update_config(path, change, context: Context | None = None) -> int:
+    """Change a configuration file and return its new version
+
+    The file is locked (advisory) while it is loaded, changed in place by
+    calling change(config) and written back atomically, so concurrent
+    updates are neither lost nor seen half written. Every update bumps the
+    version of the file. If a context is given, the reader is notified.
+    """
+    with open(lock_path(path), "a+", encoding="utf8") as lock:
+        if os.path.exists(path):
+            match_owner(lock.fileno(), os.stat(path))
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            config = load_config(path) if os.path.exists(path) else {}
+            change(config)
+            write_atomically(path, toml.dumps(config))
+            lock.seek(0)
+            version = _parse_version(lock.read()) + 1
+            lock.seek(0)
+            lock.truncate()
+            lock.write(str(version))
+            lock.flush()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    logger.info("Stored version %d of %s", version, path)
+    if context is not None:
+        notify_change(path, version, context)
+    return version
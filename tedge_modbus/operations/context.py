@@ -1,9 +1,73 @@
 """Operation context"""
 
+import copy
+import os
 import subprocess
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-import toml
+import tomli
+
+# parsed configuration files by path: (file version, config)
+_CONFIG_CACHE: dict = {}
+_CONFIG_CACHE_LOCK = threading.Lock()
+_DEVICE_ID_LOCK = threading.Lock()
+_DEVICE_ID = None
+_SHARED_CONTEXT = None
+
+
+def file_version(path):
+    """Get the version of a file as (modification time, size, inode)"""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def load_config(path) -> dict:
+    """Load a TOML configuration file
+
+    The file is parsed once per version (see file_version) and the parsed
+    configuration is shared by all callers of the process. Every caller gets
+    its own copy, so it can be changed without affecting the others.
+    """
+    path = os.fspath(path)
+    version = file_version(path)
+    with _CONFIG_CACHE_LOCK:
+        cached = _CONFIG_CACHE.get(path)
+    if cached is None or cached[0] != version:
+        with open(path, mode="rb") as file:
+            cached = (version, tomli.load(file))
+        with _CONFIG_CACHE_LOCK:
+            _CONFIG_CACHE[path] = cached
+    return copy.deepcopy(cached[1])
+
+
+def invalidate_config(path=None):
+    """Forget the parsed configuration of a file, or of all files if no path is given
+
+    Used by file watchers, so a change is picked up even if the file
+    version did not change.
+    """
+    with _CONFIG_CACHE_LOCK:
+        if path is None:
+            _CONFIG_CACHE.clear()
+        else:
+            _CONFIG_CACHE.pop(os.fspath(path), None)
+
+
+def tedge_device_id():
+    """Get thin-edge.io device id, it is queried once per process"""
+    global _DEVICE_ID  # pylint: disable=global-statement
+    with _DEVICE_ID_LOCK:
+        if _DEVICE_ID is None:
+            # Run the command and capture the output
+            result = subprocess.run(
+                ["tedge", "config", "get", "device.id"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            _DEVICE_ID = result.stdout.strip()
+        return _DEVICE_ID
 
 
 @dataclass
@@ -14,6 +78,9 @@ class Context:
     broker = "localhost"
     port = 1883
     client_id = "c8y_ModbusConfiguration-operation-client"
+    # publishes (topic, payload, qos, retain) with the MQTT client of the process
+    # running the operations in-process (the reader), None to connect per message
+    publisher = None
     config_dir = Path("/etc/tedge/plugins/modbus")
     base_config_path = config_dir / "modbus.toml"
 
@@ -25,19 +92,17 @@ class Context:
     @property
     def device_id(self):
         """Get thin-edge.io device id"""
-        try:
-            # Run the command and capture the output
-            result = subprocess.run(
-                ["tedge", "config", "get", "device.id"],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            return result.stdout.strip()
-        except subprocess.CalledProcessError as proc_err:
-            raise proc_err
+        return tedge_device_id()
 
     @property
     def base_config(self):
         """loads the default modbus.toml file and gives it back as dict"""
-        return toml.load(self.base_config_path)
+        return load_config(self.base_config_path)
+
+
+def shared_context() -> Context:
+    """Get the context shared by all operations of the process"""
+    global _SHARED_CONTEXT  # pylint: disable=global-statement
+    if _SHARED_CONTEXT is None:
+        _SHARED_CONTEXT = Context()
+    return _SHARED_CONTEXT
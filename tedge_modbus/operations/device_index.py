@@ -0,0 +1,133 @@
+"""Index of the device definitions for name-based lookups."""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+
+import toml
+
+# parsed devices.toml files by path: (mtime_ns, size, sha256, DeviceIndex)
+_FILE_CACHE: dict = {}
+_FILE_CACHE_LOCK = threading.Lock()
+# number of metric names whose match is remembered per trie
+MAX_CACHED_MATCHES = 1024
+
+
+class NameTrie:  # pylint: disable=too-few-public-methods
+    """Prefix trie of register or coil names.
+
+    Every name keeps the position of its definition in the device
+    configuration, so matches are resolved in configuration order.
+    """
+
+    def __init__(self, configs: list[dict], id_key: str):
+        self.root: dict = {}
+        self.configs = configs
+        self.matches: dict = {}
+        for position, config in enumerate(configs):
+            config_id = config.get(id_key)
+            if not config_id:
+                continue
+            node = self.root
+            for char in config_id:
+                node = node.setdefault(char, {})
+            # a name configured twice resolves to its first definition
+            node.setdefault(None, position)
+
+    def _positions(self, metric_name: str, start: int):
+        """Get the positions of all names found at the start offset of the metric name."""
+        node = self.root
+        for char in metric_name[start:]:
+            node = node.get(char)
+            if node is None:
+                return
+            if None in node:
+                yield node[None]
+
+    def match(self, metric_name: str) -> tuple[dict | None, bool]:
+        """Find the definition of a metric name.
+
+        The first definition (in configuration order) whose name is a prefix of
+        the metric name is preferred, otherwise the first one whose name is
+        contained in it. Returns (config, is_partial_match); results are cached
+        per metric name.
+        """
+        if metric_name not in self.matches:
+            if len(self.matches) >= MAX_CACHED_MATCHES:
+                self.matches.clear()
+            prefix = min(self._positions(metric_name, 0), default=None)
+            if prefix is not None:
+                self.matches[metric_name] = (self.configs[prefix], False)
+            else:
+                partial = min(
+                    (
+                        position
+                        for start in range(1, len(metric_name))
+                        for position in self._positions(metric_name, start)
+                    ),
+                    default=None,
+                )
+                self.matches[metric_name] = (
+                    self.configs[partial] if partial is not None else None,
+                    True,
+                )
+        return self.matches[metric_name]
+
+
+class DeviceIndex:
+    """Device definitions indexed by device name and register/coil names."""
+
+    def __init__(self, devices: list[dict]):
+        self.devices = devices
+        self.by_name: dict = {}
+        for device in devices:
+            self.by_name.setdefault(device.get("name"), device)
+        self.tries: dict = {}
+        self.lock = threading.Lock()
+
+    def device(self, name: str) -> dict | None:
+        """Get the definition of a device by its name."""
+        return self.by_name.get(name)
+
+    def trie(self, device: dict, config_type: str, id_key: str) -> NameTrie:
+        """Get the name trie of the registers or coils of a device."""
+        key = (device.get("name"), config_type, id_key)
+        with self.lock:
+            if key not in self.tries:
+                self.tries[key] = NameTrie(device.get(config_type, []) or [], id_key)
+            return self.tries[key]
+
+
+def as_device_index(devices: DeviceIndex | list[dict]) -> DeviceIndex:
+    """Get the index of device definitions which may not be indexed yet."""
+    if isinstance(devices, DeviceIndex):
+        return devices
+    return DeviceIndex(devices)
+
+
+def load_device_index(devices_path) -> DeviceIndex:
+    """Load the device index of a devices.toml file.
+
+    The parsed file is cached by path. The cache is reused while the
+    modification time is unchanged, or while the content hash is unchanged
+    if only the modification time changed.
+    """
+    path = os.fspath(devices_path)
+    stat = os.stat(path)
+    with _FILE_CACHE_LOCK:
+        cached = _FILE_CACHE.get(path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[3]
+    with open(path, "rb") as file:
+        content = file.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if cached and cached[2] == digest:
+        index = cached[3]
+    else:
+        devices_cfg = toml.loads(content.decode("utf-8"))
+        index = DeviceIndex(devices_cfg.get("device", []) or [])
+    with _FILE_CACHE_LOCK:
+        _FILE_CACHE[path] = (stat.st_mtime_ns, stat.st_size, digest, index)
+    return index
@@ -4,23 +4,32 @@
 import logging
 
 from pymodbus.exceptions import ConnectionException
-from .context import Context
+from .context import Context, shared_context
 from .common import (
     parse_json_arguments,
     prepare_client,
     apply_loglevel,
     close_client_quietly,
     extract_device_from_topic,
+    load_devices,
     _match_from_metrics,
 )
+from .device_index import DeviceIndex
+from .write_plan import check_results, write_coil_batch
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
+# type of the values written by this handler (coils)
+REGISTER_TYPE = "co"
 
 
-def run(arguments: str | list[str], topic: str | None = None) -> None:
+def run(
+    arguments: str | list[str],
+    topic: str | None = None,
+    context: Context | None = None,
+) -> None:
     """Run set coil operation handler
 
     Supports two payload formats:
@@ -41,19 +50,24 @@ def run(arguments: str | list[str], topic: str | None = None) -> None:
                 "name": "<name>_xxxxxxxx",
                 "timestamp": "2025-09-23T01:00:00Z",
                 "value": 0 or 1
-            }]
+            }, ...]
         }
+        All metrics are written, adjacent coils in a single request.
         Requires topic: te/device/<device-id>///cmd/modbus_SetCoil/<mapper-id>
+
+    The context defaults to the context shared by all operations of the process.
     """
     payload = parse_json_arguments(arguments)
-    context = Context()
+    if context is None:
+        context = shared_context()
     modbus_config = context.base_config
     apply_loglevel(logger, modbus_config)
     logger.info("Processing set coil operation")
 
     # Determine format and extract parameters
+    devices_path = context.config_dir / "devices.toml"
     if "metrics" in payload and topic:
-        params = _process_new_format_coil(payload, topic, context)
+        params = _process_new_format_coil(payload, topic, load_devices(devices_path))
     else:
         params = _process_explicit_format_coil(payload)
 
@@ -61,11 +75,42 @@ def run(arguments: str | list[str], topic: str | None = None) -> None:
     client = prepare_client(
         params["ip_address"],
         params["slave_id"],
-        context.config_dir / "devices.toml",
+        devices_path,
         modbus_config,
     )
 
     try:
+        results = write(client, params)
+    finally:
+        close_client_quietly(client)
+    if results is not None:
+        check_results(results)
+
+
+def resolve_params(
+    payload: dict, topic: str | None, devices: DeviceIndex | list[dict]
+) -> dict:
+    """Determine the payload format and extract the write parameters."""
+    if "metrics" in payload and topic:
+        return _process_new_format_coil(payload, topic, devices)
+    return _process_explicit_format_coil(payload)
+
+
+def write(
+    client, params: dict, confirmed: dict | None = None, **_options
+) -> list[dict] | None:
+    """Write the coil(s) described by the parameters using the given client.
+
+    If confirmed is a dict, the written coils of name-based writes are read
+    back into it. The other options of set_register.write do not apply to
+    coils and are ignored. For the name-based format the result of every
+    metric is returned.
+    """
+    try:
+        if "writes" in params:
+            return write_coil_batch(
+                client, params["slave_id"], params["writes"], confirmed
+            )
         result = client.write_coil(
             address=params["coil_number"],
             value=bool(params["value"]),
@@ -81,6 +126,7 @@ def run(arguments: str | list[str], topic: str | None = None) -> None:
             params["coil_number"],
             params["slave_id"],
         )
+        return None
     except ConnectionException as err:
         logger.error(
             "Connection error while writing to slave %d: %s",
@@ -88,48 +134,62 @@ def run(arguments: str | list[str], topic: str | None = None) -> None:
             err,
         )
         raise
-    finally:
-        close_client_quietly(client)
 
 
-def _process_new_format_coil(payload: dict, topic: str, context) -> dict:
-    """Process new format coil payload with metrics array."""
+def _process_new_format_coil(
+    payload: dict, topic: str, devices: DeviceIndex | list[dict]
+) -> dict:
+    """Process new format coil payload with metrics array.
+
+    All metrics are resolved, the returned parameters contain one write per metric.
+    """
     logger.info("Processing new format payload with metrics array")
     device_name = extract_device_from_topic(topic)
     if not device_name:
         raise ValueError(f"Could not extract device name from topic: {topic}")
 
-    coil_config, target_device, coil_id, write_value = _match_from_metrics(
+    target_device, matches = _match_from_metrics(
         payload,
         device_name,
-        context.config_dir / "devices.toml",
+        devices,
         "coils",
         "name",
         int,
     )
 
-    if not coil_config:
-        raise ValueError("Could not match any coil for metrics in payload")
     if not target_device:
         raise ValueError(f"Could not find device '{device_name}' in devices.toml")
+    if not any(coil_config for _, coil_config, _, _ in matches):
+        raise ValueError("Could not match any coil for metrics in payload")
 
-    logger.info("Matched CoilID: %s, Value: %s", coil_id, write_value)
-
-    coil_number = coil_config.get("number")
-    if coil_number is None:
-        raise ValueError(
-            f"Coil configuration missing 'number' field for name '{coil_id}'"
-        )
-
-    value_int = int(write_value)
-    if value_int not in (0, 1):
-        raise ValueError("Coil value must be 0 or 1")
+    writes = []
+    for metric_name, coil_config, coil_id, write_value in matches:
+        logger.info("Matched CoilID: %s, Value: %s", coil_id, write_value)
+        if not coil_config:
+            writes.append({"name": metric_name, "error": "No matching coil"})
+        elif coil_config.get("number") is None:
+            writes.append(
+                {
+                    "name": metric_name,
+                    "error": f"Coil configuration missing 'number' field for name '{coil_id}'",
+                }
+            )
+        elif int(write_value) not in (0, 1):
+            writes.append({"name": metric_name, "error": "Coil value must be 0 or 1"})
+        else:
+            writes.append(
+                {
+                    "name": metric_name,
+                    "coil_number": coil_config["number"],
+                    "value": int(write_value),
+                }
+            )
 
     return {
         "ip_address": target_device.get("ip", ""),
         "slave_id": target_device.get("address"),
-        "coil_number": coil_number,
-        "value": value_int,
+        "device": target_device.get("name"),
+        "writes": writes,
     }
 
 
@@ -6,7 +6,7 @@ import struct
 import sys
 
 from pymodbus.exceptions import ConnectionException
-from .context import Context
+from .context import Context, shared_context
 from .common import (
     parse_json_arguments,
     prepare_client,
@@ -15,30 +15,44 @@ from .common import (
     parse_register_params,
     compute_masked_value,
     extract_device_from_topic,
+    load_devices,
     _match_from_metrics,
 )
+from .device_index import DeviceIndex
+from .write_plan import check_results, write_register_batch
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
+# type of the values written by this handler (holding registers)
+REGISTER_TYPE = "hr"
 
 
-def run(arguments: str | list[str], topic: str | None = None) -> None:
+def run(
+    arguments: str | list[str],
+    topic: str | None = None,
+    context: Context | None = None,
+) -> None:
     """Run set register operation handler
     Supports two payload formats:
     1. Explicit address c8y format (full register details)
     2. New format (name-based)
+    The context defaults to the context shared by all operations of the process.
     """
     payload = parse_json_arguments(arguments)
-    context = Context()
+    if context is None:
+        context = shared_context()
     modbus_config = context.base_config
     apply_loglevel(logger, modbus_config)
     logger.info("Processing set register operation")
 
     # Determine format and extract parameters
+    devices_path = context.config_dir / "devices.toml"
     if "metrics" in payload and topic:
-        params = _process_new_format_register(payload, topic, context)
+        params = _process_new_format_register(
+            payload, topic, load_devices(devices_path)
+        )
     else:
         params = _process_explicit_format_register(payload)
 
@@ -46,15 +60,58 @@ def run(arguments: str | list[str], topic: str | None = None) -> None:
     client = prepare_client(
         params["ip_address"],
         params["slave_id"],
-        context.config_dir / "devices.toml",
+        devices_path,
         modbus_config,
     )
 
     try:
+        results = write(client, params)
+    finally:
+        close_client_quietly(client)
+    if results is not None:
+        check_results(results)
+
+
+def resolve_params(
+    payload: dict, topic: str | None, devices: DeviceIndex | list[dict]
+) -> dict:
+    """Determine the payload format and extract the write parameters."""
+    if "metrics" in payload and topic:
+        return _process_new_format_register(payload, topic, devices)
+    return _process_explicit_format_register(payload)
+
+
+def write(
+    client,
+    params: dict,
+    capabilities: dict | None = None,
+    cached_value=None,
+    confirmed: dict | None = None,
+) -> list[dict] | None:
+    """Write the register(s) described by the parameters using the given client.
+
+    Bitfields use Mask Write Register if the device supports it, capabilities
+    remembers the support per device. Otherwise the current register value is
+    taken from cached_value if available and read from the device if not.
+    If confirmed is a dict, the written registers of name-based writes are
+    read back into it. For the name-based format the result of every metric
+    is returned.
+    """
+    try:
+        if "writes" in params:
+            return write_register_batch(
+                client,
+                params["slave_id"],
+                params["writes"],
+                capabilities,
+                cached_value,
+                confirmed,
+            )
         if params["is_float"]:
             _write_float_registers(client, params)
         else:
-            _write_integer_register(client, params)
+            _write_integer_register(client, params, capabilities, cached_value)
+        return None
     except ConnectionException as err:
         logger.error(
             "Connection error while writing to slave %d: %s",
@@ -62,56 +119,91 @@ def run(arguments: str | list[str], topic: str | None = None) -> None:
             err,
         )
         raise
-    finally:
-        close_client_quietly(client)
 
 
-def _process_new_format_register(payload: dict, topic: str, context) -> dict:
-    """Process new format register payload with metrics array"""
+def _process_new_format_register(
+    payload: dict, topic: str, devices: DeviceIndex | list[dict]
+) -> dict:
+    """Process new format register payload with metrics array.
+
+    All metrics are resolved, the returned parameters contain one write per metric.
+    """
     logger.info("Processing new format payload with metrics array")
     device_name = extract_device_from_topic(topic)
     if not device_name:
         raise ValueError(f"Could not extract device name from topic: {topic}")
 
-    register_config, target_device, register_id, write_value = _match_from_metrics(
+    target_device, matches = _match_from_metrics(
         payload,
         device_name,
-        context.config_dir / "devices.toml",
+        devices,
         "registers",
         "name",
         float,
     )
 
-    if not register_config:
-        raise ValueError("Could not match any register for metrics in payload")
     if not target_device:
         raise ValueError(f"Could not find device '{device_name}' in devices.toml")
+    if not any(register_config for _, register_config, _, _ in matches):
+        raise ValueError("Could not match any register for metrics in payload")
 
-    logger.info("Matched RegisterID: %s, Value: %s", register_id, write_value)
-
-    register_num = register_config.get("number")
-    if register_num is None:
-        raise ValueError(
-            f"Register configuration missing 'number' field for name '{register_id}'"
+    writes = []
+    for metric_name, register_config, register_id, write_value in matches:
+        logger.info("Matched RegisterID: %s, Value: %s", register_id, write_value)
+        writes.append(
+            _register_write(
+                metric_name, register_config, register_id, write_value, target_device
+            )
         )
 
-    is_float = register_config.get("datatype") == "float"
-    params = {
+    return {
         "ip_address": target_device.get("ip", ""),
         "slave_id": target_device.get("address"),
+        "device": target_device.get("name"),
+        "writes": writes,
+    }
+
+
+def _register_write(  # pylint: disable=too-many-arguments
+    metric_name: str,
+    register_config: dict | None,
+    register_id: str | None,
+    write_value: float,
+    target_device: dict,
+) -> dict:
+    """Describe the write of a single metric, invalid metrics carry an error."""
+    if not register_config:
+        return {"name": metric_name, "error": "No matching register"}
+
+    register_num = register_config.get("number")
+    if register_num is None:
+        return {
+            "name": metric_name,
+            "error": f"Register configuration missing 'number' field for name '{register_id}'",
+        }
+
+    register_write = {
+        "name": metric_name,
         "register": register_num,
         "start_bit": register_config.get("startbit", 0),
         "num_bits": register_config.get("nobits", 16),
-        "is_float": is_float,
+        "write_value": int(write_value),
+        "words": None,
     }
-
-    if is_float:
-        params["write_value"] = write_value
-        params["little_word_endian"] = target_device.get("littlewordendian", False)
-    else:
-        params["write_value"] = int(write_value)
-
-    return params
+    try:
+        if register_config.get("datatype") == "float":
+            register_write["words"] = _float_to_register_pairs(
+                write_value,
+                register_write["num_bits"],
+                target_device.get("littlewordendian", False),
+            )
+        elif register_write["start_bit"] == 0 and register_write["num_bits"] == 16:
+            register_write["words"] = [
+                compute_masked_value(0, 0, 16, register_write["write_value"])
+            ]
+    except ValueError as err:
+        register_write["error"] = str(err)
+    return register_write
 
 
 def _process_explicit_format_register(payload: dict) -> dict:
@@ -150,39 +242,33 @@ def _write_float_registers(client, params: dict) -> None:
         logger.info("Wrote 0x%04X to register %d", reg_value, params["register"] + i)
 
 
-def _write_integer_register(client, params: dict) -> None:
+def _write_integer_register(
+    client, params: dict, capabilities: dict | None, cached_value
+) -> None:
     """Write integer value to register with bit masking."""
-    # Read current register value first
-    read_resp = client.read_holding_registers(
-        address=params["register"], count=1, slave=params["slave_id"]
-    )
-    if read_resp.isError():
-        raise RuntimeError(f"Failed to read register {params['register']}: {read_resp}")
-
-    current_value = read_resp.registers[0] & 0xFFFF
-    new_value = compute_masked_value(
-        current_value,
-        params["start_bit"],
-        params["num_bits"],
-        params["write_value"],
-    )
-
-    # Write updated value
-    write_resp = client.write_register(
-        address=params["register"], value=new_value, slave=params["slave_id"]
-    )
-    if write_resp.isError():
-        raise RuntimeError(
-            f"Failed to write register {params['register']}: {write_resp}"
+    register_write = {
+        "name": f"register {params['register']}",
+        "register": params["register"],
+        "start_bit": params["start_bit"],
+        "num_bits": params["num_bits"],
+        "write_value": params["write_value"],
+        "words": None,
+    }
+    if params["start_bit"] == 0 and params["num_bits"] == 16:
+        register_write["words"] = [
+            compute_masked_value(0, 0, 16, params["write_value"])
+        ]
+    check_results(
+        write_register_batch(
+            client, params["slave_id"], [register_write], capabilities, cached_value
         )
-
+    )
     logger.info(
-        "Updated register %d (bits %d..%d) from 0x%04X to 0x%04X on slave %d",
+        "Updated register %d (bits %d..%d) to %d on slave %d",
         params["register"],
         params["start_bit"],
         params["start_bit"] + params["num_bits"] - 1,
-        current_value,
-        new_value,
+        params["write_value"],
         params["slave_id"],
     )
 
@@ -0,0 +1,417 @@
+"""Batched writes of several registers or coils in as few transactions as possible."""
+
+from __future__ import annotations
+
+import logging
+
+from pymodbus.pdu import ModbusExceptions
+
+from .common import compute_masked_value
+
+logger = logging.getLogger(__name__)
+
+# Maximum quantities of a single Modbus request (FC3, FC16, FC15)
+MAX_READ_REGISTERS = 125
+MAX_WRITE_REGISTERS = 123
+MAX_WRITE_COILS = 1968
+# capability flags of a device supporting Mask Write Register (FC22) and
+# Read/Write Multiple Registers (FC23)
+MASK_WRITE = "mask_write"
+READ_WRITE = "read_write"
+# number of failed Mask Write Register requests in a row of a device
+MASK_WRITE_FAILURES = "mask_write_failures"
+# failed Mask Write Register requests in a row after which read-modify-write is used
+MAX_MASK_WRITE_FAILURES = 3
+
+
+def coalesce(values: dict[int, int], max_count: int) -> list[tuple[int, list]]:
+    """Group values by address into runs of adjacent addresses.
+
+    Returns a list of (start address, values) with at most max_count values each.
+    """
+    runs = []
+    for address in sorted(values):
+        if (
+            runs
+            and runs[-1][0] + len(runs[-1][1]) == address
+            and len(runs[-1][1]) < max_count
+        ):
+            runs[-1][1].append(values[address])
+        else:
+            runs.append((address, [values[address]]))
+    return runs
+
+
+def check_results(results: list[dict]) -> None:
+    """Raise an error describing all metrics which could not be written."""
+    failed = [result for result in results if result["status"] == "failed"]
+    if failed:
+        reasons = "; ".join(
+            f"{result['name']}: {result['reason']}" for result in failed
+        )
+        raise RuntimeError(
+            f"Failed to write {len(failed)} of {len(results)} metrics: {reasons}"
+        )
+
+
+def _unsupported(response) -> bool:
+    """Check if the device rejected a request with ILLEGAL FUNCTION."""
+    return (
+        response.isError()
+        and getattr(response, "exception_code", None)
+        == ModbusExceptions.IllegalFunction
+    )
+
+
+def _read_back(  # pylint: disable=too-many-arguments
+    read, attribute: str, address: int, count: int, slave_id, confirmed
+):
+    """Read written values back from the device into confirmed."""
+    response = read(address=address, count=count, slave=slave_id)
+    if response.isError():
+        logger.warning(
+            "Failed to read back %d value(s) at %d from slave %d: %s",
+            count,
+            address,
+            slave_id,
+            response,
+        )
+        return
+    confirmed.update(zip(range(address, address + count), getattr(response, attribute)))
+
+
+def _results(writes: list[dict], errors: dict[str, str]) -> list[dict]:
+    """Build the per-metric results in the order of the metrics."""
+    results = []
+    for item in writes:
+        if item["name"] in errors:
+            results.append(
+                {
+                    "name": item["name"],
+                    "status": "failed",
+                    "reason": errors[item["name"]],
+                }
+            )
+        else:
+            results.append({"name": item["name"], "status": "successful"})
+    return results
+
+
+def _read_current_registers(  # pylint: disable=too-many-arguments
+    client, slave_id: int, owners: dict, errors: dict, cached_value=None
+):
+    """Get the current values of the registers which are partially written.
+
+    owners maps each register address to the names of its bitfield metrics.
+    Values provided by cached_value are used as they are, all other registers
+    are read from the device.
+    """
+    current = {}
+    for address in owners:
+        value = cached_value(address) if cached_value is not None else None
+        if value is not None:
+            current[address] = value & 0xFFFF
+    missing = dict.fromkeys(
+        (address for address in owners if address not in current), 0
+    )
+    for start, values in coalesce(missing, MAX_READ_REGISTERS):
+        response = client.read_holding_registers(
+            address=start, count=len(values), slave=slave_id
+        )
+        if response.isError():
+            for address in range(start, start + len(values)):
+                for name in owners[address]:
+                    errors.setdefault(
+                        name, f"Failed to read register {address}: {response}"
+                    )
+            continue
+        for offset, value in enumerate(response.registers):
+            current[start + offset] = value & 0xFFFF
+    return current
+
+
+def _bitfield_masks(items: list[dict]) -> tuple[int, int]:
+    """Combine bitfield writes of one register into the masks of a Mask Write Register.
+
+    The register becomes (current AND and_mask) OR (or_mask AND NOT and_mask).
+    """
+    and_mask = 0xFFFF
+    or_mask = 0
+    for item in items:
+        # validates the bitfield and value
+        value = compute_masked_value(
+            0, item["start_bit"], item["num_bits"], item["write_value"]
+        )
+        mask = ((1 << item["num_bits"]) - 1) << item["start_bit"]
+        and_mask &= ~mask
+        or_mask = (or_mask & ~mask) | value
+    return and_mask & 0xFFFF, or_mask
+
+
+def _mask_write_registers(  # pylint: disable=too-many-arguments
+    client, slave_id: int, partial: dict, items: dict, capabilities: dict, errors
+) -> set:
+    """Write bitfields with Mask Write Register (FC22) if the device supports it.
+
+    The support is detected with the first request and remembered in the
+    capabilities of the device. A device which rejects MAX_MASK_WRITE_FAILURES
+    requests in a row with other exceptions is not sent mask writes anymore
+    either. Returns the registers which were handled.
+    """
+    handled = set()
+    for address, names in partial.items():
+        if capabilities.get(MASK_WRITE) is False:
+            break
+        try:
+            and_mask, or_mask = _bitfield_masks(items[address])
+        except ValueError as err:
+            for name in names:
+                errors.setdefault(name, str(err))
+            handled.add(address)
+            continue
+        # the generic request helpers of pymodbus take the unit instead of slave
+        response = client.mask_write_register(
+            address=address, and_mask=and_mask, or_mask=or_mask, unit=slave_id
+        )
+        if _unsupported(response):
+            logger.info(
+                "Slave %d does not support Mask Write Register, using read-modify-write",
+                slave_id,
+            )
+            capabilities[MASK_WRITE] = False
+            break
+        handled.add(address)
+        if response.isError():
+            for name in names:
+                errors.setdefault(
+                    name, f"Failed to mask write register {address}: {response}"
+                )
+            failures = capabilities.get(MASK_WRITE_FAILURES, 0) + 1
+            capabilities[MASK_WRITE_FAILURES] = failures
+            if failures >= MAX_MASK_WRITE_FAILURES:
+                logger.warning(
+                    "Slave %d failed %d Mask Write Register requests in a row, "
+                    "using read-modify-write",
+                    slave_id,
+                    failures,
+                )
+                capabilities[MASK_WRITE] = False
+                break
+            continue
+        capabilities[MASK_WRITE] = True
+        capabilities.pop(MASK_WRITE_FAILURES, None)
+        logger.info(
+            "Mask wrote register %d (AND 0x%04X, OR 0x%04X) on slave %d",
+            address,
+            and_mask,
+            or_mask,
+            slave_id,
+        )
+    return handled
+
+
+def _merge_registers(valid: list[dict], current: dict, errors: dict) -> dict:
+    """Merge all register writes into the final value of every register.
+
+    Complete words are applied first, bitfields are applied on top of them or
+    on top of the current value of the register.
+    """
+    final = {}
+    for item in valid:
+        if item["name"] not in errors and item.get("words") is not None:
+            for offset, word in enumerate(item["words"]):
+                final[item["register"] + offset] = word & 0xFFFF
+    for item in valid:
+        if item["name"] in errors or item.get("words") is not None:
+            continue
+        base = final.get(item["register"], current.get(item["register"]))
+        try:
+            final[item["register"]] = compute_masked_value(
+                base, item["start_bit"], item["num_bits"], item["write_value"]
+            )
+        except ValueError as err:
+            errors[item["name"]] = str(err)
+    return final
+
+
+def _write_runs(
+    runs: list[tuple[int, list]],
+    write_run,
+    owners: dict,
+    errors: dict,
+    kind: str,
+) -> None:
+    """Write runs of adjacent values, a failed request fails all metrics it contains."""
+    for start, values in runs:
+        response = write_run(start, values)
+        if response.isError():
+            for address in range(start, start + len(values)):
+                for name in owners[address]:
+                    errors.setdefault(
+                        name, f"Failed to write {kind} {address}: {response}"
+                    )
+            continue
+        logger.info("Wrote %d %s(s) starting at %d", len(values), kind, start)
+
+
+def _register_writer(client, slave_id: int, capabilities: dict, confirmed):
+    """Get the function writing a run of adjacent registers.
+
+    If confirmed is a dict, the written registers are read back into it. This
+    is done with a single Read/Write Multiple Registers (FC23) request if the
+    device supports it, which is tracked in its capabilities.
+    """
+
+    def write_run(address, values):
+        if confirmed is not None and capabilities.get(READ_WRITE) is not False:
+            # the generic request helpers of pymodbus take the unit instead of slave
+            response = client.readwrite_registers(
+                read_address=address,
+                read_count=len(values),
+                write_address=address,
+                write_registers=values,
+                unit=slave_id,
+            )
+            if not _unsupported(response):
+                if not response.isError():
+                    capabilities[READ_WRITE] = True
+                    confirmed.update(
+                        zip(range(address, address + len(values)), response.registers)
+                    )
+                return response
+            logger.info(
+                "Slave %d does not support Read/Write Multiple Registers, "
+                "reading back separately",
+                slave_id,
+            )
+            capabilities[READ_WRITE] = False
+        if len(values) == 1:
+            response = client.write_register(
+                address=address, value=values[0], slave=slave_id
+            )
+        else:
+            response = client.write_registers(
+                address=address, values=values, slave=slave_id
+            )
+        if confirmed is not None and not response.isError():
+            _read_back(
+                client.read_holding_registers,
+                "registers",
+                address,
+                len(values),
+                slave_id,
+                confirmed,
+            )
+        return response
+
+    return write_run
+
+
+def write_register_batch(  # pylint: disable=too-many-arguments,too-many-locals
+    client,
+    slave_id: int,
+    writes: list[dict],
+    capabilities: dict | None = None,
+    cached_value=None,
+    confirmed: dict | None = None,
+) -> list[dict]:
+    """Write several registers of a device and return the result of every metric.
+
+    Every write is a dict with the metric "name", the "register" address and
+    either the complete "words" to write or a bitfield given by "start_bit",
+    "num_bits" and "write_value". Bitfields of the same register are merged.
+    They are written with a single Mask Write Register if the device supports
+    it (tracked in the capabilities dict of the device), otherwise each
+    register is read (or taken from cached_value) and written once. Adjacent
+    registers are written together with write_registers. If confirmed is a
+    dict, the written registers are read back and stored in it by address.
+    """
+    if capabilities is None:
+        capabilities = {}
+    errors = {item["name"]: item["error"] for item in writes if item.get("error")}
+    valid = [item for item in writes if not item.get("error")]
+
+    owners = {}
+    bitfields = {}
+    for item in valid:
+        for offset in range(len(item.get("words") or [None])):
+            owners.setdefault(item["register"] + offset, []).append(item["name"])
+        if item.get("words") is None:
+            bitfields.setdefault(item["register"], []).append(item)
+    # bitfields of registers which are written completely are merged locally
+    for item in valid:
+        for offset in range(len(item.get("words") or [])):
+            bitfields.pop(item["register"] + offset, None)
+    partial = {
+        address: [item["name"] for item in items]
+        for address, items in bitfields.items()
+    }
+
+    masked = _mask_write_registers(
+        client, slave_id, partial, bitfields, capabilities, errors
+    )
+    partial = {
+        address: names for address, names in partial.items() if address not in masked
+    }
+    current = _read_current_registers(client, slave_id, partial, errors, cached_value)
+    if confirmed is not None:
+        for start, values in coalesce(dict.fromkeys(masked, 0), MAX_READ_REGISTERS):
+            _read_back(
+                client.read_holding_registers,
+                "registers",
+                start,
+                len(values),
+                slave_id,
+                confirmed,
+            )
+
+    final = _merge_registers(
+        [item for item in valid if item["register"] not in masked or item.get("words")],
+        current,
+        errors,
+    )
+    _write_runs(
+        coalesce(final, MAX_WRITE_REGISTERS),
+        _register_writer(client, slave_id, capabilities, confirmed),
+        owners,
+        errors,
+        "register",
+    )
+    return _results(writes, errors)
+
+
+def write_coil_batch(
+    client, slave_id: int, writes: list[dict], confirmed: dict | None = None
+) -> list[dict]:
+    """Write several coils of a device and return the result of every metric.
+
+    Every write is a dict with the metric "name", the "coil_number" and the
+    "value". Adjacent coils are written together with write_coils. If
+    confirmed is a dict, the written coils are read back and stored in it.
+    """
+    errors = {item["name"]: item["error"] for item in writes if item.get("error")}
+    owners = {}
+    final = {}
+    for item in writes:
+        if item["name"] in errors:
+            continue
+        owners.setdefault(item["coil_number"], []).append(item["name"])
+        final[item["coil_number"]] = bool(item["value"])
+
+    def write_run(address, values):
+        if len(values) == 1:
+            response = client.write_coil(
+                address=address, value=values[0], slave=slave_id
+            )
+        else:
+            response = client.write_coils(
+                address=address, values=values, slave=slave_id
+            )
+        if confirmed is not None and not response.isError():
+            _read_back(
+                client.read_coils, "bits", address, len(values), slave_id, confirmed
+            )
+        return response
+
+    _write_runs(coalesce(final, MAX_WRITE_COILS), write_run, owners, errors, "coil")
+    return _results(writes, errors)
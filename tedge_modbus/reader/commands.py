@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Command worker pool"""
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 100
+
+
+class CommandWorkers:  # pylint: disable=too-many-instance-attributes
+    """Bounded pool of threads executing commands off the MQTT network thread
+
+    Commands are queued per key (the device of the command). Commands of
+    different keys run in parallel, commands of the same key run one after
+    the other in the order they were submitted. The number of queued commands
+    is bounded, further commands are rejected until the queue drains.
+    After each command, the report callback is called with the latency of the
+    command (from submit to completion in seconds) and the remaining queue depth.
+    """
+
+    def __init__(
+        self, workers=DEFAULT_WORKERS, maxsize=DEFAULT_QUEUE_SIZE, report=None
+    ):
+        self.report = report
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.active = set()
+        self.ready = collections.deque()
+        self.queued = 0
+        self.workers = 0
+        self.maxsize = maxsize
+        self.threads = []
+        self.configure(workers, maxsize)
+
+    def configure(self, workers, maxsize):
+        """Set the number of worker threads and the maximum number of queued commands"""
+        if workers < 1 or maxsize < 1:
+            raise ValueError(
+                f"Command workers and queue size must be at least 1, got {workers} and {maxsize}"
+            )
+        with self.lock:
+            self.maxsize = maxsize
+            self.workers = workers
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.lock.notify_all()
+
+    def submit(self, key, func, *args):
+        """Queue a command, returns False if the queue is full"""
+        with self.lock:
+            if self.queued >= self.maxsize:
+                return False
+            self.queued += 1
+            self.pending.setdefault(key, collections.deque()).append(
+                (time.monotonic(), func, args)
+            )
+            if key not in self.active:
+                self.active.add(key)
+                self.ready.append(key)
+                self.lock.notify_all()
+        return True
+
+    def depth(self):
+        """Get the number of queued and running commands"""
+        with self.lock:
+            return self.queued
+
+    def join(self, timeout=None):
+        """Wait until all queued commands are done, returns False on timeout"""
+        with self.lock:
+            return self.lock.wait_for(lambda: self.queued == 0, timeout)
+
+    def _work(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: self.ready or len(self.threads) > self.workers
+                )
+                if not self.ready:
+                    # the pool was shrunk, leave without a command
+                    self.threads.remove(threading.current_thread())
+                    return
+                key = self.ready.popleft()
+                submitted, func, args = self.pending[key].popleft()
+            try:
+                func(*args)
+            except Exception as err:
+                logger.error("Error executing command of %s: %s", key, err)
+            latency = time.monotonic() - submitted
+            with self.lock:
+                self.queued -= 1
+                depth = self.queued
+                if self.pending[key]:
+                    # one command per turn, so a busy device does not starve the others
+                    self.ready.append(key)
+                else:
+                    del self.pending[key]
+                    self.active.discard(key)
+                self.lock.notify_all()
+            if self.report is not None:
+                try:
+                    self.report(latency, depth)
+                except Exception as err:
+                    logger.warning("Failed to report command statistics: %s", err)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Compiled configuration cache"""
+import hashlib
+import logging
+import os
+import pickle
+import stat
+import tempfile
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+# changed whenever the layout of the compiled configuration or the poll plans
+# changes, so caches written by other versions are not used
+COMPILED_FORMAT = 1
+
+
+@dataclass
+class CompiledConfig:
+    """Devices and their poll plans compiled from the configuration files
+
+    device_files holds the device names of every file of the devices
+    directory, plans the poll plan of every valid device by name.
+    """
+
+    devices: list
+    device_files: dict = field(default_factory=dict)
+    plans: dict = field(default_factory=dict)
+    source_hash: str = ""
+
+
+def source_hash(paths):
+    """Hash the content of the configuration files, missing files included"""
+    digest = hashlib.sha256(f"{COMPILED_FORMAT}\0".encode())
+    for path in paths:
+        digest.update(os.fspath(path).encode() + b"\0")
+        try:
+            with open(path, "rb") as file:
+                digest.update(hashlib.sha256(file.read()).digest())
+        except OSError:
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+
+def is_trusted(file):
+    """Check if an open cache file may be unpickled
+
+    Unpickling runs code, so the file must be owned by the user of the
+    process and must not be writable by group or others.
+    """
+    info = os.fstat(file.fileno())
+    return info.st_uid == os.geteuid() and not info.st_mode & (
+        stat.S_IWGRP | stat.S_IWOTH
+    )
+
+
+def load_compiled(path, expected_hash):
+    """Load a compiled configuration, None if it was compiled from other sources
+    or if the file is not trusted (see is_trusted)"""
+    try:
+        with open(path, "rb") as file:
+            if not is_trusted(file):
+                logger.warning(
+                    "Ignoring compiled configuration %s, it must be owned by the "
+                    "plugin and not be writable by group or others",
+                    path,
+                )
+                return None
+            compiled = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        logger.warning("Failed to load compiled configuration %s: %s", path, err)
+        return None
+    if (
+        not isinstance(compiled, CompiledConfig)
+        or compiled.source_hash != expected_hash
+    ):
+        return None
+    return compiled
+
+
+def store_compiled(path, compiled):
+    """Store a compiled configuration, the file is replaced atomically"""
+    try:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+            pickle.dump(compiled, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, path)
+    except (OSError, pickle.PicklingError) as err:
+        logger.warning("Failed to store compiled configuration in %s: %s", path, err)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Pooled Modbus connections"""
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+
+def bus_key(device):
+    """Identify the bus of a device
+
+    RTU devices on the same serial port and TCP devices behind the same
+    ip and port share one bus and therefore one connection.
+    """
+    if device["protocol"] == "RTU":
+        return ("RTU", device["port"])
+    return (device["protocol"], device.get("ip"), device["port"])
+
+
+# client methods sending a request, their round trip time is measured
+REQUEST_METHODS = frozenset(
+    (
+        "read_coils",
+        "read_discrete_inputs",
+        "read_holding_registers",
+        "read_input_registers",
+        "write_coil",
+        "write_coils",
+        "write_register",
+        "write_registers",
+        "mask_write_register",
+        "readwrite_registers",
+    )
+)
+
+
+class UnitStats:
+    """Request latency and session wait time of one unit id on a bus"""
+
+    def __init__(self):
+        self.requests = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.sessions = 0
+        self.wait = 0.0
+
+    def add_request(self, latency):
+        """Count a request answered after the given seconds"""
+        self.requests += 1
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def add_session(self, wait):
+        """Count a session which waited the given seconds for the bus"""
+        self.sessions += 1
+        self.wait += wait
+
+    def summary(self):
+        """Get the number of requests, their average and maximum round trip time
+        and the average wait time of the sessions"""
+        return {
+            "requests": self.requests,
+            "latency": round(self.latency / self.requests, 4) if self.requests else 0,
+            "maxlatency": round(self.max_latency, 4),
+            "wait": round(self.wait / self.sessions, 4) if self.sessions else 0,
+        }
+
+
+class MeteredClient:
+    """Modbus client of a bus which measures the round trip time of every request
+
+    All attributes are those of the wrapped client. The unit id the requests
+    are counted for is set by the session using the client.
+    """
+
+    def __init__(self, client, connection):
+        self.client = client
+        self.connection = connection
+        self.unit = None
+
+    def record(self, latency):
+        """Count a request of the current unit, e.g. a pipelined request"""
+        self.connection.record(self.unit, latency)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in REQUEST_METHODS:
+            return attribute
+
+        def request(*args, **kwargs):
+            sent = time.monotonic()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self.record(time.monotonic() - sent)
+
+        return request
+
+
+class BusConnection:
+    """Modbus client of a bus and the scheduler of the sessions on it
+
+    The bus has a single client (a serial port, or one persistent socket to
+    a TCP gateway), used by one session at a time. Waiting sessions are
+    granted in turns per unit id, so the devices behind a gateway are served
+    fairly, however many sessions one of them queues. A session may still
+    have several requests outstanding on the socket, see PipelinedReader.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.client = None
+        self.busy = False
+        self.condition = threading.Condition()
+        # waiting sessions by unit id, in the order in which the units are served
+        self.waiting = collections.OrderedDict()
+        self.stats = {}
+
+    def _is_next(self, unit, ticket):
+        """Check if a waiting session is next and the bus is free"""
+        return (
+            not self.busy
+            and next(iter(self.waiting)) == unit
+            and self.waiting[unit][0] is ticket
+        )
+
+    def acquire(self, unit=None):
+        """Wait for the turn of a unit id and get the client of the bus"""
+        ticket = object()
+        requested = time.monotonic()
+        with self.condition:
+            self.waiting.setdefault(unit, collections.deque()).append(ticket)
+            self.condition.wait_for(lambda: self._is_next(unit, ticket))
+            self.waiting[unit].popleft()
+            if self.waiting[unit]:
+                self.waiting.move_to_end(unit)
+            else:
+                del self.waiting[unit]
+            self.busy = True
+            if self.client is None:
+                self.client = MeteredClient(self.factory(), self)
+            self.client.unit = unit
+            self.stats.setdefault(unit, UnitStats()).add_session(
+                time.monotonic() - requested
+            )
+            return self.client
+
+    def release(self):
+        """Give the client back to the next session"""
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
+
+    def record(self, unit, latency):
+        """Count a request of a unit id answered after the given seconds"""
+        with self.condition:
+            self.stats.setdefault(unit, UnitStats()).add_request(latency)
+
+    def queued(self):
+        """Get the number of waiting sessions"""
+        with self.condition:
+            return sum(len(tickets) for tickets in self.waiting.values())
+
+    def take_stats(self):
+        """Get the stats per unit id since the last call and reset them"""
+        with self.condition:
+            stats, self.stats = self.stats, {}
+        return {unit: unit_stats.summary() for unit, unit_stats in stats.items()}
+
+    def close(self):
+        """Close the client once the running session is done"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.busy)
+            if self.client is not None:
+                self.client.close()
+
+
+class ConnectionPool:
+    """Modbus connections shared by polling and writes, one per bus
+
+    The clients stay open between polls. A client is closed after a failed
+    request, it reconnects with the next request.
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, factory):
+        """Get the connection of a bus, its client is created by the factory if needed"""
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None:
+                connection = BusConnection(factory)
+                self.connections[key] = connection
+            return connection
+
+    @contextmanager
+    def session(self, key, factory, unit=None):
+        """Use the client of a bus exclusively, in turns with the other unit ids"""
+        connection = self.get(key, factory)
+        client = connection.acquire(unit)
+        try:
+            yield client
+        except Exception:
+            client.close()
+            raise
+        finally:
+            connection.release()
+
+    def take_stats(self):
+        """Get the stats per bus and unit id since the last call and reset them"""
+        with self.lock:
+            connections = list(self.connections.items())
+        stats = {}
+        for key, connection in connections:
+            bus_stats = connection.take_stats()
+            if bus_stats:
+                stats[key] = (bus_stats, connection.queued())
+        return stats
+
+    def close_all(self):
+        """Close and forget all connections"""
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
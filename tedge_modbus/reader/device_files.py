@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Device files of the devices directory"""
+import logging
+import os
+
+from ..operations.context import file_version, load_config
+
+logger = logging.getLogger(__name__)
+
+# directory with further device definitions, one device per file
+DEVICES_DIR_NAME = "devices.d"
+
+
+def is_device_file(path):
+    """Check if a path is a device file of the devices directory"""
+    filename = os.path.basename(path)
+    return (
+        os.path.basename(os.path.dirname(path)) == DEVICES_DIR_NAME
+        and filename.endswith(".toml")
+        and not filename.startswith(".")
+    )
+
+
+def device_file_versions(config_dir):
+    """Get the versions of all files of the devices directory by path"""
+    devices_dir = os.path.join(config_dir, DEVICES_DIR_NAME)
+    versions = {}
+    if os.path.isdir(devices_dir):
+        for filename in sorted(os.listdir(devices_dir)):
+            path = os.path.join(devices_dir, filename)
+            if is_device_file(path):
+                versions[path] = file_version(path)
+    return versions
+
+
+def read_device_file(path):
+    """Read a file of the devices directory
+
+    The file holds the definition of a single device, either as top-level
+    table or as the only [[device]] entry.
+    """
+    try:
+        definition = load_config(path)
+    except (OSError, ValueError) as err:
+        logger.error("Failed to read device file %s: %s", path, err)
+        return []
+    if "device" in definition:
+        return list(definition["device"])
+    return [definition] if definition else []
+
+
+def unique_devices(devices, new_devices, source):
+    """Get the new devices whose names are not used by the devices yet"""
+    names = {device["name"] for device in devices}
+    added = []
+    for device in new_devices:
+        if device.get("name") in names:
+            logger.error(
+                "Ignoring device %s of %s, the name is used already",
+                device.get("name"),
+                source,
+            )
+            continue
+        names.add(device.get("name"))
+        added.append(device)
+    return added
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Learned address holes of Modbus devices"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# seconds after which a learned hole is probed again
+DEFAULT_HOLE_TTL = 3600
+
+
+def device_key(device):
+    """Identify a device by its connection, so the holes stay with the hardware"""
+    return (
+        f'{device.get("protocol")}://{device.get("ip", "")}:{device.get("port")}'
+        f'/{device.get("address")}'
+    )
+
+
+def definition_digest(device):
+    """Hash the definition of a device, to detect when it changed"""
+    return hashlib.sha256(
+        json.dumps(device, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+class AddressHoles:
+    """Addresses which devices rejected with ILLEGAL DATA ADDRESS
+
+    The holes are learned while polling and kept in memory. If a path is
+    configured, they are also stored on disk so they survive a restart.
+    A hole expires after ttl seconds, so the address is probed again and an
+    address rejected only temporarily (e.g. while the device was booting)
+    is polled again. The holes of a device are forgotten when its
+    definition changes.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_HOLE_TTL):
+        self.path = None
+        self.ttl = ttl
+        self.holes = {}
+        # unix time at which each hole was learned, by device key and (register type, address)
+        self.learned = {}
+        # digest of the definition of every device the holes were learned with
+        self.definitions = {}
+        if path:
+            self.open(path)
+
+    def open(self, path):
+        """Use the given file to store the holes and merge the holes stored in it"""
+        self.path = path
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding="utf8") as file:
+                stored = json.load(file)
+        except (OSError, ValueError) as err:
+            logger.warning("Ignoring invalid address hole cache %s: %s", path, err)
+            return
+        now = time.time()
+        for key, entry in stored.items():
+            if "holes" not in entry:
+                # holes stored without learn time and definition
+                entry = {"holes": entry}
+            if entry.get("definition"):
+                self.definitions.setdefault(key, entry["definition"])
+            holes = self.holes.setdefault(key, {})
+            learned = self.learned.setdefault(key, {})
+            for register_type, addresses in entry["holes"].items():
+                if isinstance(addresses, list):
+                    addresses = dict.fromkeys(addresses, now)
+                for address, learned_at in addresses.items():
+                    holes.setdefault(register_type, set()).add(int(address))
+                    learned.setdefault((register_type, int(address)), learned_at)
+
+    def for_device(self, device):
+        """Get the holes of a device by register type
+
+        The returned dict is updated in place when holes are learned, expire
+        or are forgotten because the definition of the device changed.
+        """
+        return self.holes.setdefault(device_key(device), {})
+
+    def check_definition(self, device):
+        """Forget the holes of a device if its definition changed since they were learned"""
+        key = device_key(device)
+        digest = definition_digest(device)
+        known = self.definitions.get(key)
+        self.definitions[key] = digest
+        if known is None or known == digest or not self.learned.get(key):
+            return
+        logger.info("Forgetting the address holes of changed device %s", key)
+        for addresses in self.for_device(device).values():
+            addresses.clear()
+        self.learned[key] = {}
+        self.save()
+
+    def add(self, device, register_type, address):
+        """Add a hole of a device, returns False if it was known already"""
+        addresses = self.for_device(device).setdefault(register_type, set())
+        if address in addresses:
+            return False
+        addresses.add(address)
+        self.learned.setdefault(device_key(device), {})[
+            (register_type, address)
+        ] = time.time()
+        self.save()
+        return True
+
+    def expire(self, device, now=None):
+        """Remove the holes of a device learned more than ttl seconds ago,
+        returns the number of removed holes"""
+        key = device_key(device)
+        learned = self.learned.get(key)
+        if not learned or not self.ttl:
+            return 0
+        now = time.time() if now is None else now
+        expired = [hole for hole, at in learned.items() if now - at >= self.ttl]
+        for register_type, address in expired:
+            del learned[(register_type, address)]
+            self.holes[key].get(register_type, set()).discard(address)
+        if expired:
+            self.save()
+        return len(expired)
+
+    def save(self):
+        """Store the holes if a path is configured"""
+        if not self.path:
+            return
+        data = {
+            key: {
+                "definition": self.definitions.get(key),
+                "holes": {
+                    register_type: {
+                        str(address): self.learned.get(key, {}).get(
+                            (register_type, address), time.time()
+                        )
+                        for address in sorted(addresses)
+                    }
+                    for register_type, addresses in register_types.items()
+                    if addresses
+                },
+            }
+            for key, register_types in self.holes.items()
+            if any(register_types.values())
+        }
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, delete=False, encoding="utf8"
+            ) as file:
+                json.dump(data, file, indent=2)
+            os.replace(file.name, self.path)
+        except OSError as err:
+            logger.warning("Failed to store address holes in %s: %s", self.path, err)
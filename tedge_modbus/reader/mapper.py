@@ -4,8 +4,13 @@ import json
 import struct
 import sys
 import math
+import threading
+import time
 from datetime import datetime, timezone
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+from .poll_plan import REGISTER_TYPES
 
 topics = {
     "measurement": "te/device/CHILD_ID///m/",
@@ -14,17 +19,34 @@ topics = {
 }
 
 
+@lru_cache(maxsize=256)
+def _format_unix_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def format_timestamp(timestamp=None):
+    """Format a unix timestamp as ISO 8601, defaults to now
+
+    Values read in the same block share one timestamp, so every timestamp
+    is only formatted once.
+    """
+    if timestamp is None:
+        return datetime.now(timezone.utc).isoformat()
+    return _format_unix_timestamp(timestamp)
+
+
 @dataclass
 class MappedMessage:
     """Mapped message"""
 
     data: str = ""
     topic: str = ""
-    time: str = datetime.now(timezone.utc).isoformat()
+    time: str = field(default_factory=format_timestamp)
+    retain: bool = False
 
     def serialize(self):
         """Serialize message adding time if not present"""
-        if "/cmd/" in self.topic:
+        if "/cmd/" in self.topic or not self.data:
             return self.data
         out = json.loads(self.data)
         if "time" not in out:
@@ -58,6 +80,30 @@ class MappedMessage:
         self.data = json.dumps(merged)
 
 
+@dataclass
+class MappingState:
+    """Debounce and rate state of the alarm or event mapping of a register or coil"""
+
+    # value which counts, it only changes once a new value lasted the dwell time
+    value: object = None
+    # new value which is read since the unix time since, None if the value did not change
+    candidate: object = None
+    since: float = None
+    # start of the current rate window, number of events and suppressed events in it
+    window: float = 0.0
+    events: int = 0
+    suppressed: int = 0
+
+    @property
+    def pending(self):
+        """Check if the next poll must be mapped even if the value did not change"""
+        return self.since is not None or self.suppressed > 0
+
+
+# seconds of the window of the maximum event rate (maxrate)
+RATE_WINDOW = 60
+
+
 class ModbusMapper:
     """Modbus mapper"""
 
@@ -66,6 +112,60 @@ class ModbusMapper:
     def __init__(self, device):
         self.device = device
         self.data = {"hr": {}, "ir": {}, "co": {}, "di": {}}
+        # raw values of every read block and the last measurement output per
+        # register, used to skip decoding of blocks which did not change
+        self.blocks = {}
+        self.measurements = {}
+        # debounce and rate state of the alarm and event mappings
+        self.states = {}
+        # registers and coils which must be mapped by the next poll, see MappingState
+        self.pending = set()
+        # held while mapping, polls and confirmed writes map on different threads
+        self.lock = threading.Lock()
+
+    def unchanged_blocks(self, poll_model, results):
+        """Get the register type and start of all read blocks which are
+        identical to the previous poll"""
+        unchanged = set()
+        for register_type, blocks in zip(REGISTER_TYPES, poll_model):
+            buffer = results[register_type]
+            for block in blocks:
+                key = (register_type, block[0], block[-1])
+                fingerprint = tuple(buffer.get(address) for address in block)
+                if None not in fingerprint and self.blocks.get(key) == fingerprint:
+                    unchanged.add((register_type, block[0]))
+                self.blocks[key] = fingerprint
+        return unchanged
+
+    def replay_register(
+        self, register_def, device_combine_measurements=False, timestamp=None
+    ):
+        """Replay the last output of a register whose raw value did not change
+
+        Alarms and events are only raised on a change of the value, so only the
+        measurement has to be repeated. Returns None if nothing can be replayed
+        and the register needs to be mapped.
+        """
+        register_type = "ir" if register_def.get("input") else "hr"
+        register_key = f'{register_def["number"]}:{register_def["startbit"]}'
+        if register_key not in self.data[register_type] or (
+            self.pending and (register_type, register_key) in self.pending
+        ):
+            return None
+        measurement_mapping = register_def.get("measurementmapping")
+        if measurement_mapping is None or register_def.get("on_change", False):
+            return [], None
+        data = self.measurements.get((register_type, register_key))
+        if data is None:
+            return None
+        message = MappedMessage(
+            data,
+            topics["measurement"].replace("CHILD_ID", self.device.get("name")),
+            format_timestamp(timestamp),
+        )
+        if measurement_mapping.get("combinemeasurements", device_combine_measurements):
+            return [], message
+        return [message], None
 
     def validate(self, register_def):
         """Validate definition"""
@@ -97,10 +197,19 @@ class ModbusMapper:
         )[0]
 
     def map_register(
-        self, read_register, register_def, device_combine_measurements=False
+        self,
+        read_register,
+        register_def,
+        device_combine_measurements=False,
+        timestamp=None,
     ):
-        """Map register"""
+        """Map register
+
+        The timestamp is the unix time the register was read, it defaults to now.
+        """
         # pylint: disable=too-many-locals
+        now = time.time() if timestamp is None else timestamp
+        timestamp = format_timestamp(timestamp)
         messages = []
         separate_measurement = None
         start_bit = register_def["startbit"]
@@ -158,6 +267,7 @@ class ModbusMapper:
                 data = register_def["measurementmapping"]["templatestring"].replace(
                     "%%", str(scaled_value)
                 )
+                self.measurements[(register_type, register_key)] = data
                 if register_def["measurementmapping"].get(
                     "combinemeasurements", device_combine_measurements
                 ):
@@ -166,6 +276,7 @@ class ModbusMapper:
                         topics["measurement"].replace(
                             "CHILD_ID", self.device.get("name")
                         ),
+                        timestamp,
                     )
                 else:
                     messages.append(
@@ -174,6 +285,7 @@ class ModbusMapper:
                             topics["measurement"].replace(
                                 "CHILD_ID", self.device.get("name")
                             ),
+                            timestamp,
                         )
                     )
 
@@ -181,13 +293,23 @@ class ModbusMapper:
         if register_def.get("alarmmapping") is not None:
             messages.extend(
                 self.check_alarm(
-                    value, register_def.get("alarmmapping"), register_type, register_key
+                    value,
+                    register_def.get("alarmmapping"),
+                    register_type,
+                    register_key,
+                    timestamp,
+                    now,
                 )
             )
         if register_def.get("eventmapping") is not None:
             messages.extend(
                 self.check_event(
-                    value, register_def.get("eventmapping"), register_type, register_key
+                    value,
+                    register_def.get("eventmapping"),
+                    register_type,
+                    register_key,
+                    timestamp,
+                    now,
                 )
             )
 
@@ -195,8 +317,13 @@ class ModbusMapper:
 
         return messages, separate_measurement
 
-    def map_coil(self, bits, coil_definition):
-        """Map coil"""
+    def map_coil(self, bits, coil_definition, timestamp=None):
+        """Map coil
+
+        The timestamp is the unix time the coil was read, it defaults to now.
+        """
+        now = time.time() if timestamp is None else timestamp
+        timestamp = format_timestamp(timestamp)
         messages = []
         register_type = "di" if coil_definition.get("input") else "co"
         register_key = coil_definition["number"]
@@ -208,6 +335,8 @@ class ModbusMapper:
                     coil_definition.get("alarmmapping"),
                     register_type,
                     register_key,
+                    timestamp,
+                    now,
                 )
             )
         if coil_definition.get("eventmapping") is not None:
@@ -217,44 +346,137 @@ class ModbusMapper:
                     coil_definition.get("eventmapping"),
                     register_type,
                     register_key,
+                    timestamp,
+                    now,
                 )
             )
         self.data[register_type][register_key] = value
         return messages
 
-    def check_alarm(self, value, alarm_mapping, register_type, register_key):
-        """Check alarm"""
-        messages = []
-        old_data = self.data.get(register_type).get(register_key)
-        # raise alarm if bit is 1
-        if (old_data is None or old_data == 0) and value > 0:
-            severity = alarm_mapping["severity"].lower()
-            alarm_type = alarm_mapping.get("type", "")
-            text = alarm_mapping["text"]
-            topic = topics["alarm"]
-            topic = topic.replace("CHILD_ID", self.device.get("name"))
-            topic = topic.replace("TYPE", alarm_type)
-            data = {
-                "text": text,
-                "severity": severity,
-                "time": datetime.now(timezone.utc).isoformat(),
-            }
-            messages.append(MappedMessage(json.dumps(data), topic))
-        return messages
+    def _debounce(self, kind, value, mapping, register_type, register_key, now):
+        # pylint: disable=too-many-arguments
+        """Get the state of a mapping and its previous value
 
-    def check_event(self, value, event_mapping, register_type, register_key):
-        """Check event"""
+        A changed value only counts once it was read for at least the dwell
+        time (in seconds) of the mapping, so a chattering value is ignored.
+        The first value of a mapping counts right away.
+        """
+        state = self.states.setdefault(
+            (kind, register_type, register_key), MappingState()
+        )
+        previous = state.value
+        dwell = mapping.get("dwell") or 0
+        if value == previous:
+            state.candidate, state.since = None, None
+        elif previous is None or dwell <= 0:
+            state.value, state.candidate, state.since = value, None, None
+        else:
+            if state.since is None or value != state.candidate:
+                # the dwell time starts again with every other new value
+                state.candidate, state.since = value, now
+            if now - state.since >= dwell:
+                state.value, state.candidate, state.since = value, None, None
+        return state, previous
+
+    def _update_pending(self, register_type, register_key):
+        """Remember if a register or coil must be mapped by the next poll"""
+        if any(
+            state.pending
+            for state in (
+                self.states.get((kind, register_type, register_key))
+                for kind in ("alarm", "event")
+            )
+            if state is not None
+        ):
+            self.pending.add((register_type, register_key))
+        else:
+            self.pending.discard((register_type, register_key))
+
+    def check_alarm(
+        self,
+        value,
+        alarm_mapping,
+        register_type,
+        register_key,
+        timestamp=None,
+        now=None,
+    ):  # pylint: disable=too-many-arguments
+        """Check alarm, the timestamp is expected to be formatted already
+
+        The alarm is raised (retained) when the value becomes active (> 0) and
+        cleared with an empty retained message when it becomes inactive, so
+        the retained alarm always reflects the current state. The first
+        inactive value clears an alarm which may be retained from before.
+        """
+        state, previous = self._debounce(
+            "alarm",
+            value > 0,
+            alarm_mapping,
+            register_type,
+            register_key,
+            time.time() if now is None else now,
+        )
+        self._update_pending(register_type, register_key)
+        if state.value == previous:
+            return []
+        topic = topics["alarm"]
+        topic = topic.replace("CHILD_ID", self.device.get("name"))
+        topic = topic.replace("TYPE", alarm_mapping.get("type", ""))
+        if not state.value:
+            return [MappedMessage("", topic, retain=True)]
+        data = {
+            "text": alarm_mapping["text"],
+            "severity": alarm_mapping["severity"].lower(),
+            "time": timestamp or format_timestamp(),
+        }
+        return [MappedMessage(json.dumps(data), topic, retain=True)]
+
+    def check_event(
+        self,
+        value,
+        event_mapping,
+        register_type,
+        register_key,
+        timestamp=None,
+        now=None,
+    ):  # pylint: disable=too-many-arguments
+        """Check event, the timestamp is expected to be formatted already
+
+        An event is raised when the value changed. With maxrate, at most that
+        many events are raised per minute, the further changes are counted
+        and reported by a summary event once the minute is over.
+        """
+        now = time.time() if now is None else now
+        state, previous = self._debounce(
+            "event", value, event_mapping, register_type, register_key, now
+        )
         messages = []
-        old_data = self.data.get(register_type).get(register_key)
+        topic = topics["event"]
+        topic = topic.replace("CHILD_ID", self.device.get("name"))
+        topic = topic.replace("TYPE", event_mapping.get("type", ""))
+        maxrate = event_mapping.get("maxrate")
+        if maxrate and now - state.window >= RATE_WINDOW:
+            if state.suppressed:
+                data = {
+                    "text": f'{event_mapping["text"]} '
+                    f"({state.suppressed} events suppressed)",
+                    "suppressed": state.suppressed,
+                    "time": timestamp or format_timestamp(),
+                }
+                messages.append(MappedMessage(json.dumps(data), topic))
+            state.window, state.events, state.suppressed = now, 0, 0
         # raise event if value changed
-        if old_data is None or old_data != value:
-            eventtype = event_mapping.get("type", "")
-            text = event_mapping["text"]
-            topic = topics["event"]
-            topic = topic.replace("CHILD_ID", self.device.get("name"))
-            topic = topic.replace("TYPE", eventtype)
-            data = {"text": text, "time": datetime.now(timezone.utc).isoformat()}
-            messages.append(MappedMessage(json.dumps(data), topic))
+        if state.value != previous:
+            if maxrate and state.events >= maxrate:
+                state.suppressed += 1
+            else:
+                state.events += 1
+                data = {
+                    "text": event_mapping["text"],
+                    "time": timestamp or format_timestamp(),
+                }
+                messages.append(MappedMessage(json.dumps(data), topic))
+        self._update_pending(register_type, register_key)
         return messages
 
     @staticmethod
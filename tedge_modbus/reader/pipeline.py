@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Pipelined Modbus TCP reads"""
+import itertools
+import logging
+import struct
+import time
+
+from pymodbus.bit_read_message import ReadCoilsRequest, ReadDiscreteInputsRequest
+from pymodbus.exceptions import ConnectionException
+from pymodbus.factory import ClientDecoder
+from pymodbus.register_read_message import (
+    ReadHoldingRegistersRequest,
+    ReadInputRegistersRequest,
+)
+
+logger = logging.getLogger(__name__)
+
+# read request per register type
+READ_REQUEST_TYPES = {
+    "hr": ReadHoldingRegistersRequest,
+    "ir": ReadInputRegistersRequest,
+    "co": ReadCoilsRequest,
+    "di": ReadDiscreteInputsRequest,
+}
+# Modbus application protocol header: transaction id, protocol id, length, unit id
+MBAP_HEADER = struct.Struct(">HHHB")
+_TRANSACTION_IDS = itertools.count(1)
+
+
+def next_transaction_id():
+    """Get the next transaction id, unique among the outstanding requests of the process"""
+    return next(_TRANSACTION_IDS) & 0xFFFF
+
+
+class PipelinedReader:  # pylint: disable=too-few-public-methods
+    """Send several read requests over one Modbus TCP connection before waiting for replies
+
+    Up to depth requests are outstanding at a time, a new request is sent
+    as soon as a reply arrives. Replies are matched to their requests by
+    transaction id, so the server may answer in any order. If a reply does
+    not arrive within the timeout of the client, all outstanding requests
+    fail with a ConnectionException and the caller has to close the client,
+    so late replies are not mistaken for replies of later requests.
+    The round trip time of every request is passed to record, if given.
+    """
+
+    def __init__(self, client, depth, record=None):
+        self.client = client
+        self.depth = depth
+        self.record = record
+        self.decoder = ClientDecoder()
+
+    def _send(self, request):
+        """Send a read request (register type, address, count, unit), returns its transaction id"""
+        register_type, address, count, unit = request
+        pdu = READ_REQUEST_TYPES[register_type](address=address, count=count)
+        data = pdu.encode()
+        transaction_id = next_transaction_id()
+        self.client.send(
+            MBAP_HEADER.pack(transaction_id, 0, len(data) + 2, unit)
+            + bytes([pdu.function_code])
+            + data
+        )
+        return transaction_id
+
+    def _receive(self, size):
+        """Receive exactly size bytes"""
+        data = self.client.recv(size)
+        if len(data) < size:
+            raise ConnectionException(
+                f"No complete reply within the timeout ({len(data)} of {size} bytes)"
+            )
+        return data
+
+    def read(self, requests):
+        """Read all requests, returns their responses in the order of the requests
+
+        A response can be an exception response, e.g. if the server does not
+        support an address.
+        """
+        if not self.client.connect():
+            raise ConnectionException("Failed to connect")
+        requests = list(requests)
+        responses = [None] * len(requests)
+        waiting = iter(enumerate(requests))
+        outstanding = {}
+        for index, request in itertools.islice(waiting, self.depth):
+            outstanding[self._send(request)] = (index, time.monotonic())
+        while outstanding:
+            transaction_id, _, length, _ = MBAP_HEADER.unpack(
+                self._receive(MBAP_HEADER.size)
+            )
+            pdu = self._receive(length - 1)
+            sent = outstanding.pop(transaction_id, None)
+            if sent is None:
+                logger.debug("Ignoring reply of unknown transaction %d", transaction_id)
+                continue
+            index, sent = sent
+            if self.record is not None:
+                self.record(time.monotonic() - sent)
+            response = self.decoder.decode(pdu)
+            if response is None:
+                raise ConnectionException(
+                    f"Invalid reply to transaction {transaction_id}"
+                )
+            responses[index] = response
+            for index, request in itertools.islice(waiting, 1):
+                outstanding[self._send(request)] = (index, time.monotonic())
+        return responses
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Modbus poll plan"""
+from dataclasses import dataclass
+
+REGISTER_TYPES = ("hr", "ir", "co", "di")
+
+# groups which become due within this window are polled in the same tick
+MERGE_WINDOW = 0.01
+# shortest supported poll interval in seconds
+MIN_INTERVAL = 0.01
+# weight of the latest poll period in the achieved poll interval
+ACHIEVED_WEIGHT = 0.2
+
+
+def split_set(s):
+    """Split a set of addresses into sorted lists of consecutive addresses"""
+    partitions = []
+    v = list(s)
+    v.sort()
+    cur = []
+    i = 0
+    while i < len(v):
+        cur.append(v[i])
+        if i == len(v) - 1 or v[i + 1] > v[i] + 1:
+            partitions.append(cur)
+            cur = []
+        i = i + 1
+    return partitions
+
+
+def build_query_model(device, holes=None):
+    """Build the blocks of holding registers, input registers, coils and
+    discrete inputs to read for the registers and coils of a device
+
+    Definitions which cover an address hole of the device are left out, so
+    the blocks are planned around the holes.
+    """
+    holes = holes or {}
+    holding_registers = set()
+    input_register = set()
+    coils = set()
+    discrete_input = set()
+    if device.get("registers") is not None:
+        for register_definition in device["registers"]:
+            register_number = register_definition["number"]
+            num_registers = int(
+                (register_definition["startbit"] + register_definition["nobits"] - 1)
+                / 16
+            )
+            register_end = register_number + num_registers
+            registers = list(range(register_number, register_end + 1))
+            if register_definition.get("input") is True:
+                if holes.get("ir", set()).isdisjoint(registers):
+                    input_register.update(registers)
+            elif holes.get("hr", set()).isdisjoint(registers):
+                holding_registers.update(registers)
+    if device.get("coils") is not None:
+        for coil_definition in device["coils"]:
+            coil_number = coil_definition["number"]
+            if coil_definition.get("input") is True:
+                if coil_number not in holes.get("di", set()):
+                    discrete_input.add(coil_number)
+            elif coil_number not in holes.get("co", set()):
+                coils.add(coil_number)
+
+    return (
+        split_set(holding_registers),
+        split_set(input_register),
+        split_set(coils),
+        split_set(discrete_input),
+    )
+
+
+@dataclass
+class DecodeStep:
+    """Position of a register or coil definition within the read blocks"""
+
+    definition: dict
+    register_type: str
+    address: int
+    count: int
+    block: int
+
+
+def build_decode_plan(device, poll_model):
+    """Locate every register and coil definition of a device within the
+    blocks of its query model, definitions which are not read are skipped"""
+    block_starts = {}
+    for register_type, blocks in zip(REGISTER_TYPES, poll_model):
+        for block in blocks:
+            for address in block:
+                block_starts[(register_type, address)] = block[0]
+    decode_plan = {"registers": [], "coils": []}
+    for definition in device.get("registers") or []:
+        register_type = "ir" if definition.get("input") is True else "hr"
+        if (register_type, definition["number"]) not in block_starts:
+            continue
+        decode_plan["registers"].append(
+            DecodeStep(
+                definition,
+                register_type,
+                definition["number"],
+                int((definition["startbit"] + definition["nobits"] - 1) / 16) + 1,
+                block_starts[(register_type, definition["number"])],
+            )
+        )
+    for definition in device.get("coils") or []:
+        register_type = "di" if definition.get("input") is True else "co"
+        if (register_type, definition["number"]) not in block_starts:
+            continue
+        decode_plan["coils"].append(
+            DecodeStep(
+                definition,
+                register_type,
+                definition["number"],
+                1,
+                block_starts[(register_type, definition["number"])],
+            )
+        )
+    return decode_plan
+
+
+def validate_interval(interval):
+    """Validate a poll interval given in (fractional) seconds"""
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)):
+        raise ValueError(f"Poll interval must be a number, got {interval!r}")
+    if interval < MIN_INTERVAL:
+        raise ValueError(
+            f"Poll interval must be at least {MIN_INTERVAL}s, got {interval}s"
+        )
+    return interval
+
+
+def resolve_interval(definition, default_interval, pollgroups):
+    """Get the poll interval of a register or coil definition"""
+    if definition.get("pollinterval") is not None:
+        return validate_interval(definition["pollinterval"])
+    group = definition.get("pollgroup")
+    if group is None:
+        return default_interval
+    if group not in pollgroups:
+        raise ValueError(
+            f'Unknown poll group "{group}" of {definition.get("name", definition["number"])}'
+        )
+    return validate_interval(pollgroups[group])
+
+
+class PollPlan:  # pylint: disable=too-many-instance-attributes
+    """Poll plan of a device
+
+    The registers and coils of a device are grouped by their poll interval.
+    Every group is due on its own schedule, groups which are due in the same
+    tick are merged so that their blocks are read together. The blocks are
+    planned around the address holes of the device, which are updated in
+    place when new holes are learned. A stopped plan is not polled anymore.
+    """
+
+    def __init__(self, device, default_interval, pollgroups=None, holes=None):
+        self.device = device
+        self.holes = holes if holes is not None else {}
+        self.known_holes = 0
+        validate_interval(default_interval)
+        self.groups = {}
+        for kind in ("registers", "coils"):
+            for definition in device.get(kind) or []:
+                interval = resolve_interval(
+                    definition, default_interval, pollgroups or {}
+                )
+                group = self.groups.setdefault(interval, {"registers": [], "coils": []})
+                group[kind].append(definition)
+        if not self.groups:
+            self.groups[default_interval] = {"registers": [], "coils": []}
+        self.next_due = dict.fromkeys(self.groups)
+        self.views = {}
+        self.last_poll = dict.fromkeys(self.groups)
+        self.achieved = dict(zip(self.groups, self.groups))
+        self.overruns = dict.fromkeys(self.groups, 0)
+        # first block of the next poll per merged groups, see rotate and defer
+        self.cursors = {}
+        self.deferred = 0
+        self.stopped = False
+
+    def due(self, now):
+        """Get the intervals of all groups which are due at the given time"""
+        return tuple(
+            sorted(
+                interval
+                for interval, due in self.next_due.items()
+                if due is None or due <= now + MERGE_WINDOW
+            )
+        )
+
+    def view(self, intervals):
+        """Get the device definition, query model and decode plan of the merged groups"""
+        known_holes = sum(len(addresses) for addresses in self.holes.values())
+        if known_holes != self.known_holes:
+            self.known_holes = known_holes
+            self.views.clear()
+        if intervals not in self.views:
+            view = dict(self.device)
+            view["registers"] = [
+                definition
+                for interval in intervals
+                for definition in self.groups[interval]["registers"]
+            ]
+            view["coils"] = [
+                definition
+                for interval in intervals
+                for definition in self.groups[interval]["coils"]
+            ]
+            poll_model = build_query_model(view, self.holes)
+            self.views[intervals] = (
+                view,
+                poll_model,
+                build_decode_plan(view, poll_model),
+            )
+        return self.views[intervals]
+
+    def rotate(self, intervals, blocks):
+        """Order the blocks of the merged groups to start with the ones deferred by the last poll"""
+        if not blocks:
+            return blocks
+        offset = self.cursors.get(intervals, 0) % len(blocks)
+        return blocks[offset:] + blocks[:offset]
+
+    def defer(self, intervals, read, total):
+        """Remember that only the first read of the total rotated blocks were read"""
+        self.deferred = total - read
+        if self.deferred:
+            offset = self.cursors.get(intervals, 0) % total
+            self.cursors[intervals] = (offset + read) % total
+
+    def advance(self, intervals, started, finished=None):
+        """Reschedule the polled groups and return the delay until the next poll
+
+        Groups are rescheduled relative to the time they were due, so the poll
+        duration does not add up to a drift. A group which missed a whole
+        interval is counted as overrun and resynchronized instead of catching up.
+        """
+        for interval in intervals:
+            due = self.next_due[interval]
+            if due is None or due + interval <= started:
+                if due is not None:
+                    self.overruns[interval] += 1
+                due = started
+            self.next_due[interval] = due + interval
+
+            last_poll = self.last_poll[interval]
+            if last_poll is not None:
+                self.achieved[interval] += ACHIEVED_WEIGHT * (
+                    started - last_poll - self.achieved[interval]
+                )
+            self.last_poll[interval] = started
+        if finished is None:
+            finished = started
+        return max(0.0, min(self.next_due.values()) - finished)
+
+    def lagging(self, tolerance=0.1):
+        """Get the requested and achieved intervals of groups polled too slowly"""
+        return [
+            (interval, self.achieved[interval])
+            for interval in self.groups
+            if self.achieved[interval] > interval * (1 + tolerance)
+        ]
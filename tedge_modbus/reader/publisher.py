@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Prioritized publish queue"""
+import collections
+import json
+import logging
+import threading
+import time
+
+from paho.mqtt.client import MQTT_ERR_NO_CONN, MQTT_ERR_SUCCESS, error_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PUBLISH_QUEUE_SIZE = 1000
+# seconds to wait until a message is written to the broker connection (QoS 0)
+# or acknowledged by the broker (QoS 1 or 2)
+ACK_TIMEOUT = 10
+# seconds to wait before publishing again while not connected to the broker
+RETRY_DELAY = 1
+# priorities, lower values are published first
+PRIORITY_HIGH = 0
+PRIORITY_EVENT = 1
+PRIORITY_MEASUREMENT = 2
+PRIORITY_METADATA = 3
+# priority by thin-edge.io channel (te/device/<device>/<service>/<service id>/<channel>/...)
+CHANNEL_PRIORITIES = {
+    "a": PRIORITY_HIGH,
+    "cmd": PRIORITY_HIGH,
+    "e": PRIORITY_EVENT,
+    "m": PRIORITY_MEASUREMENT,
+}
+
+
+def message_priority(topic):
+    """Get the priority of a message: registrations, alarms and command status
+    first, then events, measurements and last twin and other metadata
+
+    Registrations (topics without channel, e.g. te/device/<name>//) go first,
+    so a device is registered before its data and capabilities are sent.
+    """
+    parts = topic.split("/")
+    channel = parts[5] if len(parts) > 5 else ""
+    if not channel:
+        return PRIORITY_HIGH
+    return CHANNEL_PRIORITIES.get(channel, PRIORITY_METADATA)
+
+
+def merge_measurements(queued, payload):
+    """Merge a measurement into a queued measurement of the same topic
+
+    The series of the newer measurement replace the ones of the queued
+    measurement, so the latest values are published. Returns the merged
+    payload, or None if the payloads cannot be merged.
+    """
+    try:
+        merged = json.loads(queued)
+        newer = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(merged, dict) or not isinstance(newer, dict):
+        return None
+    for key, value in newer.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    return json.dumps(merged)
+
+
+class PublishQueue:  # pylint: disable=too-many-instance-attributes
+    """Bounded queue of MQTT messages published by a dedicated thread
+
+    Polling only queues its messages, so it never waits for the broker.
+    Messages are published by priority (see message_priority), in the order
+    they were queued within a priority. A message is only followed by the
+    next one once it was written to the broker connection (QoS 0) or
+    acknowledged by the broker (QoS 1 or 2), so a slow broker fills this
+    queue instead of the unbounded queue of the MQTT client. While not
+    connected, QoS 0 messages stay queued here (QoS 1 and 2 messages are
+    kept by the MQTT client until it reconnects). A full queue sheds measurements: a new
+    measurement is merged into a queued one of the same topic, or dropped.
+    Other messages are never dropped, they evict the oldest queued
+    measurement instead, or exceed the bound if there is none.
+    """
+
+    def __init__(self, maxsize=DEFAULT_PUBLISH_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.condition = threading.Condition()
+        self.queues = [collections.deque() for _ in range(PRIORITY_METADATA + 1)]
+        # queued measurements by topic, for merging
+        self.measurements = {}
+        self.size = 0
+        self.dropped = 0
+        self.merged = 0
+        self.failed = 0
+        self.client = None
+        self.thread = None
+
+    def configure(self, maxsize):
+        """Set the maximum number of queued messages"""
+        if maxsize < 1:
+            raise ValueError(f"Publish queue size must be at least 1, got {maxsize}")
+        with self.condition:
+            self.maxsize = maxsize
+
+    def set_client(self, client):
+        """Set the MQTT client the messages are published with and start publishing"""
+        with self.condition:
+            self.client = client
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def put(self, topic, payload, retain=False, qos=0):
+        """Queue a message, returns False if it was dropped"""
+        priority = message_priority(topic)
+        with self.condition:
+            if self.size >= self.maxsize:
+                if priority == PRIORITY_MEASUREMENT:
+                    return self._shed(topic, payload)
+                self._evict_measurement()
+            entry = [topic, payload, retain, qos]
+            self.queues[priority].append(entry)
+            self.size += 1
+            if priority == PRIORITY_MEASUREMENT:
+                self.measurements[topic] = entry
+            self.condition.notify_all()
+        return True
+
+    def _shed(self, topic, payload):
+        """Merge a measurement into the queued one of its topic or drop it"""
+        queued = self.measurements.get(topic)
+        merged = merge_measurements(queued[1], payload) if queued else None
+        if merged is None:
+            self.dropped += 1
+            return False
+        queued[1] = merged
+        self.merged += 1
+        return True
+
+    def _evict_measurement(self):
+        """Drop the oldest queued measurement to make room for a message of higher priority"""
+        measurements = self.queues[PRIORITY_MEASUREMENT]
+        if not measurements:
+            return
+        entry = measurements.popleft()
+        self.size -= 1
+        self.dropped += 1
+        if self.measurements.get(entry[0]) is entry:
+            del self.measurements[entry[0]]
+
+    def _requeue(self, entry):
+        """Put a message which could not be published back in front of its priority"""
+        topic, payload = entry[0], entry[1]
+        priority = message_priority(topic)
+        with self.condition:
+            if priority == PRIORITY_MEASUREMENT:
+                queued = self.measurements.get(topic)
+                if queued is not None:
+                    # a newer measurement of the topic is queued, the newer values win
+                    queued[1] = merge_measurements(payload, queued[1]) or queued[1]
+                    self.merged += 1
+                    return
+                if self.size >= self.maxsize:
+                    self.dropped += 1
+                    return
+                self.measurements[topic] = entry
+            self.queues[priority].appendleft(entry)
+            self.size += 1
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """Take the next message to publish, returns None on timeout"""
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.size and self.client is not None, timeout
+            ):
+                return None
+            queue = next(queue for queue in self.queues if queue)
+            entry = queue.popleft()
+            self.size -= 1
+            if self.measurements.get(entry[0]) is entry:
+                del self.measurements[entry[0]]
+            return self.client, entry
+
+    def depth(self):
+        """Get the number of queued messages"""
+        with self.condition:
+            return self.size
+
+    def take_stats(self):
+        """Get the queue depth and the messages dropped and merged since the last call"""
+        with self.condition:
+            stats = {
+                "queued": self.size,
+                "dropped": self.dropped,
+                "merged": self.merged,
+                "failed": self.failed,
+            }
+            self.dropped = 0
+            self.merged = 0
+            self.failed = 0
+        return stats
+
+    def publish_next(self, timeout=None):
+        """Publish the next message, returns False if there was none"""
+        item = self.get(timeout)
+        if item is None:
+            return False
+        client, entry = item
+        topic, payload, retain, qos = entry
+        try:
+            info = client.publish(topic=topic, payload=payload, retain=retain, qos=qos)
+            if info.rc == MQTT_ERR_NO_CONN:
+                if not qos:
+                    self._requeue(entry)
+                time.sleep(RETRY_DELAY)
+            elif info.rc != MQTT_ERR_SUCCESS:
+                raise RuntimeError(error_string(info.rc))
+            else:
+                info.wait_for_publish(timeout=ACK_TIMEOUT)
+                if not info.is_published():
+                    logger.warning(
+                        "Message to %s not published within %ss", topic, ACK_TIMEOUT
+                    )
+        except Exception as e:
+            with self.condition:
+                self.failed += 1
+            logger.error("Failed to publish message to %s: %s", topic, e)
+        return True
+
+    def _run(self):
+        while True:
+            self.publish_next()
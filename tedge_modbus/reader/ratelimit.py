@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Rate limiting of the published telemetry"""
+import threading
+import time
+
+from .publisher import PRIORITY_MEASUREMENT, merge_measurements, message_priority
+
+
+class TokenBucket:
+    """Token bucket refilled at a rate per second, holding at most one second of tokens
+
+    A message may be sent while the bucket is not empty and takes its
+    tokens even if there are not enough, the debt is paid off by the
+    refill. So a single message larger than the rate is still sent.
+    """
+
+    def __init__(self, rate, now):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = now
+
+    def refill(self, now):
+        """Add the tokens since the last refill"""
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount):
+        """Take tokens, the bucket may go into debt"""
+        self.tokens -= amount
+
+
+def buckets(config, now):
+    """Create the message and byte buckets of maxmessagerate and maxbyterate"""
+    return [
+        (TokenBucket(config[key], now), unit)
+        for key, unit in (("maxmessagerate", "messages"), ("maxbyterate", "bytes"))
+        if config.get(key)
+    ]
+
+
+class RateLimiter:
+    """Token buckets of messages/s and bytes/s for all devices and per device
+
+    Measurements over a limit are held back per topic: further measurements
+    of the topic are merged into the held one (the newest values win) until
+    the buckets allow to publish it, so the measurements of a noisy device
+    are downsampled. Other messages are never held back but take their
+    tokens, except alarms which are exempt.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buckets = []
+        self.device_buckets = {}
+        # held back measurements by topic: (device, payload)
+        self.held = {}
+        # number of held back measurements merged or replaced by device
+        self.shed = {}
+
+    def configure(self, config):
+        """Set the limits for all devices"""
+        with self.lock:
+            self.buckets = buckets(config, self.clock())
+
+    def set_device(self, name, device):
+        """Set the limits of a device"""
+        with self.lock:
+            self.device_buckets[name] = buckets(device, self.clock())
+
+    def remove_device(self, name):
+        """Forget the limits and held back measurements of a device"""
+        with self.lock:
+            self.device_buckets.pop(name, None)
+            for topic, (device, _) in list(self.held.items()):
+                if device == name:
+                    del self.held[topic]
+
+    def _buckets_of(self, device, now):
+        limits = self.buckets + self.device_buckets.get(device, [])
+        for bucket, _ in limits:
+            bucket.refill(now)
+        return limits
+
+    @staticmethod
+    def _take(limits, payload):
+        for bucket, unit in limits:
+            bucket.take(len(payload.encode("utf-8")) if unit == "bytes" else 1)
+
+    def admit(self, topic, payload):
+        """Get the payload to publish now, None if the measurement is held back"""
+        parts = topic.split("/")
+        if len(parts) > 5 and parts[5] == "a":
+            return payload
+        device = parts[2] if len(parts) > 2 else ""
+        with self.lock:
+            limits = self._buckets_of(device, self.clock())
+            if not limits and topic not in self.held:
+                return payload
+            if message_priority(topic) != PRIORITY_MEASUREMENT:
+                self._take(limits, payload)
+                return payload
+            held = self.held.pop(topic, None)
+            if held is not None:
+                # the held measurement is merged into the new one or replaced by it
+                payload = merge_measurements(held[1], payload) or payload
+                self.shed[device] = self.shed.get(device, 0) + 1
+            if all(bucket.tokens > 0 for bucket, _ in limits):
+                self._take(limits, payload)
+                return payload
+            self.held[topic] = (device, payload)
+            return None
+
+    def release(self):
+        """Get the held back measurements (topic, payload) which may be published now"""
+        released = []
+        with self.lock:
+            if not self.held:
+                return released
+            now = self.clock()
+            for topic, (device, payload) in list(self.held.items()):
+                limits = self._buckets_of(device, now)
+                if all(bucket.tokens > 0 for bucket, _ in limits):
+                    self._take(limits, payload)
+                    del self.held[topic]
+                    released.append((topic, payload))
+        return released
+
+    def take_stats(self):
+        """Get the number of measurements merged or replaced per device since the last call"""
+        with self.lock:
+            shed, self.shed = self.shed, {}
+        return shed
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """Modbus reader"""
+# pylint: disable=too-many-lines
 import argparse
+import functools
 import json
 import logging
 import os.path
@@ -8,25 +10,93 @@ import sched
 import sys
 import threading
 import time
+from contextlib import contextmanager
+from pathlib import Path
 
-import tomli
 from paho.mqtt import client as mqtt_client
 from pymodbus.client import ModbusTcpClient, ModbusSerialClient
 from pymodbus.exceptions import ConnectionException
-from watchdog.events import FileSystemEventHandler, DirModifiedEvent, FileModifiedEvent
+from pymodbus.pdu import ModbusExceptions
+from watchdog.events import (
+    FileSystemEventHandler,
+    DirModifiedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+)
 from watchdog.observers import Observer
 
 from .banner import BANNER
+from .commands import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, CommandWorkers
+from .compiled_config import (
+    CompiledConfig,
+    load_compiled,
+    source_hash,
+    store_compiled,
+)
+from .connections import ConnectionPool, bus_key
+from .device_files import (
+    device_file_versions,
+    is_device_file,
+    read_device_file,
+    unique_devices,
+)
+from .holes import DEFAULT_HOLE_TTL, AddressHoles, device_key
 from .mapper import MappedMessage, ModbusMapper
-from ..operations import set_coil, set_register
+from .pipeline import PipelinedReader
+from .publisher import DEFAULT_PUBLISH_QUEUE_SIZE, PublishQueue
+from .poll_plan import REGISTER_TYPES, PollPlan, build_decode_plan, split_set
+from .ratelimit import RateLimiter
+from .register_cache import RegisterCache
+from .shards import ShardSupervisor, assign_shards
+from ..operations import (
+    OPERATIONS,
+    WRITE_OPERATIONS,
+    load_operation,
+    load_write_operation,
+)
+from ..operations.common import (
+    backfill_serial_defaults,
+    extract_device_from_topic,
+    find_target_device,
+)
+from ..operations.config_store import CONFIG_CHANGED_TOPIC
+from ..operations.context import (
+    Context,
+    file_version,
+    invalidate_config,
+    load_config,
+)
+from ..operations.device_index import DeviceIndex
 
 
 DEFAULT_FILE_DIR = "/etc/tedge/plugins/modbus"
 BASE_CONFIG_NAME = "modbus.toml"
 DEVICES_CONFIG_NAME = "devices.toml"
+# seconds between two reports of the publish queue and the request latency of TCP gateways
+DEFAULT_STATS_INTERVAL = 60
+# timeout (in seconds) and retries of Modbus requests, the defaults of pymodbus
+DEFAULT_TIMEOUT = 3
+DEFAULT_RETRIES = 3
+# settings of a serial port, shared by all RTU devices on the port
+SERIAL_SETTINGS = ("baudrate", "stopbits", "parity", "databits")
+# client function, response attribute and description per register type
+READ_REQUESTS = {
+    "hr": ("read_holding_registers", "registers", "holding register"),
+    "ir": ("read_input_registers", "registers", "input registers"),
+    "co": ("read_coils", "bits", "coils"),
+    "di": ("read_discrete_inputs", "bits", "discrete input"),
+}
 
 
-class ModbusPoll:
+def step_was_read(step, results):
+    """Check if all values decoded by a step of a decode plan were read"""
+    buffer = results[step.register_type]
+    return all(
+        address in buffer for address in range(step.address, step.address + step.count)
+    )
+
+
+class ModbusPoll:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """Modbus Poller"""
 
     class ConfigFileChangedHandler(FileSystemEventHandler):
@@ -42,19 +112,66 @@ class ModbusPoll:
             if isinstance(event, DirModifiedEvent):
                 return
             if isinstance(event, FileModifiedEvent) and event.event_type == "modified":
-                filename = os.path.basename(event.src_path)
-                if filename in [BASE_CONFIG_NAME, DEVICES_CONFIG_NAME]:
-                    self.poller.reread_config()
+                self._changed(event.src_path)
+
+        def on_created(self, event):
+            """handler called when a file is created"""
+            if not event.is_directory:
+                self._changed(event.src_path)
+
+        def on_deleted(self, event):
+            """handler called when a file is deleted"""
+            if not event.is_directory:
+                self._changed(event.src_path)
+
+        def on_moved(self, event):
+            """handler called when a file is moved, e.g. replaced atomically"""
+            if isinstance(event, FileMovedEvent):
+                if is_device_file(event.src_path):
+                    self.poller.reload_device_file(event.src_path)
+                self._changed(event.dest_path)
+
+        def _changed(self, path):
+            filename = os.path.basename(path)
+            if filename in [BASE_CONFIG_NAME, DEVICES_CONFIG_NAME]:
+                self.poller.reload_config(path)
+            elif is_device_file(path):
+                self.poller.reload_device_file(path)
 
     logger: logging.Logger
     tedge_client: mqtt_client.Client = None
-    poll_scheduler = sched.scheduler(time.time, time.sleep)
+    poll_scheduler = sched.scheduler(time.monotonic, time.sleep)
     base_config = {}
     devices = []
+    _device_index = None
     config_dir = "."
+    poll_rate_warnings = {}
 
-    def __init__(self, config_dir=".", logfile=None):
+    def __init__(self, config_dir=".", logfile=None, shard=None):
         self.config_dir = config_dir
+        # (index, count) of the shard of the devices polled by this process
+        self.shard = shard
+        self.shard_of = {}
+        self.poll_rate_warnings = {}
+        self.address_holes = AddressHoles()
+        self.connections = ConnectionPool()
+        # maximum number of requests outstanding on a TCP bus, by bus key
+        self.bus_depths = {}
+        # errors of RTU devices whose serial settings differ from the ones of their port
+        self.bus_conflicts = {}
+        self.register_cache = RegisterCache()
+        self.write_capabilities = {}
+        self.mappers = {}
+        self.operation_context = None
+        self.config_lock = threading.Lock()
+        self.loaded_versions = None
+        # versions and device names of the files of the devices directory
+        self.device_files = {}
+        self.poll_plans = {}
+        self.compiled_plans = {}
+        self.commands = CommandWorkers(report=self._report_command_stats)
+        self.publisher = PublishQueue()
+        self.rate_limiter = RateLimiter()
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
         if logfile is not None:
@@ -67,9 +184,43 @@ class ModbusPoll:
             self.logger.addHandler(fh)
         self.print_banner()
 
+    @property
+    def device_index(self):
+        """Index of the device definitions, rebuilt when the definitions are replaced"""
+        if self._device_index is None or self._device_index.devices is not self.devices:
+            self._device_index = DeviceIndex(self.devices)
+        return self._device_index
+
+    def config_versions(self):
+        """Get the versions of the configuration files, None if a file is missing"""
+        versions = {}
+        for name in (BASE_CONFIG_NAME, DEVICES_CONFIG_NAME):
+            try:
+                versions[name] = file_version(f"{self.config_dir}/{name}")
+            except OSError:
+                versions[name] = None
+        return versions
+
+    def reload_config(self, path=None):
+        """Reread the configuration if a configuration file changed
+
+        Called by the file watcher and by change notifications of the config
+        store. Several events of the same change cause a single reload, as the
+        configuration is only reread if the version of a file changed since
+        it was read last.
+        """
+        with self.config_lock:
+            if path is not None:
+                invalidate_config(path)
+            if self.config_versions() == self.loaded_versions:
+                self.logger.debug("configuration files unchanged, skipping reload")
+                return
+            self.reread_config()
+
     def reread_config(self):
         """Reread the configuration"""
         self.logger.info("file change detected, reading files")
+        self.loaded_versions = self.config_versions()
         new_base_config = self.read_base_definition(
             f"{self.config_dir}/{BASE_CONFIG_NAME}"
         )
@@ -77,45 +228,197 @@ class ModbusPoll:
         if len(new_base_config) > 1 and new_base_config != self.base_config:
             restart_required = True
             self.base_config = new_base_config
+            self.address_holes.open(self.base_config["modbus"].get("layoutcache"))
+            self.address_holes.ttl = self.base_config["modbus"].get(
+                "holettl", DEFAULT_HOLE_TTL
+            )
+            self.commands.configure(
+                self.base_config["modbus"].get("commandworkers") or DEFAULT_WORKERS,
+                self.base_config["modbus"].get("commandqueuesize")
+                or DEFAULT_QUEUE_SIZE,
+            )
+            self.publisher.configure(
+                self.base_config["modbus"].get("publishqueuesize")
+                or DEFAULT_PUBLISH_QUEUE_SIZE
+            )
         loglevel = self.base_config["modbus"]["loglevel"] or "INFO"
         self.logger.setLevel(getattr(logging, loglevel.upper(), logging.INFO))
-        new_devices = self.read_device_definition(
-            f"{self.config_dir}/{DEVICES_CONFIG_NAME}"
-        )
-        # Add Serial Config into Device Config
-        for device in new_devices["device"]:
-            if device["protocol"] == "RTU":
-                for key in self.base_config["serial"]:
-                    if device.get(key, None) is None:
-                        device[key] = self.base_config["serial"][key]
-        if (
-            len(new_devices) >= 1
-            and new_devices.get("device")
-            and new_devices.get("device") is not None
-            and new_devices.get("device") != self.devices
-        ):
+        versions = device_file_versions(self.config_dir)
+        compiled = self._load_devices(versions)
+        self.device_files = {
+            path: (versions[path], names)
+            for path, names in compiled.device_files.items()
+        }
+        devices = self._own_devices(compiled.devices)
+        # a shard may be left without devices, it must stop polling its old ones
+        if (devices or self.shard is not None) and devices != self.devices:
             restart_required = True
-            self.devices = new_devices["device"]
+            self.devices = devices
+        # the compiled poll plans are used if polling is restarted
+        self.compiled_plans = compiled.plans if restart_required else {}
         if restart_required:
             self.logger.info("config change detected, restart polling")
             if self.tedge_client is not None and self.tedge_client.is_connected():
                 self.tedge_client.disconnect()
             self.tedge_client = self.connect_to_tedge()
+            self.publisher.set_client(self.tedge_client)
             # If connected to tedge, register service, update config
             time.sleep(5)
             self.register_child_devices(self.devices)
-            self.register_service()
-            self.update_base_config_on_device(self.base_config)
+            if self.primary:
+                self.register_service()
+                self.update_base_config_on_device(self.base_config)
             self.update_modbus_info_on_child_devices(self.devices)
             for evt in self.poll_scheduler.queue:
                 self.poll_scheduler.cancel(evt)
+            self.connections.close_all()
             self.poll_data()
 
+    @property
+    def primary(self):
+        """Check if this process handles the main device, i.e. is not a secondary shard"""
+        return self.shard is None or self.shard[0] == 0
+
+    def _own_devices(self, devices):
+        """Get the devices of the shard of this process, all devices if not sharded"""
+        if self.shard is None:
+            return devices
+        index, count = self.shard
+        self.shard_of = assign_shards(devices, count)
+        return [device for device in devices if self.shard_of[device["name"]] == index]
+
+    def _owns_topic(self, topic):
+        """Check if a command topic is handled by the shard of this process
+
+        Commands of devices which are not configured and of the main device
+        are handled by the first shard.
+        """
+        if self.shard is None:
+            return True
+        name = topic.split("/")[2] if topic.startswith("te/device/") else "main"
+        return self.shard_of.get(name, 0) == self.shard[0]
+
+    def _load_devices(self, versions):
+        """Get the compiled devices of devices.toml and the devices directory
+
+        If compiledcache is configured, the compiled devices are stored in it
+        and loaded from it as long as the configuration files are unchanged.
+        """
+        cache_path = self.base_config["modbus"].get("compiledcache")
+        if not cache_path:
+            return self._compile_devices(versions)
+        digest = source_hash(
+            [
+                f"{self.config_dir}/{BASE_CONFIG_NAME}",
+                f"{self.config_dir}/{DEVICES_CONFIG_NAME}",
+                *versions,
+            ]
+        )
+        compiled = load_compiled(cache_path, digest)
+        if compiled is not None:
+            self.logger.info("Loaded compiled configuration from %s", cache_path)
+            return compiled
+        compiled = self._compile_devices(versions)
+        compiled.source_hash = digest
+        store_compiled(cache_path, compiled)
+        return compiled
+
+    def _compile_devices(self, versions):
+        """Read the devices and build their poll plans
+
+        The poll plans are built without address holes, the holes of the
+        devices are attached when polling starts.
+        """
+        new_devices = self.read_device_definition(
+            f"{self.config_dir}/{DEVICES_CONFIG_NAME}"
+        )
+        compiled = CompiledConfig(
+            unique_devices([], new_devices.get("device") or [], DEVICES_CONFIG_NAME)
+        )
+        for path in versions:
+            file_devices = unique_devices(
+                compiled.devices, read_device_file(path), path
+            )
+            compiled.device_files[path] = [d["name"] for d in file_devices]
+            compiled.devices.extend(file_devices)
+        self._apply_serial_defaults(compiled.devices)
+        for device in compiled.devices:
+            try:
+                poll_plan = self._build_poll_plan(device, holes={})
+            except ValueError:
+                # reported when polling the device starts
+                continue
+            # plan the first poll, where all groups are due
+            poll_plan.view(tuple(sorted(poll_plan.groups)))
+            compiled.plans[device["name"]] = poll_plan
+        return compiled
+
+    def _apply_serial_defaults(self, devices):
+        """Add Serial Config into Device Config"""
+        for device in devices:
+            if device["protocol"] == "RTU":
+                for key in self.base_config["serial"]:
+                    if device.get(key, None) is None:
+                        device[key] = self.base_config["serial"][key]
+
+    def reload_device_file(self, path):
+        """Reload a single file of the devices directory
+
+        Only the devices of the file are parsed again, and only the devices
+        which were added, changed or removed are rescheduled. The other
+        devices keep polling without interruption.
+        """
+        with self.config_lock:
+            try:
+                version = file_version(path)
+            except OSError:
+                version = None
+            old_version, old_names = self.device_files.get(path, (None, []))
+            if version == old_version:
+                return
+            if self.shard is not None:
+                # the devices of the file may move to another shard
+                self.reread_config()
+                return
+            if self.tedge_client is None:
+                # not polling yet, start with the complete configuration
+                self.reread_config()
+                return
+            invalidate_config(path)
+            old = {d["name"]: d for d in self.devices if d["name"] in old_names}
+            others = [d for d in self.devices if d["name"] not in old]
+            new = unique_devices(
+                others, read_device_file(path) if version else [], path
+            )
+            self._apply_serial_defaults(new)
+            if version is None:
+                self.device_files.pop(path, None)
+            else:
+                self.device_files[path] = (version, [d["name"] for d in new])
+            changed = [device for device in new if old.get(device["name"]) != device]
+            for name, device in old.items():
+                if device not in new:
+                    self.logger.info("Stop polling device %s of %s", name, path)
+                    self._stop_polling_device(name)
+            self.devices = others + new
+            self._plan_buses()
+            if changed:
+                self.logger.info(
+                    "Start polling device(s) %s of %s",
+                    ", ".join(device["name"] for device in changed),
+                    path,
+                )
+                self.register_child_devices(changed)
+                self.update_modbus_info_on_child_devices(changed)
+                for device in changed:
+                    self._start_polling_device(device)
+
     def watch_config_files(self, config_dir):
         """Start watching configuration files for changes"""
         event_handler = self.ConfigFileChangedHandler(self)
         observer = Observer()
-        observer.schedule(event_handler, config_dir)
+        # recursive to include the devices directory, even if created later
+        observer.schedule(event_handler, config_dir, recursive=True)
         observer.start()
         try:
             while True:
@@ -140,160 +443,353 @@ class ModbusPoll:
 
     def poll_data(self):
         """Poll Modbus data"""
+        for poll_plan in self.poll_plans.values():
+            poll_plan.stopped = True
+        self.poll_plans = {}
+        self.mappers = {}
+        self.rate_limiter.configure(self.base_config["modbus"])
+        self._plan_buses()
         for device in self.devices:
-            mapper = ModbusMapper(device)
-            poll_model = self._build_query_model(device)
-            self.poll_device(device, poll_model, mapper)
-
-    def _split_set(self, s):
-        partitions = []
-        v = list(s)
-        v.sort()
-        cur = []
-        i = 0
-        while i < len(v):
-            cur.append(v[i])
-            if i == len(v) - 1 or v[i + 1] > v[i] + 1:
-                partitions.append(cur)
-                cur = []
-            i = i + 1
-        return partitions
-
-    def _build_query_model(self, device):
-        holding_registers = set()
-        input_register = set()
-        coils = set()
-        discrete_input = set()
-        if device.get("registers") is not None:
-            for register_definition in device["registers"]:
-                register_number = register_definition["number"]
-                num_registers = int(
-                    (
-                        register_definition["startbit"]
-                        + register_definition["nobits"]
-                        - 1
+            self._start_polling_device(device)
+        self.compiled_plans = {}
+        stats_interval = self.base_config["modbus"].get(
+            "statsinterval", DEFAULT_STATS_INTERVAL
+        )
+        if stats_interval:
+            self.poll_scheduler.enter(
+                stats_interval, 2, self._report_stats, (stats_interval,)
+            )
+
+    def _report_stats(self, interval):
+        """Publish the stats of the publish queue and the request latency per unit id
+        of the buses shared by several devices"""
+        publish_stats = self.publisher.take_stats()
+        shed = self.rate_limiter.take_stats()
+        self.logger.debug("Publish queue: %s, rate limited: %s", publish_stats, shed)
+        if self.tedge_client is not None:
+            self.send_tedge_message(
+                MappedMessage(
+                    json.dumps({"publish": publish_stats}),
+                    "te/device/main/service/tedge-modbus-plugin/m/publish",
+                )
+            )
+            if shed:
+                self.send_tedge_message(
+                    MappedMessage(
+                        json.dumps({"ratelimited": shed}),
+                        "te/device/main/service/tedge-modbus-plugin/m/ratelimit",
                     )
-                    / 16
                 )
-                register_end = register_number + num_registers
-                registers = list(range(register_number, register_end + 1))
-                if register_definition.get("input") is True:
-                    input_register.update(registers)
-                else:
-                    holding_registers.update(registers)
-        if device.get("coils") is not None:
-            for coil_definition in device["coils"]:
-                coil_number = coil_definition["number"]
-                if coil_definition.get("input") is True:
-                    discrete_input.add(coil_number)
-                else:
-                    coils.add(coil_number)
+        for key, (units, queued) in self.connections.take_stats().items():
+            if key[0] != "TCP" or len(units) < 2:
+                continue
+            data = {
+                f"unit{unit}": dict(stats, queued=queued)
+                for unit, stats in units.items()
+            }
+            self.logger.debug("Gateway %s:%s: %s", key[1], key[2], data)
+            if self.tedge_client is not None:
+                self.send_tedge_message(
+                    MappedMessage(
+                        json.dumps(data),
+                        "te/device/main/service/tedge-modbus-plugin/m/"
+                        f"gateway_{key[1]}_{key[2]}",
+                    )
+                )
+        self.poll_scheduler.enter(interval, 2, self._report_stats, (interval,))
 
-        return (
-            self._split_set(holding_registers),
-            self._split_set(input_register),
-            self._split_set(coils),
-            self._split_set(discrete_input),
+    def _start_polling_device(self, device):
+        """Poll a device and schedule its next polls"""
+        if device["name"] in self.bus_conflicts:
+            self.logger.error(
+                "Invalid configuration of device %s: %s",
+                device["name"],
+                self.bus_conflicts[device["name"]],
+            )
+            return
+        self.address_holes.check_definition(device)
+        mapper = ModbusMapper(device)
+        self.mappers[device["name"]] = mapper
+        self.rate_limiter.set_device(device["name"], device)
+        poll_plan = self.compiled_plans.pop(device["name"], None)
+        if poll_plan is not None and poll_plan.device == device:
+            poll_plan.holes = self.address_holes.for_device(device)
+        else:
+            try:
+                poll_plan = self._build_poll_plan(device)
+            except ValueError as e:
+                self.logger.error(
+                    "Invalid configuration of device %s: %s", device["name"], e
+                )
+                return
+        self.poll_plans[device["name"]] = poll_plan
+        self.poll_device(device, poll_plan, mapper)
+
+    def _stop_polling_device(self, name):
+        """Stop polling a device, the other devices are not affected"""
+        self.mappers.pop(name, None)
+        self.rate_limiter.remove_device(name)
+        poll_plan = self.poll_plans.pop(name, None)
+        if poll_plan is None:
+            return
+        poll_plan.stopped = True
+        for event in self.poll_scheduler.queue:
+            if event.argument[1:2] == (poll_plan,):
+                try:
+                    self.poll_scheduler.cancel(event)
+                except ValueError:
+                    # the poll started in the meantime, it stops by itself
+                    pass
+
+    def _build_poll_plan(self, device, holes=None):
+        interval = device.get(
+            "pollinterval", self.base_config["modbus"]["pollinterval"]
+        )
+        pollgroups = {
+            **self.base_config["modbus"].get("pollgroups", {}),
+            **device.get("pollgroups", {}),
+        }
+        return PollPlan(
+            device,
+            interval,
+            pollgroups,
+            self.address_holes.for_device(device) if holes is None else holes,
         )
 
     def read_register(self, buf, address=0, count=1):
         """Read Modbus register"""
         return [buf[i] for i in range(address, address + count)]
 
-    def poll_device(self, device, poll_model, mapper):
-        """Poll a Modbus device"""
-        # TODO: Can this be simplified / split to smaller portions?
-        # pylint: disable=too-many-branches,too-many-locals
+    def poll_device(self, device, poll_plan, mapper):
+        """Poll all due poll groups of a Modbus device"""
+        # pylint: disable=too-many-locals
+        if poll_plan.stopped:
+            return
         self.logger.debug("Polling device %s", device["name"])
+        if self.address_holes.expire(device):
+            self.logger.info(
+                "Probing unsupported addresses of %s again", device["name"]
+            )
+        started = time.monotonic()
+        intervals = poll_plan.due(started)
+        view, poll_model, decode_plan = poll_plan.view(intervals)
         (
             coil_results,
             di_result,
             hr_results,
             ir_result,
             error,
-        ) = self.get_data_from_device(device, poll_model)
-        device_combine_measurements = device.get(
-            "combinemeasurements",
-            self.base_config["modbus"].get("combinemeasurements", False),
-        )
-        combined_measuerement = None
+            timestamps,
+        ) = self.get_data_from_device(view, poll_model, poll_plan, intervals)
         if error is None:
-            # handle all Registers
-            if device.get("registers") is not None:
-                for register_definition in device["registers"]:
-                    try:
-                        register_number = register_definition["number"]
-                        num_registers = (
-                            int(
-                                (
-                                    register_definition["startbit"]
-                                    + register_definition["nobits"]
-                                    - 1
-                                )
-                                / 16
-                            )
-                            + 1
-                        )
-                        if register_definition.get("input"):
-                            result = self.read_register(
-                                ir_result, address=register_number, count=num_registers
-                            )
-                        else:
-                            result = self.read_register(
-                                hr_results, address=register_number, count=num_registers
-                            )
-                        msgs, temp = mapper.map_register(
-                            result, register_definition, device_combine_measurements
-                        )
-                        if combined_measuerement is not None and temp is not None:
-                            combined_measuerement.extend_data(temp)
-                        elif temp is not None:
-                            combined_measuerement = temp
-                        for msg in msgs:
-                            self.send_tedge_message(msg)
-                    except Exception as e:
-                        self.logger.error("Failed to map register: %s", e)
-
-            # send combined measurement if any
-            try:
-                if combined_measuerement is not None:
-                    self.send_tedge_message(combined_measuerement)
-            except Exception as e:
-                self.logger.error("Failed to send combined measurement: %s", e)
-
-            # all Coils
-            if device.get("coils") is not None:
-                for coil_def in device["coils"]:
-                    try:
-                        coil_number = coil_def["number"]
-                        if coil_def.get("input") is True:
-                            result = self.read_register(
-                                di_result, address=coil_number, count=1
-                            )
-                        else:
-                            result = self.read_register(
-                                coil_results, address=coil_number, count=1
-                            )
-                        msgs = mapper.map_coil(result, coil_def)
-                        for msg in msgs:
-                            self.send_tedge_message(msg)
-                    except Exception as e:
-                        self.logger.error("Failed to map coils: %s", e)
+            results = {
+                "hr": hr_results,
+                "ir": ir_result,
+                "co": coil_results,
+                "di": di_result,
+            }
+            if poll_plan.deferred:
+                # publish the partial results, without the deferred blocks
+                decode_plan = {
+                    kind: [step for step in steps if step_was_read(step, results)]
+                    for kind, steps in decode_plan.items()
+                }
+            self.register_cache.update(device, hr_results)
+            with mapper.lock:
+                unchanged = mapper.unchanged_blocks(poll_model, results)
+                self._map_registers(
+                    view,
+                    decode_plan["registers"],
+                    mapper,
+                    results,
+                    unchanged,
+                    timestamps,
+                )
+                self._map_coils(
+                    decode_plan["coils"], mapper, results, unchanged, timestamps
+                )
         else:
             self.logger.error("Failed to poll device %s: %s", device["name"], error)
 
-        interval = device.get(
-            "pollinterval", self.base_config["modbus"]["pollinterval"]
-        )
+        for topic, payload in self.rate_limiter.release():
+            self.publisher.put(topic, payload)
+
+        delay = poll_plan.advance(intervals, started, time.monotonic())
+        self._check_poll_rate(device, poll_plan, started)
         self.poll_scheduler.enter(
-            interval,
+            delay,
             1,
             self.poll_device,
-            (device, poll_model, mapper),
+            (device, poll_plan, mapper),
         )
 
+    def _check_poll_rate(self, device, poll_plan, now):
+        """Warn (at most once per minute and device) about groups which are
+        polled slower than requested"""
+        last_warning = self.poll_rate_warnings.get(device["name"])
+        if last_warning is not None and now - last_warning < 60:
+            return
+        for interval, achieved in poll_plan.lagging():
+            self.poll_rate_warnings[device["name"]] = now
+            self.logger.warning(
+                "Device %s is polled every %.3fs instead of every %.3fs (%d overruns)",
+                device["name"],
+                achieved,
+                interval,
+                poll_plan.overruns[interval],
+            )
+
+    def _map_registers(
+        self, device, decode_plan, mapper, results, unchanged, timestamps
+    ):  # pylint: disable=too-many-arguments,too-many-locals
+        """Map the polled registers of a device and send the resulting messages
+
+        Registers which are only read from blocks that did not change since the
+        previous poll are not decoded again, their last output is replayed instead.
+        """
+        device_combine_measurements = device.get(
+            "combinemeasurements",
+            self.base_config["modbus"].get("combinemeasurements", False),
+        )
+        combined_measuerement = None
+        for step in decode_plan:
+            try:
+                block = (step.register_type, step.block)
+                timestamp = timestamps.get(block)
+                output = None
+                if block in unchanged:
+                    output = mapper.replay_register(
+                        step.definition, device_combine_measurements, timestamp
+                    )
+                if output is None:
+                    result = self.read_register(
+                        results[step.register_type],
+                        address=step.address,
+                        count=step.count,
+                    )
+                    output = mapper.map_register(
+                        result,
+                        step.definition,
+                        device_combine_measurements,
+                        timestamp,
+                    )
+                msgs, temp = output
+                if combined_measuerement is not None and temp is not None:
+                    combined_measuerement.extend_data(temp)
+                elif temp is not None:
+                    combined_measuerement = temp
+                for msg in msgs:
+                    self.send_tedge_message(msg)
+            except Exception as e:
+                self.logger.error("Failed to map register: %s", e)
+
+        # send combined measurement if any
+        try:
+            if combined_measuerement is not None:
+                self.send_tedge_message(combined_measuerement)
+        except Exception as e:
+            self.logger.error("Failed to send combined measurement: %s", e)
+
+    def _map_coils(
+        self, decode_plan, mapper, results, unchanged, timestamps
+    ):  # pylint: disable=too-many-arguments
+        """Map the polled coils and discrete inputs of a device and send the resulting messages
+
+        Alarms and events are only raised on a change, so coils from unchanged
+        blocks are skipped entirely.
+        """
+        for step in decode_plan:
+            try:
+                if (
+                    (step.register_type, step.block) in unchanged
+                    and step.address in mapper.data[step.register_type]
+                    and (step.register_type, step.address) not in mapper.pending
+                ):
+                    continue
+                result = self.read_register(
+                    results[step.register_type], address=step.address, count=1
+                )
+                msgs = mapper.map_coil(
+                    result,
+                    step.definition,
+                    timestamps.get((step.register_type, step.block)),
+                )
+                for msg in msgs:
+                    self.send_tedge_message(msg)
+            except Exception as e:
+                self.logger.error("Failed to map coils: %s", e)
+
+    def _device_setting(self, device, key, default=None):
+        """Get a setting of a device
+
+        A setting which is not set for the device defaults to the setting of
+        its bus (the serial section of modbus.toml for RTU devices) and then
+        to the setting of all devices (the modbus section).
+        """
+        if key in device:
+            return device[key]
+        if device["protocol"] == "RTU" and key in self.base_config.get("serial", {}):
+            return self.base_config["serial"][key]
+        return self.base_config["modbus"].get(key, default)
+
+    def _plan_buses(self):
+        """Work out the maximum number of outstanding requests of every TCP bus
+        and check the serial settings of every serial port
+
+        The limit (inflight) is shared by all devices behind a gateway, the
+        smallest value set for one of them (or in modbus.toml) applies.
+        All devices on a serial port share one client, so they must use the
+        same serial settings. Devices which differ from the first device of
+        their port are not polled.
+        """
+        depths = {}
+        ports = {}
+        conflicts = {}
+        for device in self.devices:
+            depth = self._device_setting(device, "inflight")
+            if device["protocol"] == "TCP" and depth:
+                key = bus_key(device)
+                depths[key] = min(depths.get(key, depth), depth)
+            if device["protocol"] == "RTU":
+                settings = {key: device.get(key) for key in SERIAL_SETTINGS}
+                first, first_settings = ports.setdefault(
+                    device["port"], (device["name"], settings)
+                )
+                if settings != first_settings:
+                    conflicts[device["name"]] = (
+                        f"serial settings {settings} differ from {first_settings} "
+                        f"of device {first} on port {device['port']}"
+                    )
+        self.bus_depths = depths
+        self.bus_conflicts = conflicts
+
+    @contextmanager
+    def _session(self, device):
+        """Use the pooled connection of the bus of a device, in turns with its other units
+
+        The client uses the timeout and retries of the device during the session.
+        """
+        if device["name"] in self.bus_conflicts:
+            raise ValueError(self.bus_conflicts[device["name"]])
+        with self.connections.session(
+            bus_key(device),
+            lambda: self.get_modbus_client(device),
+            unit=device.get("address"),
+        ) as client:
+            params = getattr(client, "params", None)
+            if params is not None:
+                params.timeout = self._device_setting(
+                    device, "timeout", DEFAULT_TIMEOUT
+                )
+                params.retries = self._device_setting(
+                    device, "retries", DEFAULT_RETRIES
+                )
+            yield client
+
     def get_modbus_client(self, device):
         """Get Modbus client"""
+        timeout = self._device_setting(device, "timeout", DEFAULT_TIMEOUT)
+        retries = self._device_setting(device, "retries", DEFAULT_RETRIES)
         if device["protocol"] == "RTU":
             return ModbusSerialClient(
                 port=device["port"],
@@ -301,97 +797,178 @@ class ModbusPoll:
                 stopbits=device["stopbits"],
                 parity=device["parity"],
                 bytesize=device["databits"],
+                timeout=timeout,
+                retries=retries,
             )
         if device["protocol"] == "TCP":
+            # the client stays connected, it is shared by all units of the gateway
             return ModbusTcpClient(
-                host=device["ip"],
-                port=device["port"],
-                # TODO: Check if these parameters really supported by ModbusTcpClient?
-                auto_open=True,
-                auto_close=True,
-                debug=True,
+                host=device["ip"], port=device["port"], timeout=timeout, retries=retries
             )
         raise ValueError(
             "Expected protocol to be RTU or TCP. Got " + device["protocol"] + "."
         )
 
-    def get_data_from_device(self, device, poll_model):
-        """Get Modbus information from the device"""
-        # pylint: disable=too-many-locals
-        client = self.get_modbus_client(device)
-        holding_register, input_registers, coils, discrete_input = poll_model
-        hr_results = {}
-        ir_result = {}
-        coil_results = {}
-        di_result = {}
+    def get_data_from_device(self, device, poll_model, poll_plan=None, intervals=()):
+        """Get Modbus information from the device
+
+        Besides the values of all register types, the unix time at which each
+        read block was acquired is returned, keyed by register type and block start.
+
+        If the device has a cycle budget (cyclebudget, in seconds) and it is
+        used up, the remaining blocks are deferred: the poll plan starts the
+        next poll of the same groups with them (round-robin), so every block
+        is read eventually. The blocks read so far are returned. Pipelined
+        reads are sent in batches of the pipeline depth then, and the budget
+        is checked before every batch.
+        """
+        # pylint: disable=too-many-arguments,too-many-locals
+        results = {register_type: {} for register_type in REGISTER_TYPES}
+        timestamps = {}
         error = None
+        budget = self._device_setting(device, "cyclebudget")
+        deadline = time.monotonic() + budget if budget else None
+        blocks = [
+            (register_type, block[0], len(block))
+            for register_type, type_blocks in zip(REGISTER_TYPES, poll_model)
+            for block in type_blocks
+        ]
+        if poll_plan is not None:
+            blocks = poll_plan.rotate(intervals, blocks)
+        read = 0
         try:
-            for hr_range in holding_register:
-                result = client.read_holding_registers(
-                    address=hr_range[0],
-                    count=hr_range[-1] - hr_range[0] + 1,
-                    slave=device["address"],
-                )
-                if result.isError():
-                    self.logger.error("Failed to read holding register: %s", result)
-                    continue
-                hr_results.update(dict(zip(hr_range, result.registers)))
-            for ir_range in input_registers:
-                result = client.read_input_registers(
-                    address=ir_range[0],
-                    count=ir_range[-1] - ir_range[0] + 1,
-                    slave=device["address"],
-                )
-                if result.isError():
-                    self.logger.error("Failed to read input registers: %s", result)
-                    continue
-                ir_result.update(dict(zip(ir_range, result.registers)))
-            for coil_range in coils:
-                result = client.read_coils(
-                    address=coil_range[0],
-                    count=coil_range[-1] - coil_range[0] + 1,
-                    slave=device["address"],
-                )
-                if result.isError():
-                    self.logger.error("Failed to read coils: %s", result)
-                    continue
-                coil_results.update(dict(zip(coil_range, result.bits)))
-            for di_range in discrete_input:
-                result = client.read_discrete_inputs(
-                    address=di_range[0],
-                    count=di_range[-1] - di_range[0] + 1,
-                    slave=device["address"],
-                )
-                if result.isError():
-                    self.logger.error("Failed to read discrete input: %s", result)
-                    continue
-                di_result.update(dict(zip(di_range, result.bits)))
+            with self._session(device) as client:
+                depth = self._pipeline_depth(device)
+                prefetched = []
+                for index, (register_type, block_start, count) in enumerate(blocks):
+                    if index < len(prefetched):
+                        # the block was read by the last pipelined batch
+                        result = prefetched[index]
+                    elif read and deadline is not None and time.monotonic() >= deadline:
+                        self.logger.warning(
+                            "Device %s used up its cycle budget of %ss, "
+                            "%d of %d blocks are deferred to the next poll",
+                            device["name"],
+                            budget,
+                            len(blocks) - read,
+                            len(blocks),
+                        )
+                        break
+                    elif depth > 1:
+                        batch = (
+                            blocks[index : index + depth]
+                            if deadline is not None
+                            else blocks[index:]
+                        )
+                        prefetched.extend(
+                            self._read_pipelined(client, device, batch, depth)
+                        )
+                        result = prefetched[index]
+                    else:
+                        result = None
+                    read += 1
+                    for start, values, acquired in self._read_block(
+                        client, device, register_type, block_start, count, result
+                    ):
+                        results[register_type].update(
+                            zip(range(start, start + len(values)), values)
+                        )
+                        timestamps[(register_type, block_start)] = acquired
         except ConnectionException as e:
             error = e
             self.logger.error("Failed to connect to device: %s: %s", device["name"], e)
         except Exception as e:
             error = e
             self.logger.error("Failed to read: %s", e)
-        client.close()
-        return coil_results, di_result, hr_results, ir_result, error
+        if poll_plan is not None:
+            # nothing is deferred by a failed poll, the next poll reads all blocks
+            poll_plan.defer(
+                intervals, read if error is None else len(blocks), len(blocks)
+            )
+        return (
+            results["co"],
+            results["di"],
+            results["hr"],
+            results["ir"],
+            error,
+            timestamps,
+        )
+
+    def _pipeline_depth(self, device):
+        """Get the number of reads of a device which are sent before waiting for replies
+
+        For a TCP device, up to pipeline reads are sent over the socket of the
+        bus, at most inflight of the bus. Devices without pipeline use inflight
+        of their bus, so setting inflight alone turns pipelining on.
+        """
+        if device["protocol"] != "TCP":
+            return 1
+        inflight = self.bus_depths.get(bus_key(device))
+        depth = device.get("pipeline", inflight or 1)
+        return min(depth, inflight or depth)
+
+    def _read_pipelined(self, client, device, blocks, depth):
+        """Read blocks with pipelined requests
+
+        Returns the response per block, or None per block if there are too
+        few blocks for pipelining, they are to be read one by one then.
+        """
+        if len(blocks) < 2:
+            return [None] * len(blocks)
+        return PipelinedReader(client, depth, getattr(client, "record", None)).read(
+            (register_type, start, count, device["address"])
+            for register_type, start, count in blocks
+        )
+
+    def _read_block(
+        self, client, device, register_type, start, count, result=None
+    ):  # pylint: disable=too-many-arguments
+        """Read a block of registers or coils
+
+        If the device rejects the block with ILLEGAL DATA ADDRESS, the block is
+        bisected to find the unsupported addresses. These are remembered as
+        holes of the device, so future reads are planned around them.
+        The response of the block can be given if it was already read.
+        Returns a list of the start, values and acquisition time of all reads.
+        """
+        function, attribute, description = READ_REQUESTS[register_type]
+        if result is None:
+            result = getattr(client, function)(
+                address=start, count=count, slave=device["address"]
+            )
+        acquired = time.time()
+        if not result.isError():
+            return [(start, getattr(result, attribute)[:count], acquired)]
+        if getattr(result, "exception_code", None) != ModbusExceptions.IllegalAddress:
+            self.logger.error("Failed to read %s: %s", description, result)
+            return []
+        if count == 1:
+            if self.address_holes.add(device, register_type, start):
+                self.logger.warning(
+                    "Device %s does not support %s %d, it will not be polled anymore",
+                    device["name"],
+                    description,
+                    start,
+                )
+            return []
+        half = count // 2
+        return self._read_block(
+            client, device, register_type, start, half
+        ) + self._read_block(client, device, register_type, start + half, count - half)
 
     def read_base_definition(self, base_path):
         """Read base definition file"""
         if os.path.exists(base_path):
-            with open(base_path, mode="rb") as file:
-                return tomli.load(file)
-        else:
-            self.logger.error("Base config file %s not found", base_path)
-            return {}
+            return load_config(base_path)
+        self.logger.error("Base config file %s not found", base_path)
+        return {}
 
     def read_device_definition(self, device_path):
         """Read device definition file"""
         if os.path.exists(device_path):
-            with open(device_path, mode="rb") as file:
-                return tomli.load(file)
-        else:
-            self.logger.error("Device config file %s not found", device_path)
-            return {}
+            return load_config(device_path)
+        self.logger.error("Device config file %s not found", device_path)
+        return {}
 
     def start_polling(self):
         """Start watching the configuration files and start polling the Modbus server"""
@@ -406,11 +983,21 @@ class ModbusPoll:
     def send_tedge_message(
         self, msg: MappedMessage, retain: bool = False, qos: int = 0
     ):
-        """Send a thin-edge.io message via MQTT"""
-        self.logger.debug("sending message %s to topic %s", msg.serialize(), msg.topic)
-        self.tedge_client.publish(
-            topic=msg.topic, payload=msg.serialize(), retain=retain, qos=qos
-        )
+        """Queue a thin-edge.io message, it is published via MQTT by the publisher thread
+
+        Measurements over the rate limits are held back, see RateLimiter.
+        """
+        payload = self.rate_limiter.admit(msg.topic, msg.serialize())
+        if payload is None:
+            self.logger.debug(
+                "Rate limit exceeded, holding back message to %s", msg.topic
+            )
+            return
+        self.logger.debug("sending message %s to topic %s", payload, msg.topic)
+        if not self.publisher.put(
+            msg.topic, payload, retain=retain or msg.retain, qos=qos
+        ):
+            self.logger.debug("Publish queue is full, dropped message to %s", msg.topic)
 
     def on_connect(
         self, client, userdata, flags, rc
@@ -444,8 +1031,8 @@ class ModbusPoll:
 
     def _subscribe_to_topics(self, client):
         """Subscribe to configured MQTT topics"""
-        subscribe_topics = self.base_config.get("thinedge", {}).get(
-            "subscribe_topics", []
+        subscribe_topics = [CONFIG_CHANGED_TOPIC] + list(
+            self.base_config.get("thinedge", {}).get("subscribe_topics", [])
         )
         if subscribe_topics:
             for topic in subscribe_topics:
@@ -466,6 +1053,18 @@ class ModbusPoll:
         """Handle messages received from subscribed topics"""
         self.logger.debug("Handling message from topic %s: %s", topic, payload)
 
+        if topic == CONFIG_CHANGED_TOPIC:
+            filename = json.loads(payload).get("file")
+            if filename in [BASE_CONFIG_NAME, DEVICES_CONFIG_NAME]:
+                # Reloading reconnects the MQTT client, so it is done by a worker
+                self.commands.submit(
+                    "config", self.reload_config, f"{self.config_dir}/{filename}"
+                )
+            return
+
+        if not self._owns_topic(topic):
+            return
+
         try:
             payload_data = json.loads(payload)
         except json.JSONDecodeError as e:
@@ -481,63 +1080,202 @@ class ModbusPoll:
             )
             return
 
-        # Handle modbus_SetRegister commands
-        if (
-            "///cmd/modbus_SetRegister/" in topic
-            and payload_data["status"] == "executing"
-        ):
-            self.logger.info("Processing modbus_SetRegister command")
-            try:
-                self.logger.debug("Register data: %s", payload_data)
+        # Handle modbus_SetRegister and modbus_SetCoil commands
+        for command in WRITE_OPERATIONS:
+            if f"///cmd/{command}/" in topic and payload_data["status"] == "executing":
+                # Commands are executed by the worker pool, so a slow device
+                # does not block the MQTT network thread
+                if not self.commands.submit(
+                    extract_device_from_topic(topic),
+                    self._process_write_command,
+                    command,
+                    payload_data,
+                    topic,
+                ):
+                    self.logger.error("Rejecting %s command: queue is full", command)
+                    payload_data["status"] = "failed"
+                    payload_data["reason"] = (
+                        f"Rejected {command} command: command queue is full"
+                    )
+                    self.send_tedge_message(
+                        MappedMessage(json.dumps(payload_data), topic),
+                        retain=True,
+                        qos=1,
+                    )
+                return
 
-                register_json = json.dumps(payload_data)
-                set_register.run(register_json, topic=topic)
-                self.logger.debug("Successfully processed modbus_SetRegister command")
-                payload_data["status"] = "successful"
-                self.send_tedge_message(
-                    MappedMessage(json.dumps(payload_data), topic),
-                    retain=True,
-                    qos=1,
-                )
-            except Exception as e:
-                self.logger.error("Error processing modbus_SetRegister command: %s", e)
-                payload_data["status"] = "failed"
-                payload_data["reason"] = (
-                    f"Error processing modbus_SetRegister command: {e}"
-                )
+        # Handle Cloud Fieldbus operations mapped to commands of the main device
+        for command in OPERATIONS:
+            if (
+                topic.startswith(f"te/device/main///cmd/{command}/")
+                and payload_data["status"] == "executing"
+            ):
+                if not self.commands.submit(
+                    "main", self._process_operation, command, payload_data, topic
+                ):
+                    self.logger.error("Rejecting %s operation: queue is full", command)
+                    payload_data["status"] = "failed"
+                    payload_data["reason"] = (
+                        f"Rejected {command} operation: command queue is full"
+                    )
+                    self.send_tedge_message(
+                        MappedMessage(json.dumps(payload_data), topic),
+                        retain=True,
+                        qos=1,
+                    )
+                return
 
-                self.send_tedge_message(
-                    MappedMessage(json.dumps(payload_data), topic), retain=True, qos=1
-                )
+        # Add more topic-specific handlers as needed
+        self.logger.debug("No specific handler for topic: %s", topic)
 
-        # Handle modbus_SetCoil commands
-        elif (
-            "///cmd/modbus_SetCoil/" in topic and payload_data["status"] == "executing"
-        ):
-            self.logger.info("Processing modbus_SetCoil command")
-            try:
-                self.logger.debug("Coil data: %s", payload_data)
+    def _process_write_command(self, command, payload_data, topic):
+        """Execute a write command and publish its final status
 
-                coil_json = json.dumps(payload_data)
-                set_coil.run(coil_json, topic=topic)
-                self.logger.debug("Successfully processed modbus_SetCoil command")
-                payload_data["status"] = "successful"
-                self.send_tedge_message(
-                    MappedMessage(json.dumps(payload_data), topic),
-                    retain=True,
-                    qos=1,
-                )
-            except Exception as e:
-                self.logger.error("Error processing modbus_SetCoil command: %s", e)
-                payload_data["status"] = "failed"
-                payload_data["reason"] = f"Error processing modbus_SetCoil command: {e}"
-                self.send_tedge_message(
-                    MappedMessage(json.dumps(payload_data), topic), retain=True, qos=1
+        The handler module of the command is imported on first use, so the
+        reader does not load the write handlers until they are needed.
+        """
+        self.logger.info("Processing %s command", command)
+        try:
+            self.logger.debug("Command data: %s", payload_data)
+            operation = load_write_operation(command)
+            results = self._execute_write(operation, payload_data, topic)
+            if results is not None:
+                payload_data["results"] = results
+                operation.check_results(results)
+            self.logger.debug("Successfully processed %s command", command)
+            payload_data["status"] = "successful"
+        except Exception as e:
+            self.logger.error("Error processing %s command: %s", command, e)
+            payload_data["status"] = "failed"
+            payload_data["reason"] = f"Error processing {command} command: {e}"
+        self.send_tedge_message(
+            MappedMessage(json.dumps(payload_data), topic), retain=True, qos=1
+        )
+
+    def _process_operation(self, command, payload_data, topic):
+        """Execute a Cloud Fieldbus operation in-process and publish its final status
+
+        The handler module is imported on first use and stays loaded, the
+        operation gets the command payload as its single JSON argument.
+        """
+        self.logger.info("Processing %s operation", command)
+        try:
+            if self.operation_context is None:
+                self.operation_context = Context()
+                self.operation_context.config_dir = Path(self.config_dir)
+                self.operation_context.base_config_path = (
+                    self.operation_context.config_dir / BASE_CONFIG_NAME
                 )
+                # publish with the client of the reader instead of connecting again
+                self.operation_context.publisher = self._publish_operation_message
+            arguments = {
+                key: value
+                for key, value in payload_data.items()
+                if key not in ("status", "reason", "logPath")
+            }
+            load_operation(command).run([json.dumps(arguments)], self.operation_context)
+            payload_data["status"] = "successful"
+        except Exception as e:
+            self.logger.error("Error processing %s operation: %s", command, e)
+            payload_data["status"] = "failed"
+            payload_data["reason"] = f"Error processing {command} operation: {e}"
+        self.send_tedge_message(
+            MappedMessage(json.dumps(payload_data), topic), retain=True, qos=1
+        )
 
-        # Add more topic-specific handlers as needed
+    def _publish_operation_message(self, topic, payload, qos=0, retain=False):
+        """Queue a message of an in-process operation as is, for the client of the reader"""
+        self.publisher.put(topic, payload, retain=retain, qos=qos)
+
+    def _report_command_stats(self, latency, depth):
+        """Publish the latency of the last command and the command queue depth"""
+        self.logger.debug(
+            "Command finished after %.3fs, %d commands queued", latency, depth
+        )
+        if self.tedge_client is None:
+            return
+        data = {"commands": {"latency": round(latency, 3), "queued": depth}}
+        self.send_tedge_message(
+            MappedMessage(
+                json.dumps(data),
+                "te/device/main/service/tedge-modbus-plugin/m/commands",
+            )
+        )
+
+    def _execute_write(self, operation, payload_data, topic):
+        """Execute a write command in-process
+
+        The write parameters are resolved against the loaded device definitions
+        and written with the pooled connection of the target bus, so the write
+        is serialized with the polling of all devices on the same bus. Bitfields
+        can be written based on register values polled within writecacheage
+        seconds. If writeconfirm is enabled, the written values are read back
+        and published right away. Returns the per-metric results of name-based
+        commands.
+        """
+        params = operation.resolve_params(payload_data, topic, self.device_index)
+        device = self.device_index.device(params.get("device"))
+        if device is not None:
+            target_device, protocol = dict(device), device["protocol"]
         else:
-            self.logger.debug("No specific handler for topic: %s", topic)
+            target_device, protocol = find_target_device(
+                params["ip_address"], params["slave_id"], self.device_index
+            )
+        backfill_serial_defaults(target_device, protocol, self.base_config)
+        confirm = device is not None and device.get(
+            "writeconfirm", self.base_config["modbus"].get("writeconfirm", False)
+        )
+        confirmed = {} if confirm else None
+        with self._session(target_device) as client:
+            max_age = self.base_config["modbus"].get("writecacheage", 0)
+            try:
+                results = operation.write(
+                    client,
+                    params,
+                    capabilities=self.write_capabilities.setdefault(
+                        device_key(target_device), {}
+                    ),
+                    cached_value=lambda address: self.register_cache.get(
+                        target_device, address, max_age
+                    ),
+                    confirmed=confirmed,
+                )
+            finally:
+                self.register_cache.invalidate(target_device)
+        if confirmed:
+            self._publish_confirmed(device, operation.REGISTER_TYPE, confirmed)
+        return results
+
+    def _publish_confirmed(self, device, register_type, confirmed):
+        """Map and publish values read back after a write
+
+        The values go through the mapper of the device like polled values, so
+        on_change registers are not published again by the next poll.
+        """
+        mapper = self.mappers.get(device["name"])
+        if mapper is None:
+            return
+        results = {key: {} for key in REGISTER_TYPES}
+        results[register_type] = confirmed
+        if register_type == "hr":
+            self.register_cache.update(device, confirmed)
+        poll_model = tuple(
+            split_set(confirmed) if key == register_type else []
+            for key in REGISTER_TYPES
+        )
+        decode_plan = build_decode_plan(device, poll_model)
+        steps = [
+            step
+            for step in decode_plan["registers"]
+            if all(
+                address in confirmed
+                for address in range(step.address, step.address + step.count)
+            )
+        ]
+        # this runs on a command worker while the device may be polled
+        with mapper.lock:
+            self._map_registers(device, steps, mapper, results, set(), {})
+            self._map_coils(decode_plan["coils"], mapper, results, set(), {})
 
     def connect_to_tedge(self):
         """Connect to the thin-edge.io MQTT broker and return a connected MQTT client"""
@@ -546,6 +1284,8 @@ class ModbusPoll:
                 broker = self.base_config["thinedge"]["mqtthost"]
                 port = self.base_config["thinedge"]["mqttport"]
                 client_id = "modbus-client"
+                if self.shard is not None:
+                    client_id = f"{client_id}-shard{self.shard[0]}"
                 client = mqtt_client.Client(client_id)
 
                 # Set up callbacks
@@ -641,12 +1381,32 @@ class ModbusPoll:
                 )
 
 
+def run_shard(config_dir, logfile, index, count):
+    """Poll the devices of one shard, the entry point of a shard worker process"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    poll = ModbusPoll(config_dir, logfile, shard=(index, count))
+    poll.start_polling()
+
+
+def configured_shards(config_dir):
+    """Get the number of shards configured in modbus.toml, 1 if not sharded"""
+    try:
+        base_config = load_config(f"{config_dir}/{BASE_CONFIG_NAME}")
+    except (OSError, ValueError):
+        return 1
+    return base_config.get("modbus", {}).get("shards") or 1
+
+
 def main():
     """Main"""
     try:
         parser = argparse.ArgumentParser()
         parser.add_argument("-c", "--configdir", required=False)
         parser.add_argument("-l", "--logfile", required=False)
+        parser.add_argument("-s", "--shards", type=int, required=False)
         args = parser.parse_args()
         logging.basicConfig(
             level=logging.INFO,
@@ -656,7 +1416,22 @@ def main():
             config_dir = os.path.abspath(args.configdir)
         else:
             config_dir = None
-        poll = ModbusPoll(config_dir or DEFAULT_FILE_DIR, args.logfile)
+        config_dir = config_dir or DEFAULT_FILE_DIR
+        shards = args.shards or configured_shards(config_dir)
+        if shards > 1:
+            thinedge = load_config(f"{config_dir}/{BASE_CONFIG_NAME}").get(
+                "thinedge", {}
+            )
+            ShardSupervisor(
+                functools.partial(run_shard, config_dir, args.logfile),
+                shards,
+                {
+                    "hostname": thinedge.get("mqtthost", "127.0.0.1"),
+                    "port": thinedge.get("mqttport", 1883),
+                },
+            ).run()
+            return
+        poll = ModbusPoll(config_dir, args.logfile)
         poll.start_polling()
     except KeyboardInterrupt:
         sys.exit(1)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Cache of the holding register values read from the devices"""
+import threading
+import time
+
+from .holes import device_key
+
+
+class RegisterCache:
+    """Latest holding register values of all devices with the time they were read
+
+    Polling updates the cache, writes use it to skip reading a register
+    before changing some of its bits.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def update(self, device, registers, acquired=None):
+        """Store the values of holding registers read from a device"""
+        if acquired is None:
+            acquired = time.monotonic()
+        key = device_key(device)
+        with self.lock:
+            device_values = self.values.setdefault(key, {})
+            for address, value in registers.items():
+                device_values[address] = (value, acquired)
+
+    def get(self, device, address, max_age, now=None):
+        """Get the value of a register if it was read within max_age seconds"""
+        if not max_age:
+            return None
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            entry = self.values.get(device_key(device), {}).get(address)
+        if entry is None or now - entry[1] > max_age:
+            return None
+        return entry[0]
+
+    def invalidate(self, device):
+        """Forget all values of a device, e.g. after writing to it"""
+        with self.lock:
+            self.values.pop(device_key(device), None)
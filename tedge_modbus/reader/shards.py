@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Multi-process sharding of the devices"""
+import json
+import logging
+import multiprocessing
+import time
+
+from paho.mqtt.publish import single as mqtt_publish
+
+from .connections import bus_key
+
+logger = logging.getLogger(__name__)
+
+# seconds between two checks of the shard workers
+CHECK_INTERVAL = 1
+# seconds to wait before a crashed shard worker is started again
+RESTART_DELAY = 5
+HEALTH_TOPIC = "te/device/main/service/tedge-modbus-plugin/status/health"
+
+
+def device_load(device):
+    """Estimate the polling load of a device by its number of registers and coils
+
+    Every device counts at least once, as it is polled even without any.
+    """
+    return 1 + len(device.get("registers") or []) + len(device.get("coils") or [])
+
+
+def assign_shards(devices, count):
+    """Assign every device to one of count shards, returns the shard by device name
+
+    Devices on the same bus (serial port or TCP endpoint) share a connection
+    and always stay in the same shard. The buses are distributed so that the
+    shards have about the same load (see device_load). The assignment
+    only depends on the devices, so every shard computes the same one.
+    """
+    buses = {}
+    for device in devices:
+        buses.setdefault(bus_key(device), []).append(device)
+    load = [0] * count
+    shards = {}
+    for key, bus_devices in sorted(
+        buses.items(),
+        key=lambda item: (-sum(device_load(d) for d in item[1]), repr(item[0])),
+    ):
+        shard = load.index(min(load))
+        load[shard] += sum(device_load(device) for device in bus_devices)
+        for device in bus_devices:
+            shards[device["name"]] = shard
+        logger.debug("Assigned bus %s to shard %d", key, shard)
+    return shards
+
+
+class ShardSupervisor:  # pylint: disable=too-many-instance-attributes
+    """Run the shards of the reader in worker processes
+
+    Every worker reads the configuration itself and polls the devices of its
+    shard with its own MQTT client. The supervisor starts the workers,
+    restarts crashed workers and publishes the aggregated health of all
+    shards.
+    """
+
+    def __init__(self, target, count, mqtt_settings=None):
+        self.target = target
+        self.count = count
+        self.mqtt_settings = mqtt_settings or {}
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [None] * count
+        self.restarts = [0] * count
+        self.crashed = [None] * count
+        self.health = None
+
+    def start(self, index):
+        """Start the worker process of a shard"""
+        process = self.context.Process(
+            target=self.target,
+            args=(index, self.count),
+            name=f"tedge-modbus-shard{index}",
+            daemon=True,
+        )
+        process.start()
+        self.workers[index] = process
+        self.crashed[index] = None
+        logger.info("Started shard %d of %d (pid %d)", index, self.count, process.pid)
+
+    def check(self, now=None):
+        """Restart crashed workers and publish the health if it changed"""
+        now = time.monotonic() if now is None else now
+        for index, process in enumerate(self.workers):
+            if process is None:
+                self.start(index)
+            elif not process.is_alive():
+                if self.crashed[index] is None:
+                    self.crashed[index] = now
+                    logger.error(
+                        "Shard %d exited with code %s, restarting in %ds",
+                        index,
+                        process.exitcode,
+                        RESTART_DELAY,
+                    )
+                elif now - self.crashed[index] >= RESTART_DELAY:
+                    self.restarts[index] += 1
+                    self.start(index)
+        self.publish_health()
+
+    def health_status(self):
+        """Get the aggregated health of all shards"""
+        shards = {
+            str(index): {
+                "status": (
+                    "up" if process is not None and process.is_alive() else "down"
+                ),
+                "pid": process.pid if process is not None else None,
+                "restarts": self.restarts[index],
+            }
+            for index, process in enumerate(self.workers)
+        }
+        up = all(shard["status"] == "up" for shard in shards.values())
+        return {"status": "up" if up else "down", "shards": shards}
+
+    def publish_health(self):
+        """Publish the health of the shards if it changed"""
+        health = self.health_status()
+        if health == self.health:
+            return
+        self.health = health
+        try:
+            mqtt_publish(
+                topic=HEALTH_TOPIC,
+                payload=json.dumps(health),
+                qos=1,
+                retain=True,
+                **self.mqtt_settings,
+            )
+        except Exception as err:
+            logger.warning("Failed to publish the shard health: %s", err)
+
+    def stop(self):
+        """Stop all worker processes"""
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            if process is not None:
+                process.join(timeout=5)
+
+    def run(self):
+        """Start all shards and supervise them until interrupted"""
+        try:
+            while True:
+                self.check()
+                time.sleep(CHECK_INTERVAL)
+        finally:
+            self.stop()
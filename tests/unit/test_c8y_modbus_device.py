@@ -0,0 +1,153 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+import toml
+from tedge_modbus.operations import c8y_modbus_device
+
+MAPPING = {
+    "c8y_Registers": [
+        {
+            "number": 1,
+            "startBit": 0,
+            "noBits": 16,
+            "signed": False,
+            "multiplier": 1,
+            "divisor": 1,
+            "offset": 0,
+            "input": False,
+            "measurementMapping": {"type": "power", "series": "L1"},
+        },
+        {
+            "number": 2,
+            "startBit": 0,
+            "noBits": 16,
+            "signed": True,
+            "multiplier": 1,
+            "divisor": 10,
+            "offset": 0,
+            "input": False,
+        },
+    ]
+}
+
+
+def device(index, mapping_path="/inventory/managedObjects/42"):
+    return {
+        "protocol": "TCP",
+        "address": 1,
+        "name": f"meter{index}",
+        "ipAddress": "192.168.1.10",
+        "id": str(index),
+        "type": mapping_path,
+    }
+
+
+def response(status_code, body=None, etag=None):
+    return MagicMock(
+        status_code=status_code,
+        json=MagicMock(return_value=body),
+        headers={"ETag": etag} if etag else {},
+    )
+
+
+class TestBulkProvisioning(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.context = MagicMock()
+        self.context.publisher = None
+        self.context.base_config = {"modbus": {"loglevel": "INFO"}}
+        self.context.config_dir = Path(self.tmpdir.name)
+        self.context.c8y_proxy = "http://localhost:8001/c8y"
+        self.context.device_id = "gateway"
+        self.devices_path = self.context.config_dir / "devices.toml"
+        self.devices_path.write_text(
+            toml.dumps({"device": [{"name": "existing", "protocol": "RTU"}]})
+        )
+        c8y_modbus_device._MAPPING_CACHE.clear()
+        publish = patch("tedge_modbus.operations.config_store.mqtt_publish")
+        self.mock_publish = publish.start()
+        self.addCleanup(publish.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @patch("tedge_modbus.operations.c8y_modbus_device.update_config")
+    @patch("tedge_modbus.operations.c8y_modbus_device.requests")
+    def test_devices_are_provisioned_with_one_write(self, mock_requests, mock_update):
+        """
+        GIVEN a bulk operation of several devices sharing one mapping
+        WHEN it is executed
+        THEN an external id is created for every device, the mapping is
+        fetched once and all devices are stored with a single write.
+        """
+        mock_requests.post.return_value = response(201)
+        mock_requests.get.return_value = response(200, MAPPING)
+        arguments = [json.dumps({"devices": [device(i) for i in range(5)]})]
+
+        c8y_modbus_device.run(arguments, self.context)
+
+        self.assertEqual(mock_requests.post.call_count, 5)
+        mock_requests.get.assert_called_once()
+        mock_update.assert_called_once()
+        stored = toml.load(self.devices_path)
+        mock_update.call_args[0][1](stored)
+        self.assertEqual(
+            [item["name"] for item in stored["device"]],
+            ["existing"] + [f"meter{i}" for i in range(5)],
+        )
+        self.assertEqual(
+            [register["number"] for register in stored["device"][1]["registers"]],
+            [1, 2],
+        )
+
+    @patch("tedge_modbus.operations.c8y_modbus_device.requests")
+    def test_cached_mapping_is_revalidated_by_etag(self, mock_requests):
+        """
+        GIVEN a mapping which was fetched with an ETag
+        WHEN it is needed again and did not change
+        THEN it is requested with If-None-Match and the cached mapping is used.
+        """
+        mock_requests.get.return_value = response(200, MAPPING, etag='"v1"')
+        c8y_modbus_device.fetch_mapping("/mapping", self.context)
+        mock_requests.get.return_value = response(304)
+
+        mapping = c8y_modbus_device.fetch_mapping("/mapping", self.context)
+
+        self.assertEqual(mapping, MAPPING)
+        self.assertEqual(
+            mock_requests.get.call_args[1]["headers"], {"If-None-Match": '"v1"'}
+        )
+
+    @patch("tedge_modbus.operations.c8y_modbus_device.requests")
+    def test_failed_devices_are_reported(self, mock_requests):
+        """
+        GIVEN a bulk operation where the external id of one device fails
+        WHEN it is executed
+        THEN the other devices are stored and the failed device is reported.
+        """
+        mock_requests.post.side_effect = lambda url, **_: response(
+            500 if "/globalIds/1/" in url else 201
+        )
+        mock_requests.get.return_value = response(200, MAPPING)
+        arguments = [json.dumps({"devices": [device(0), device(1)]})]
+
+        with self.assertRaisesRegex(ValueError, "1 of 2 devices: meter1"):
+            c8y_modbus_device.run(arguments, self.context)
+
+        stored = toml.load(self.devices_path)
+        self.assertEqual(
+            [item["name"] for item in stored["device"]], ["existing", "meter0"]
+        )
+        self.mock_publish.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
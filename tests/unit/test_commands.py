@@ -0,0 +1,78 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import threading
+import time
+import unittest
+from tedge_modbus.reader.commands import CommandWorkers
+
+
+class TestCommandWorkers(unittest.TestCase):
+
+    def test_commands_of_one_device_run_in_order(self):
+        """
+        GIVEN a pool with several workers
+        WHEN commands of one device are submitted
+        THEN they are executed one after the other in submit order.
+        """
+        workers = CommandWorkers(workers=4, maxsize=10)
+        executed = []
+
+        def command(number):
+            time.sleep(0.01)
+            executed.append(number)
+
+        for number in range(5):
+            self.assertTrue(workers.submit("device", command, number))
+        self.assertTrue(workers.join(timeout=5))
+        self.assertEqual(executed, [0, 1, 2, 3, 4])
+
+    def test_devices_run_in_parallel(self):
+        """
+        GIVEN a command of one device which blocks
+        WHEN a command of another device is submitted
+        THEN it is executed while the first one is still running.
+        """
+        workers = CommandWorkers(workers=2, maxsize=10)
+        release = threading.Event()
+        done = threading.Event()
+        workers.submit("slow", release.wait)
+        workers.submit("fast", done.set)
+        self.assertTrue(done.wait(timeout=5))
+        release.set()
+        self.assertTrue(workers.join(timeout=5))
+
+    def test_full_queue_rejects_and_reports(self):
+        reports = []
+        workers = CommandWorkers(
+            workers=1, maxsize=2, report=lambda *args: reports.append(args)
+        )
+        release = threading.Event()
+        self.assertTrue(workers.submit("a", release.wait))
+        self.assertTrue(workers.submit("b", lambda: None))
+        self.assertFalse(workers.submit("c", lambda: None))
+        self.assertEqual(workers.depth(), 2)
+
+        release.set()
+        self.assertTrue(workers.join(timeout=5))
+        self.assertEqual([depth for _, depth in reports], [1, 0])
+        self.assertTrue(all(latency >= 0 for latency, _ in reports))
+
+    def test_failing_command_does_not_stop_worker(self):
+        workers = CommandWorkers(workers=1, maxsize=10)
+        done = threading.Event()
+        workers.submit("device", lambda: 1 / 0)
+        workers.submit("device", done.set)
+        self.assertTrue(done.wait(timeout=5))
+
+    def test_shrinking_the_pool(self):
+        workers = CommandWorkers(workers=3, maxsize=10)
+        workers.configure(1, 10)
+        deadline = time.monotonic() + 5
+        while len(workers.threads) > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(workers.threads), 1)
+        with self.assertRaises(ValueError):
+            workers.configure(0, 10)
@@ -0,0 +1,125 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import json
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+import toml
+from tedge_modbus.operations.config_store import (
+    CONFIG_CHANGED_TOPIC,
+    read_version,
+    update_config,
+)
+
+
+class TestConfigStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "modbus.toml")
+        with open(self.path, "w", encoding="utf8") as file:
+            toml.dump({"modbus": {"pollinterval": 2}}, file)
+        os.chmod(self.path, 0o644)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_update_replaces_file_and_bumps_version(self):
+        """
+        GIVEN a configuration file
+        WHEN it is updated
+        THEN the file is replaced by a new file with the same mode and its
+        version is incremented.
+        """
+        inode = os.stat(self.path).st_ino
+
+        def apply(config):
+            config["modbus"]["pollinterval"] = 5
+
+        version = update_config(self.path, apply)
+
+        self.assertEqual(version, 1)
+        self.assertEqual(read_version(self.path), 1)
+        self.assertEqual(toml.load(self.path)["modbus"]["pollinterval"], 5)
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir.name)), [".modbus.toml.lock", "modbus.toml"]
+        )
+
+    @unittest.skipUnless(os.geteuid() == 0, "changing the owner requires root")
+    def test_update_by_root_keeps_owner(self):
+        """
+        GIVEN a configuration file owned by the service user
+        WHEN root (the reader) updates it
+        THEN the new file and its lock file keep the owner of the file.
+        """
+        os.chown(self.path, 4242, 4243)
+
+        update_config(self.path, lambda config: None)
+
+        for path in (self.path, os.path.join(self.tmpdir.name, ".modbus.toml.lock")):
+            self.assertEqual((os.stat(path).st_uid, os.stat(path).st_gid), (4242, 4243))
+
+    def test_concurrent_updates_are_not_lost(self):
+        """
+        GIVEN several threads updating the same configuration file
+        WHEN they run at the same time
+        THEN every update is applied and counted.
+        """
+
+        def add(index):
+            def apply(config):
+                config.setdefault("updates", {})[f"u{index}"] = index
+
+            return lambda: update_config(self.path, apply)
+
+        threads = [threading.Thread(target=add(index)) for index in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(toml.load(self.path)["updates"]), 10)
+        self.assertEqual(read_version(self.path), 10)
+
+    @patch("tedge_modbus.operations.config_store.mqtt_publish")
+    def test_reader_is_notified(self, mock_publish):
+        """
+        GIVEN an operation context
+        WHEN a configuration file is updated
+        THEN the file name and its new version are published for the reader.
+        """
+        context = MagicMock(broker="localhost", port=1883, publisher=None)
+
+        update_config(self.path, lambda config: None, context)
+
+        self.assertEqual(mock_publish.call_args[1]["topic"], CONFIG_CHANGED_TOPIC)
+        self.assertEqual(
+            json.loads(mock_publish.call_args[1]["payload"]),
+            {"file": "modbus.toml", "version": 1},
+        )
+
+    @patch("tedge_modbus.operations.config_store.mqtt_publish")
+    def test_context_publisher_is_used(self, mock_publish):
+        """
+        GIVEN an operation context with a publisher of the running process
+        WHEN a configuration file is updated
+        THEN the notification goes through that publisher, no new client connects.
+        """
+        context = MagicMock(publisher=MagicMock())
+
+        update_config(self.path, lambda config: None, context)
+
+        mock_publish.assert_not_called()
+        topic, payload = context.publisher.call_args[0]
+        self.assertEqual(topic, CONFIG_CHANGED_TOPIC)
+        self.assertEqual(json.loads(payload), {"file": "modbus.toml", "version": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from tedge_modbus.reader.connections import ConnectionPool
+
+GATEWAY = ("TCP", "10.0.0.1", 502)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool()
+        self.factory = MagicMock(side_effect=lambda: MagicMock())
+
+    def wait_queued(self, count):
+        connection = self.pool.get(GATEWAY, self.factory)
+        deadline = time.monotonic() + 5
+        while connection.queued() < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(connection.queued(), count)
+
+    def queue_session(self, unit, served):
+        def use():
+            with self.pool.session(GATEWAY, self.factory, unit=unit):
+                served.append(unit)
+
+        thread = threading.Thread(target=use)
+        thread.start()
+        return thread
+
+    def test_units_are_served_in_turns(self):
+        """
+        GIVEN a gateway busy with a request of unit 1
+        WHEN unit 1 queues three more requests before unit 2 queues one
+        THEN unit 2 is served right after the next request of unit 1.
+        """
+        served = []
+        threads = []
+        with self.pool.session(GATEWAY, self.factory, unit=1):
+            for count, unit in enumerate((1, 1, 1, 2), start=1):
+                threads.append(self.queue_session(unit, served))
+                self.wait_queued(count)
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(served, [1, 2, 1, 1])
+        self.factory.assert_called_once()
+
+    def test_units_share_one_client(self):
+        """
+        GIVEN a gateway with two units
+        WHEN both units use it one after the other
+        THEN they share the same client, so a single socket is opened.
+        """
+        with self.pool.session(GATEWAY, self.factory, unit=1) as first:
+            pass
+        with self.pool.session(GATEWAY, self.factory, unit=2) as second:
+            pass
+
+        self.assertIs(first, second)
+        self.factory.assert_called_once()
+
+    def test_failed_session_closes_its_client(self):
+        with self.assertRaises(ConnectionError):
+            with self.pool.session(GATEWAY, self.factory, unit=1) as client:
+                raise ConnectionError("gone")
+
+        client.close.assert_called_once()
+        with self.pool.session(GATEWAY, self.factory, unit=1) as reused:
+            self.assertIs(reused, client)
+
+    def test_latency_is_tracked_per_request(self):
+        """
+        GIVEN sessions of two units on a gateway
+        WHEN the stats are taken
+        THEN the number of requests and their round trip time are reported
+        per unit, time spent in the session between requests is not counted,
+        and the stats are reset.
+        """
+        self.factory.side_effect = lambda: MagicMock(
+            read_holding_registers=lambda **kwargs: time.sleep(0.01)
+        )
+        for unit, requests in ((1, 2), (2, 1)):
+            with self.pool.session(GATEWAY, self.factory, unit=unit) as client:
+                for _ in range(requests):
+                    client.read_holding_registers(address=0, count=1, slave=unit)
+                time.sleep(0.05)
+
+        stats = self.pool.take_stats()
+
+        units, queued = stats[GATEWAY]
+        self.assertEqual(queued, 0)
+        self.assertEqual(units[1]["requests"], 2)
+        self.assertEqual(units[2]["requests"], 1)
+        self.assertGreaterEqual(units[2]["latency"], 0.01)
+        self.assertLess(units[2]["latency"], 0.05)
+        self.assertEqual(self.pool.take_stats(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
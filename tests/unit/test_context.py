@@ -0,0 +1,95 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from tedge_modbus.operations import context
+from tedge_modbus.operations.context import (
+    Context,
+    invalidate_config,
+    load_config,
+    tedge_device_id,
+)
+
+
+class TestOperationContext(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "modbus.toml")
+        self.write_config(1)
+        invalidate_config()
+
+    def tearDown(self):
+        invalidate_config()
+        self.tmpdir.cleanup()
+
+    def write_config(self, interval, mtime_ns=None):
+        with open(self.path, "w", encoding="utf8") as file:
+            file.write(f"[modbus]\npollinterval = {interval}\n")
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_config_is_parsed_once_per_file_version(self):
+        """
+        GIVEN a configuration file
+        WHEN it is loaded several times without being changed
+        THEN it is parsed only once, and every caller gets its own copy.
+        """
+        with patch("tedge_modbus.operations.context.tomli.load") as mock_load:
+            mock_load.return_value = {"modbus": {"pollinterval": 1}}
+            first = load_config(self.path)
+            first["modbus"]["pollinterval"] = 5
+            second = load_config(self.path)
+
+        mock_load.assert_called_once()
+        self.assertEqual(second["modbus"]["pollinterval"], 1)
+
+    def test_changed_config_is_reloaded(self):
+        """
+        GIVEN a loaded configuration file
+        WHEN the file is replaced with a new modification time
+        THEN the new content is loaded.
+        """
+        self.write_config(1, mtime_ns=1_000_000_000)
+        self.assertEqual(load_config(self.path)["modbus"]["pollinterval"], 1)
+
+        self.write_config(2, mtime_ns=2_000_000_000)
+
+        self.assertEqual(load_config(self.path)["modbus"]["pollinterval"], 2)
+
+    def test_invalidated_config_is_reloaded(self):
+        """
+        GIVEN a loaded configuration file
+        WHEN the file changes without a new version (same mtime and size)
+        THEN the change is picked up once the file watcher invalidates it.
+        """
+        self.write_config(1, mtime_ns=1_000_000_000)
+        load_config(self.path)
+        self.write_config(3, mtime_ns=1_000_000_000)
+        self.assertEqual(load_config(self.path)["modbus"]["pollinterval"], 1)
+
+        invalidate_config(self.path)
+
+        self.assertEqual(load_config(self.path)["modbus"]["pollinterval"], 3)
+
+    @patch("tedge_modbus.operations.context.subprocess.run")
+    def test_device_id_is_queried_once(self, mock_run):
+        """
+        GIVEN several contexts
+        WHEN the device id is read repeatedly
+        THEN the tedge command is executed only once.
+        """
+        mock_run.return_value = MagicMock(stdout="gateway-1\n")
+        with patch.object(context, "_DEVICE_ID", None):
+            ids = [Context().device_id for _ in range(3)] + [tedge_device_id()]
+
+        self.assertEqual(ids, ["gateway-1"] * 4)
+        mock_run.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import tempfile
+import unittest
+from unittest.mock import patch
+from tedge_modbus.operations.device_index import (
+    DeviceIndex,
+    NameTrie,
+    load_device_index,
+)
+
+REGISTERS = [
+    {"number": 0, "name": "temp"},
+    {"number": 1, "name": "temperature"},
+    {"number": 2, "name": "pressure"},
+    {"number": 3, "name": "sure"},
+    {"number": 4},
+]
+
+
+class TestNameTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = NameTrie(REGISTERS, "name")
+
+    def test_first_prefix_in_config_order_wins(self):
+        """
+        GIVEN several register names which are a prefix of a metric name
+        WHEN the metric is matched
+        THEN the first of them in configuration order is used, like a linear scan.
+        """
+        self.assertEqual(self.trie.match("temperature_1a2b"), (REGISTERS[0], False))
+
+    def test_prefix_beats_partial_match(self):
+        self.assertEqual(self.trie.match("sure_x"), (REGISTERS[3], False))
+
+    def test_partial_match_in_config_order(self):
+        self.assertEqual(self.trie.match("x_pressure"), (REGISTERS[2], True))
+
+    def test_no_match(self):
+        self.assertEqual(self.trie.match("humidity"), (None, True))
+        self.assertEqual(self.trie.match(""), (None, True))
+
+
+class TestLoadDeviceIndex(unittest.TestCase):
+
+    def test_file_is_parsed_once_per_version(self):
+        """
+        GIVEN a devices.toml file
+        WHEN its index is loaded repeatedly
+        THEN the file is only parsed again after its content changed.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "devices.toml")
+            with open(path, "w", encoding="utf8") as file:
+                file.write('[[device]]\nname = "a"\n')
+
+            index = load_device_index(path)
+            self.assertIsInstance(index, DeviceIndex)
+            self.assertEqual(index.device("a"), {"name": "a"})
+
+            with patch("tedge_modbus.operations.device_index.toml.loads") as loads:
+                self.assertIs(load_device_index(path), index)
+                # touched without a change of content
+                os.utime(path, ns=(1, 1))
+                self.assertIs(load_device_index(path), index)
+                loads.assert_not_called()
+
+            with open(path, "w", encoding="utf8") as file:
+                file.write('[[device]]\nname = "b"\n')
+            changed = load_device_index(path)
+            self.assertIsNone(changed.device("a"))
+            self.assertEqual(changed.device("b"), {"name": "b"})
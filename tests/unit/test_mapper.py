@@ -5,12 +5,13 @@ import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 sys.path.insert(0, parent_dir)
-from tedge_modbus.reader.mapper import ModbusMapper
+from tedge_modbus.reader.mapper import MappedMessage, ModbusMapper
 
 import unittest
 import struct
 import json
-from tedge_modbus.reader.mapper import ModbusMapper
+from unittest.mock import patch
+from tedge_modbus.reader.mapper import MappedMessage, ModbusMapper
 
 
 class TestMapperOnChange(unittest.TestCase):
@@ -340,3 +341,137 @@ class TestMapperOnChange(unittest.TestCase):
         self.assertEqual(len(messages2), 1)
         event_data2 = json.loads(messages2[0].data)
         self.assertEqual(event_data2["text"], "This event tests the event mapping")
+
+
+class TestMapperFlapSuppression(unittest.TestCase):
+    def setUp(self):
+        self.mapper = ModbusMapper({"name": "test_device"})
+        self.coil = {"number": 2, "input": False}
+
+    def poll(self, value, timestamp):
+        return self.mapper.map_coil([value], self.coil, timestamp=timestamp)
+
+    def test_alarm_is_cleared(self):
+        """
+        GIVEN a coil with an alarm mapping
+        WHEN it becomes active and inactive again
+        THEN the alarm is raised and cleared with empty retained messages
+        and the first inactive value clears a stale retained alarm.
+        """
+        self.coil["alarmmapping"] = {
+            "severity": "MAJOR",
+            "text": "Overheat",
+            "type": "Overheat",
+        }
+
+        cleared = self.poll(0, 0)
+        raised = self.poll(1, 1)
+        still = self.poll(1, 2)
+        cleared_again = self.poll(0, 3)
+
+        for messages in (cleared, cleared_again):
+            self.assertEqual(len(messages), 1)
+            self.assertEqual(messages[0].topic, "te/device/test_device///a/Overheat")
+            self.assertEqual(messages[0].serialize(), "")
+            self.assertTrue(messages[0].retain)
+        self.assertEqual(json.loads(raised[0].serialize())["text"], "Overheat")
+        self.assertTrue(raised[0].retain)
+        self.assertEqual(still, [])
+
+    def test_dwell_debounces_flapping_value(self):
+        """
+        GIVEN an alarm mapping with a dwell time of 10 seconds
+        WHEN the coil flaps for a shorter time
+        THEN no alarm is raised until the coil stays active for 10 seconds.
+        """
+        self.coil["alarmmapping"] = {
+            "severity": "MAJOR",
+            "text": "Overheat",
+            "dwell": 10,
+        }
+        self.poll(0, 0)
+
+        self.assertEqual(self.poll(1, 1), [])
+        self.assertEqual(self.poll(0, 5), [])
+        self.assertEqual(self.poll(1, 6), [])
+        self.assertEqual(self.mapper.pending, {("co", 2)})
+        self.assertEqual(self.poll(1, 12), [])
+        raised = self.poll(1, 16)
+
+        self.assertEqual(json.loads(raised[0].serialize())["text"], "Overheat")
+        self.assertEqual(self.mapper.pending, set())
+
+    def test_dwell_restarts_with_every_new_value(self):
+        """
+        GIVEN an event mapping with a dwell time of 10 seconds
+        WHEN a register changes from 1 to 2 and then to 3 within the dwell time
+        THEN 3 only raises an event once it was read for 10 seconds itself.
+        """
+        register_def = {
+            "number": 100,
+            "startbit": 0,
+            "nobits": 16,
+            "signed": False,
+            "eventmapping": {"text": "Mode", "type": "Mode", "dwell": 10},
+        }
+
+        def poll(value, timestamp):
+            messages, _ = self.mapper.map_register(
+                read_register=[value], register_def=register_def, timestamp=timestamp
+            )
+            return messages
+
+        self.assertEqual(len(poll(1, 0)), 1)
+        self.assertEqual(poll(2, 1), [])
+        self.assertEqual(poll(3, 6), [])
+        self.assertEqual(poll(3, 12), [])
+        self.assertEqual(len(poll(3, 16)), 1)
+
+    def test_event_rate_is_limited(self):
+        """
+        GIVEN an event mapping with at most 2 events per minute
+        WHEN the coil changes 5 times within a minute
+        THEN 2 events are raised and a summary event reports
+        the 3 suppressed changes once the minute is over.
+        """
+        self.coil["eventmapping"] = {"text": "Door", "type": "Door", "maxrate": 2}
+
+        events = [
+            self.poll(value, second) for second, value in enumerate([0, 1, 0, 1, 0])
+        ]
+        summary = self.poll(0, 61)
+
+        self.assertEqual([len(messages) for messages in events], [1, 1, 0, 0, 0])
+        self.assertEqual(len(summary), 1)
+        data = json.loads(summary[0].serialize())
+        self.assertEqual(data["suppressed"], 3)
+        self.assertEqual(data["text"], "Door (3 events suppressed)")
+        self.assertEqual(self.mapper.pending, set())
+
+
+class TestMapperTimestamps(unittest.TestCase):
+    def setUp(self):
+        self.mapper = ModbusMapper({"name": "test_device"})
+        self.register_def = {
+            "number": 100,
+            "startbit": 0,
+            "nobits": 16,
+            "signed": False,
+            "measurementmapping": {"templatestring": '{"temp": %%}'},
+            "eventmapping": {"text": "changed", "type": "TestEvent"},
+        }
+
+    def test_messages_carry_acquisition_time(self):
+        messages, _ = self.mapper.map_register(
+            read_register=[1], register_def=self.register_def, timestamp=1700000000.5
+        )
+        self.assertEqual(len(messages), 2)
+        for message in messages:
+            data = json.loads(message.serialize())
+            self.assertEqual(data["time"], "2023-11-14T22:13:20.500000+00:00")
+
+    def test_default_time_is_creation_time(self):
+        with patch("tedge_modbus.reader.mapper.datetime") as mock_datetime:
+            mock_datetime.now.return_value.isoformat.return_value = "now"
+            message = MappedMessage('{"temp": 1}', "te/device/test_device///m/")
+        self.assertEqual(json.loads(message.serialize())["time"], "now")
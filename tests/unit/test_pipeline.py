@@ -0,0 +1,210 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import struct
+import unittest
+from unittest.mock import patch, MagicMock
+from pymodbus.exceptions import ConnectionException
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from tedge_modbus.reader.pipeline import PipelinedReader
+from tedge_modbus.reader.reader import ModbusPoll
+
+
+class FakePipelineServer:
+    """Modbus TCP client talking to a server which answers pipelined holding
+    register reads in reverse order, the value of a register is its address"""
+
+    def __init__(self, holes=(), silent=False):
+        self.holes = holes
+        self.silent = silent
+        self.events = []
+        self.unanswered = []
+        self.buffer = b""
+        self.requests = []
+
+    def connect(self):
+        return True
+
+    def send(self, frame):
+        self.events.append("send")
+        self.unanswered.append(frame)
+
+    def recv(self, size):
+        self.events.append("recv")
+        if not self.buffer and not self.silent:
+            for frame in reversed(self.unanswered):
+                self.buffer += self.reply(frame)
+            self.unanswered = []
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def reply(self, frame):
+        transaction_id, _, _, unit, _, address, count = struct.unpack(">HHHBBHH", frame)
+        if any(address <= hole < address + count for hole in self.holes):
+            pdu = bytes([0x83, ModbusExceptions.IllegalAddress])
+        else:
+            values = range(address, address + count)
+            pdu = bytes([3, 2 * count]) + struct.pack(f">{count}H", *values)
+        return struct.pack(">HHHB", transaction_id, 0, len(pdu) + 1, unit) + pdu
+
+    def read_holding_registers(self, address, count, slave):
+        self.requests.append((address, count))
+        if any(address <= hole < address + count for hole in self.holes):
+            return ExceptionResponse(3, ModbusExceptions.IllegalAddress)
+        return ReadHoldingRegistersResponse(list(range(address, address + count)))
+
+    def close(self):
+        pass
+
+
+class TestPipelinedReader(unittest.TestCase):
+
+    def test_requests_are_sent_before_replies_arrive(self):
+        """
+        GIVEN a pipeline depth of 3
+        WHEN 5 blocks are read
+        THEN 3 requests are sent before the first reply is awaited
+        and every response is matched to its request by transaction id.
+        """
+        server = FakePipelineServer()
+        requests = [("hr", address * 10, 2, 1) for address in range(5)]
+
+        responses = PipelinedReader(server, 3).read(requests)
+
+        self.assertEqual(server.events[:4], ["send", "send", "send", "recv"])
+        self.assertEqual(
+            [response.registers for response in responses],
+            [[address * 10, address * 10 + 1] for address in range(5)],
+        )
+
+    def test_exception_responses_are_returned(self):
+        server = FakePipelineServer(holes=(10,))
+
+        responses = PipelinedReader(server, 4).read([("hr", 0, 2, 1), ("hr", 10, 2, 1)])
+
+        self.assertFalse(responses[0].isError())
+        self.assertEqual(responses[1].exception_code, ModbusExceptions.IllegalAddress)
+
+    def test_missing_reply_times_out(self):
+        """
+        GIVEN a server which does not answer
+        WHEN blocks are read
+        THEN the read fails with a ConnectionException once the timeout expires.
+        """
+        server = FakePipelineServer(silent=True)
+
+        with self.assertRaises(ConnectionException):
+            PipelinedReader(server, 2).read([("hr", 0, 1, 1), ("hr", 5, 1, 1)])
+
+
+class TestReaderPipelining(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.base_config = {"modbus": {"pollinterval": 5}}
+        self.device = {
+            "name": "remote-plc",
+            "protocol": "TCP",
+            "ip": "127.0.0.1",
+            "port": 502,
+            "address": 1,
+            "pipeline": 4,
+            "registers": [
+                {"number": number, "startbit": 0, "nobits": 16}
+                for number in (0, 1, 200, 201, 400)
+            ],
+        }
+        self.server = FakePipelineServer(holes=(400,))
+        self.poll.get_modbus_client = MagicMock(return_value=self.server)
+
+    def test_blocks_are_read_pipelined(self):
+        """
+        GIVEN a TCP device with pipelining enabled and three blocks
+        WHEN it is polled
+        THEN all blocks are requested before the first reply is awaited
+        and a rejected block is still bisected with single requests.
+        """
+        plan = self.poll._build_poll_plan(self.device)
+
+        _, _, hr_results, _, error, _ = self.poll.get_data_from_device(
+            *plan.view(plan.due(0))[:2]
+        )
+
+        self.assertIsNone(error)
+        self.assertEqual(self.server.events.index("recv"), 3)
+        self.assertEqual(hr_results, {0: 0, 1: 1, 200: 200, 201: 201})
+        self.assertEqual(self.poll.address_holes.for_device(self.device), {"hr": {400}})
+
+    def test_inflight_of_the_gateway_caps_the_pipeline(self):
+        """
+        GIVEN a device with a pipeline of 4 behind a gateway with inflight 2
+        WHEN it is polled
+        THEN at most 2 reads are outstanding on the socket of the gateway
+        and the round trip time of every read is counted for the unit.
+        """
+        other = dict(self.device, name="other", address=2, inflight=2)
+        self.poll.devices = [self.device, other]
+        self.poll._plan_buses()
+        plan = self.poll._build_poll_plan(self.device)
+
+        self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+
+        self.assertEqual(self.server.events.index("recv"), 2)
+        units, _ = self.poll.connections.take_stats()[("TCP", "127.0.0.1", 502)]
+        self.assertEqual(units[1]["requests"], 3)
+
+    def test_cycle_budget_applies_to_pipelined_batches(self):
+        """
+        GIVEN a pipelined device with a pipeline of 2 and a cycle budget
+        WHEN the budget is used up by the first batch
+        THEN only the first batch of 2 blocks is read
+        and the third block is deferred to the next poll.
+        """
+        self.device["pipeline"] = 2
+        self.device["cyclebudget"] = 1e-9
+        plan = self.poll._build_poll_plan(self.device)
+        intervals = plan.due(0)
+
+        _, _, hr_results, _, error, _ = self.poll.get_data_from_device(
+            *plan.view(intervals)[:2], plan, intervals
+        )
+
+        self.assertIsNone(error)
+        self.assertEqual(
+            self.server.events, ["send", "send", "recv", "recv", "recv", "recv"]
+        )
+        self.assertEqual(hr_results, {0: 0, 1: 1, 200: 200, 201: 201})
+        self.assertEqual(plan.deferred, 1)
+
+    def test_inflight_alone_turns_pipelining_on(self):
+        del self.device["pipeline"]
+        self.poll.base_config["modbus"]["inflight"] = 3
+        self.poll.devices = [self.device]
+        self.poll._plan_buses()
+        plan = self.poll._build_poll_plan(self.device)
+
+        self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+
+        self.assertEqual(self.server.events.index("recv"), 3)
+        self.assertEqual(self.server.requests, [])
+
+    def test_pipelining_is_opt_in(self):
+        del self.device["pipeline"]
+        plan = self.poll._build_poll_plan(self.device)
+
+        self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+
+        self.assertEqual(self.server.events, [])
+        self.assertEqual(self.server.requests, [(0, 2), (200, 2), (400, 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
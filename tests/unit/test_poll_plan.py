@@ -0,0 +1,135 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import unittest
+from tedge_modbus.reader.poll_plan import PollPlan
+
+
+def register(number, **kwargs):
+    return {"number": number, "startbit": 0, "nobits": 16, **kwargs}
+
+
+class TestPollPlan(unittest.TestCase):
+    def setUp(self):
+        self.device = {
+            "name": "meter",
+            "registers": [
+                register(0),
+                register(1, pollinterval=60),
+                register(2, pollgroup="nameplate"),
+            ],
+            "coils": [{"number": 5, "pollgroup": "nameplate"}],
+        }
+        self.plan = PollPlan(self.device, 1, {"nameplate": 3600})
+
+    def test_groups_by_interval(self):
+        self.assertEqual(sorted(self.plan.groups), [1, 60, 3600])
+        self.assertEqual(
+            self.plan.groups[3600]["registers"], [register(2, pollgroup="nameplate")]
+        )
+        self.assertEqual(
+            self.plan.groups[3600]["coils"], [{"number": 5, "pollgroup": "nameplate"}]
+        )
+
+    def test_unknown_poll_group(self):
+        with self.assertRaises(ValueError):
+            PollPlan({"registers": [register(0, pollgroup="fast")]}, 1, {})
+
+    def test_groups_due_in_same_tick_are_merged(self):
+        """
+        GIVEN groups with different intervals
+        WHEN they become due at the same time
+        THEN their blocks are read together in one query model.
+        """
+        intervals = self.plan.due(0)
+        self.assertEqual(intervals, (1, 60, 3600))
+        view, poll_model, _ = self.plan.view(intervals)
+        self.assertEqual(len(view["registers"]), 3)
+        self.assertEqual(poll_model, ([[0, 1, 2]], [], [[5]], []))
+        self.assertEqual(self.plan.advance(intervals, 0), 1)
+
+        for now in range(1, 60):
+            self.assertEqual(self.plan.due(now), (1,))
+            self.assertEqual(self.plan.advance((1,), now), 1)
+
+        intervals = self.plan.due(60)
+        self.assertEqual(intervals, (1, 60))
+        _, poll_model, _ = self.plan.view(intervals)
+        self.assertEqual(poll_model, ([[0, 1]], [], [], []))
+
+    def test_device_without_definitions(self):
+        plan = PollPlan({"name": "empty"}, 5)
+        intervals = plan.due(0)
+        self.assertEqual(plan.view(intervals)[1], ([], [], [], []))
+        self.assertEqual(plan.advance(intervals, 0), 5)
+
+
+class TestPollPlanTiming(unittest.TestCase):
+    def test_fractional_interval(self):
+        plan = PollPlan({"name": "fast", "coils": [{"number": 1}]}, 0.1)
+        intervals = plan.due(0.0)
+        self.assertAlmostEqual(plan.advance(intervals, 0.0), 0.1)
+
+    def test_interval_too_short(self):
+        with self.assertRaises(ValueError):
+            PollPlan({"name": "fast"}, 0.001)
+        with self.assertRaises(ValueError):
+            PollPlan({"coils": [{"number": 1, "pollinterval": "1"}]}, 1)
+
+    def test_poll_duration_does_not_drift(self):
+        """
+        GIVEN a group polled every second
+        WHEN every poll takes 0.3 seconds
+        THEN the next poll is still due one second after the previous one.
+        """
+        plan = PollPlan({"name": "meter"}, 1)
+        self.assertAlmostEqual(plan.advance(plan.due(10.0), 10.0, 10.3), 0.7)
+        self.assertAlmostEqual(plan.advance(plan.due(11.0), 11.0, 11.3), 0.7)
+        self.assertEqual(plan.overruns[1], 0)
+        self.assertEqual(plan.lagging(), [])
+
+    def test_overrun_is_resynchronized(self):
+        """
+        GIVEN a group polled every 0.1 seconds
+        WHEN the polls take longer than the interval
+        THEN the missed polls are counted and not caught up with and the
+        achieved interval is reported as lagging.
+        """
+        plan = PollPlan({"name": "meter"}, 0.1)
+        now = 0.0
+        for _ in range(20):
+            delay = plan.advance(plan.due(now), now, now + 0.25)
+            self.assertEqual(delay, 0.0)
+            now += 0.25
+        self.assertEqual(plan.overruns[0.1], 19)
+        ((interval, achieved),) = plan.lagging()
+        self.assertEqual(interval, 0.1)
+        self.assertAlmostEqual(achieved, 0.25, places=2)
+
+
+class TestPollPlanDeferral(unittest.TestCase):
+    def test_deferred_blocks_are_read_first(self):
+        """
+        GIVEN a poll which only read the first of three blocks
+        WHEN the same groups are polled again
+        THEN the blocks start with the deferred ones, in round-robin order.
+        """
+        plan = PollPlan({"name": "meter"}, 1)
+        blocks = ["a", "b", "c"]
+
+        plan.defer((1,), 1, 3)
+        self.assertEqual(plan.deferred, 2)
+        self.assertEqual(plan.rotate((1,), blocks), ["b", "c", "a"])
+
+        plan.defer((1,), 2, 3)
+        self.assertEqual(plan.rotate((1,), blocks), ["a", "b", "c"])
+
+    def test_complete_poll_keeps_order(self):
+        plan = PollPlan({"name": "meter"}, 1)
+
+        plan.defer((1,), 3, 3)
+
+        self.assertEqual(plan.deferred, 0)
+        self.assertEqual(plan.rotate((1,), ["a", "b", "c"]), ["a", "b", "c"])
@@ -0,0 +1,186 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import json
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+from paho.mqtt.client import MQTT_ERR_NO_CONN, MQTT_ERR_QUEUE_SIZE, MQTT_ERR_SUCCESS
+from tedge_modbus.reader.publisher import PublishQueue
+
+ALARM = "te/device/meter///a/overheat"
+EVENT = "te/device/meter///e/door"
+MEASUREMENT = "te/device/meter///m/"
+OTHER_MEASUREMENT = "te/device/other///m/"
+TWIN = "te/device/meter///twin/c8y_ModbusDevice"
+COMMAND = "te/device/meter///cmd/modbus_SetRegister/1"
+REGISTRATION = "te/device/meter//"
+
+
+class TestPublishQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = PublishQueue(maxsize=3)
+        # publish manually instead of with the publisher thread
+        self.queue.client = MagicMock()
+        self.queue.client.publish.return_value.rc = MQTT_ERR_SUCCESS
+
+    def published(self):
+        while self.queue.publish_next(timeout=0):
+            pass
+        return [
+            (call.kwargs["topic"], call.kwargs["payload"])
+            for call in self.queue.client.publish.call_args_list
+        ]
+
+    def test_messages_are_published_by_priority(self):
+        """
+        GIVEN queued messages of all kinds
+        WHEN they are published
+        THEN registrations, alarms and command status go first,
+        then events, measurements and twin.
+        """
+        queue = PublishQueue(maxsize=10)
+        queue.client = self.queue.client
+        self.queue = queue
+        for topic in (TWIN, MEASUREMENT, EVENT, REGISTRATION, ALARM, COMMAND):
+            self.queue.put(topic, "{}")
+
+        self.assertEqual(
+            [topic for topic, _ in self.published()],
+            [REGISTRATION, ALARM, COMMAND, EVENT, MEASUREMENT, TWIN],
+        )
+
+    def test_full_queue_sheds_measurements(self):
+        """
+        GIVEN a full queue
+        WHEN more measurements are queued
+        THEN a measurement of a queued topic is merged into it
+        and a measurement of another topic is dropped.
+        """
+        self.queue.put(MEASUREMENT, json.dumps({"temp": {"a": 1}, "time": 1}))
+        self.queue.put(EVENT, "{}")
+        self.queue.put(TWIN, "{}")
+
+        self.assertTrue(
+            self.queue.put(MEASUREMENT, json.dumps({"temp": {"b": 2}, "time": 2}))
+        )
+        self.assertFalse(self.queue.put("te/device/other///m/", "{}"))
+
+        self.assertEqual(
+            self.queue.take_stats(),
+            {"queued": 3, "dropped": 1, "merged": 1, "failed": 0},
+        )
+        self.assertEqual(
+            json.loads(dict(self.published())[MEASUREMENT]),
+            {"temp": {"a": 1, "b": 2}, "time": 2},
+        )
+
+    def test_alarms_are_never_dropped(self):
+        """
+        GIVEN a full queue
+        WHEN alarms are queued
+        THEN the oldest measurement makes room for the first alarm
+        and further alarms exceed the bound instead of being dropped.
+        """
+        self.queue.put(MEASUREMENT, "{}")
+        self.queue.put(EVENT, "{}")
+        self.queue.put(TWIN, "{}")
+
+        self.assertTrue(self.queue.put(ALARM, '{"n": 1}'))
+        self.assertTrue(self.queue.put(ALARM, '{"n": 2}'))
+
+        self.assertEqual(self.queue.depth(), 4)
+        self.assertEqual(
+            self.published(),
+            [(ALARM, '{"n": 1}'), (ALARM, '{"n": 2}'), (EVENT, "{}"), (TWIN, "{}")],
+        )
+
+    def test_publication_is_awaited_for_every_qos(self):
+        self.queue.put(TWIN, "{}", retain=True, qos=1)
+        self.queue.put(MEASUREMENT, "{}")
+
+        self.published()
+
+        info = self.queue.client.publish.return_value
+        self.assertEqual(info.wait_for_publish.call_count, 2)
+
+    def test_slow_broker_sheds_qos_0_measurements(self):
+        """
+        GIVEN a broker connection which does not take a QoS 0 message
+        WHEN more measurements are queued than the queue holds
+        THEN the publisher waits for the message instead of handing on
+        the others to the MQTT client, so the queue fills and sheds measurements.
+        """
+        written = threading.Event()
+        info = MagicMock(rc=MQTT_ERR_SUCCESS)
+        info.wait_for_publish.side_effect = lambda timeout: written.wait(5)
+        client = MagicMock()
+        client.publish.return_value = info
+        self.queue.set_client(client)
+        self.queue.put(MEASUREMENT, json.dumps({"temp": {"a": 0}}))
+        deadline = time.monotonic() + 5
+        while not client.publish.called and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        for value in range(5):
+            self.queue.put(MEASUREMENT, json.dumps({"temp": {"a": value}}))
+            self.queue.put(OTHER_MEASUREMENT, json.dumps({"temp": {"a": value}}))
+        stats = self.queue.take_stats()
+        client.publish.assert_called_once()
+        written.set()
+
+        self.assertEqual(stats["queued"], 3)
+        self.assertGreater(stats["dropped"] + stats["merged"], 0)
+
+    @patch("tedge_modbus.reader.publisher.time.sleep")
+    def test_message_is_requeued_while_not_connected(self, mock_sleep):
+        """
+        GIVEN a client which is not connected to the broker
+        WHEN a QoS 0 message is published
+        THEN it is queued again and published once the client is connected.
+        """
+        disconnected = MagicMock(rc=MQTT_ERR_NO_CONN)
+        connected = MagicMock(rc=MQTT_ERR_SUCCESS)
+        self.queue.client.publish.side_effect = [disconnected, connected]
+        self.queue.put(MEASUREMENT, "{}")
+
+        self.assertEqual(self.published(), [(MEASUREMENT, "{}")] * 2)
+        mock_sleep.assert_called_once()
+        self.assertEqual(self.queue.depth(), 0)
+
+    def test_failed_publish_is_counted(self):
+        self.queue.client.publish.return_value.rc = MQTT_ERR_QUEUE_SIZE
+        self.queue.put(EVENT, "{}")
+
+        self.published()
+
+        self.assertEqual(self.queue.take_stats()["failed"], 1)
+
+    def test_queue_without_client_does_not_block(self):
+        """
+        GIVEN a queue which is not connected to the broker yet
+        WHEN messages are queued
+        THEN they are kept without blocking and published once a client is set.
+        """
+        queue = PublishQueue()
+        queue.put(MEASUREMENT, "{}")
+        self.assertFalse(queue.publish_next(timeout=0))
+
+        client = MagicMock()
+        client.publish.return_value.rc = MQTT_ERR_SUCCESS
+        queue.set_client(client)
+        deadline = time.monotonic() + 5
+        while not client.publish.called and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        client.publish.assert_called_once_with(
+            topic=MEASUREMENT, payload="{}", retain=False, qos=0
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
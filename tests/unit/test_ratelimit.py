@@ -0,0 +1,94 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import json
+import unittest
+from tedge_modbus.reader.ratelimit import RateLimiter
+
+MEASUREMENT = "te/device/meter///m/"
+ALARM = "te/device/meter///a/overheat"
+EVENT = "te/device/meter///e/door"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(clock=self.clock)
+
+    def test_measurements_over_limit_are_merged(self):
+        """
+        GIVEN a device limited to 1 message per second
+        WHEN it sends several measurements within a second
+        THEN the first one is published, the others are merged and published
+        together once the bucket refilled, and the merged ones are counted.
+        """
+        self.limiter.set_device("meter", {"maxmessagerate": 1})
+
+        self.assertIsNotNone(self.limiter.admit(MEASUREMENT, '{"a": {"a": 1}}'))
+        self.assertIsNone(self.limiter.admit(MEASUREMENT, '{"b": {"b": 1}}'))
+        self.assertIsNone(self.limiter.admit(MEASUREMENT, '{"b": {"b": 2}}'))
+        self.assertEqual(self.limiter.release(), [])
+
+        self.clock.now = 1.0
+        ((topic, payload),) = self.limiter.release()
+
+        self.assertEqual(topic, MEASUREMENT)
+        self.assertEqual(json.loads(payload), {"b": {"b": 2}})
+        self.assertEqual(self.limiter.take_stats(), {"meter": 1})
+
+    def test_global_byte_limit(self):
+        """
+        GIVEN a limit of 10 bytes per second for all devices
+        WHEN two devices send measurements
+        THEN they share the limit.
+        """
+        self.limiter.configure({"maxbyterate": 10})
+
+        self.assertIsNotNone(self.limiter.admit(MEASUREMENT, '{"temp": {"t": 20}}'))
+        self.assertIsNone(
+            self.limiter.admit("te/device/other///m/", '{"temp": {"t": 21}}')
+        )
+
+    def test_alarms_are_exempt(self):
+        """
+        GIVEN a device which used up its limit
+        WHEN it raises an alarm or an event
+        THEN both are published, only the event takes tokens.
+        """
+        self.limiter.set_device("meter", {"maxmessagerate": 1})
+        self.limiter.admit(MEASUREMENT, "{}")
+
+        self.assertEqual(
+            self.limiter.admit(ALARM, '{"text": "hot"}'), '{"text": "hot"}'
+        )
+        self.assertEqual(self.limiter.admit(EVENT, "{}"), "{}")
+        self.assertEqual(self.limiter.device_buckets["meter"][0][0].tokens, -1)
+
+    def test_unlimited_devices_are_not_held_back(self):
+        for _ in range(100):
+            self.assertIsNotNone(self.limiter.admit(MEASUREMENT, "{}"))
+
+    def test_removed_device_drops_held_measurements(self):
+        self.limiter.set_device("meter", {"maxmessagerate": 1})
+        self.limiter.admit(MEASUREMENT, "{}")
+        self.limiter.admit(MEASUREMENT, "{}")
+
+        self.limiter.remove_device("meter")
+        self.clock.now = 10.0
+
+        self.assertEqual(self.limiter.release(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
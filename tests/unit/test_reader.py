@@ -3,9 +3,18 @@ import sys
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 sys.path.insert(0, parent_dir)
+import json
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from watchdog.events import FileMovedEvent
+from tedge_modbus.reader.holes import AddressHoles
 from tedge_modbus.reader.reader import ModbusPoll
+from tedge_modbus.reader.mapper import ModbusMapper
 
 
 class TestReaderPollingInterval(unittest.TestCase):
@@ -36,7 +45,7 @@ class TestReaderPollingInterval(unittest.TestCase):
             "pollinterval": 1,  # This should be used
         }
 
-        mock_poll_model = MagicMock()
+        poll_plan = self.poll._build_poll_plan(device_config)
         mock_mapper = MagicMock()
 
         # WHEN poll_device is called
@@ -44,15 +53,15 @@ class TestReaderPollingInterval(unittest.TestCase):
         with patch.object(
             self.poll,
             "get_data_from_device",
-            return_value=(None, None, None, None, None),
+            return_value=({}, {}, {}, {}, None, {}),
         ):
-            self.poll.poll_device(device_config, mock_poll_model, mock_mapper)
+            self.poll.poll_device(device_config, poll_plan, mock_mapper)
 
         # THEN the scheduler should be called with the device's interval
         self.poll.poll_scheduler.enter.assert_called_once()
         call_args, _ = self.poll.poll_scheduler.enter.call_args
         # The first argument to enter() is the delay
-        self.assertEqual(call_args[0], 1)
+        self.assertAlmostEqual(call_args[0], 1, places=2)
 
     def test_uses_global_poll_interval_as_fallback(self):
         """
@@ -65,21 +74,21 @@ class TestReaderPollingInterval(unittest.TestCase):
         # AND a device without its own poll_interval
         device_config = {"name": "normal_poller"}
 
-        mock_poll_model = MagicMock()
+        poll_plan = self.poll._build_poll_plan(device_config)
         mock_mapper = MagicMock()
 
         # WHEN poll_device is called
         with patch.object(
             self.poll,
             "get_data_from_device",
-            return_value=(None, None, None, None, None),
+            return_value=({}, {}, {}, {}, None, {}),
         ):
-            self.poll.poll_device(device_config, mock_poll_model, mock_mapper)
+            self.poll.poll_device(device_config, poll_plan, mock_mapper)
 
         # THEN the scheduler should be called with the global interval
         self.poll.poll_scheduler.enter.assert_called_once()
         call_args, _ = self.poll.poll_scheduler.enter.call_args
-        self.assertEqual(call_args[0], 5)
+        self.assertAlmostEqual(call_args[0], 5, places=2)
 
     # Todo: Implement the following tests
     def test_defaults_to_no_measurement_combination(self):
@@ -90,3 +99,994 @@ class TestReaderPollingInterval(unittest.TestCase):
 
     def test_device_specific_measurement_combination(self):
         pass
+
+
+class TestReaderBlockChangeDetection(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.poll_scheduler = MagicMock()
+        self.poll.base_config = {"modbus": {"pollinterval": 5}}
+        self.poll.send_tedge_message = MagicMock()
+        self.device = {
+            "name": "static_device",
+            "registers": [
+                {
+                    "number": 3,
+                    "startbit": 0,
+                    "nobits": 16,
+                    "measurementmapping": {"templatestring": '{"a": %%}'},
+                },
+                {
+                    "number": 4,
+                    "startbit": 0,
+                    "nobits": 16,
+                    "on_change": True,
+                    "measurementmapping": {"templatestring": '{"b": %%}'},
+                },
+            ],
+            "coils": [
+                {
+                    "number": 2,
+                    "eventmapping": {"text": "changed", "type": "TestEvent"},
+                }
+            ],
+        }
+
+    def _poll(self, mapper, hr_results, coil_results):
+        poll_plan = self.poll._build_poll_plan(self.device)
+        with patch.object(
+            self.poll,
+            "get_data_from_device",
+            return_value=(coil_results, {}, hr_results, {}, None, {}),
+        ):
+            self.poll.poll_device(self.device, poll_plan, mapper)
+        topics = [
+            call.args[0].topic for call in self.poll.send_tedge_message.call_args_list
+        ]
+        self.poll.send_tedge_message.reset_mock()
+        return topics
+
+    def test_unchanged_blocks_are_not_decoded(self):
+        """
+        GIVEN a device whose raw register and coil values do not change
+        WHEN it is polled twice
+        THEN the registers are only decoded once, the periodic measurement is
+        replayed and on_change measurements and events are not sent again.
+        """
+        mapper = ModbusMapper(self.device)
+        with patch.object(
+            mapper, "map_register", wraps=mapper.map_register
+        ) as map_register:
+            topics = self._poll(mapper, {3: 10, 4: 20}, {2: True})
+            self.assertEqual(map_register.call_count, 2)
+            self.assertEqual(
+                topics,
+                [
+                    "te/device/static_device///m/",
+                    "te/device/static_device///m/",
+                    "te/device/static_device///e/TestEvent",
+                ],
+            )
+
+            topics = self._poll(mapper, {3: 10, 4: 20}, {2: True})
+            self.assertEqual(map_register.call_count, 2)
+            self.assertEqual(topics, ["te/device/static_device///m/"])
+
+    def test_changed_block_is_decoded(self):
+        """
+        GIVEN a device whose register block changes between two polls
+        WHEN it is polled again
+        THEN all registers of that block are decoded and mapped.
+        """
+        mapper = ModbusMapper(self.device)
+        self._poll(mapper, {3: 10, 4: 20}, {2: True})
+        with patch.object(
+            mapper, "map_register", wraps=mapper.map_register
+        ) as map_register:
+            topics = self._poll(mapper, {3: 10, 4: 21}, {2: True})
+            self.assertEqual(map_register.call_count, 2)
+        self.assertEqual(
+            topics, ["te/device/static_device///m/", "te/device/static_device///m/"]
+        )
+
+
+class FakeHoleClient:
+    """Client of a device without holding register 4"""
+
+    def __init__(self, holes=(4,)):
+        self.holes = holes
+        self.requests = []
+
+    def read_holding_registers(self, address, count, slave):
+        self.requests.append((address, count))
+        if any(address <= hole < address + count for hole in self.holes):
+            return ExceptionResponse(3, ModbusExceptions.IllegalAddress)
+        return ReadHoldingRegistersResponse(list(range(address, address + count)))
+
+    def close(self):
+        pass
+
+
+class TestReaderAddressHoles(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.base_config = {"modbus": {"pollinterval": 5}}
+        self.device = {
+            "name": "holey",
+            "protocol": "TCP",
+            "ip": "127.0.0.1",
+            "port": 502,
+            "address": 1,
+            "registers": [
+                {"number": number, "startbit": 0, "nobits": 16}
+                for number in range(0, 8)
+            ],
+        }
+        self.client = FakeHoleClient()
+        self.poll.get_modbus_client = MagicMock(return_value=self.client)
+
+    def test_bisects_block_and_plans_around_hole(self):
+        """
+        GIVEN a device which rejects reading holding register 4
+        WHEN a block containing it is read
+        THEN the block is bisected, all other registers are returned and the
+        next poll plan reads around the learned hole.
+        """
+        plan = self.poll._build_poll_plan(self.device)
+        view, poll_model, _ = plan.view(plan.due(0))
+        self.assertEqual(poll_model[0], [list(range(0, 8))])
+
+        _, _, hr_results, _, error, _ = self.poll.get_data_from_device(view, poll_model)
+        self.assertIsNone(error)
+        self.assertEqual(sorted(hr_results), [0, 1, 2, 3, 5, 6, 7])
+        self.assertEqual(self.poll.address_holes.for_device(self.device), {"hr": {4}})
+
+        view, poll_model, decode_plan = plan.view(plan.due(0))
+        self.assertEqual(poll_model[0], [[0, 1, 2, 3], [5, 6, 7]])
+        self.assertNotIn(4, [step.address for step in decode_plan["registers"]])
+
+        self.client.requests.clear()
+        self.poll.get_data_from_device(view, poll_model)
+        self.assertEqual(self.client.requests, [(0, 4), (5, 3)])
+
+    def test_holes_are_stored(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "layout.json")
+            self.poll.address_holes.open(path)
+            plan = self.poll._build_poll_plan(self.device)
+            self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+
+            holes = AddressHoles(path)
+            self.assertEqual(holes.for_device(self.device), {"hr": {4}})
+
+    def test_expired_hole_is_probed_again(self):
+        """
+        GIVEN a hole learned more than holettl seconds ago
+        WHEN the device is polled
+        THEN the hole is forgotten and the address is read again.
+        """
+        self.poll.address_holes.ttl = 60
+        plan = self.poll._build_poll_plan(self.device)
+        self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+        self.client.holes = ()
+        self.poll.poll_scheduler = MagicMock()
+        self.poll.send_tedge_message = MagicMock()
+
+        with patch(
+            "tedge_modbus.reader.holes.time.time", return_value=time.time() + 61
+        ):
+            self.client.requests.clear()
+            self.poll.poll_device(self.device, plan, ModbusMapper(self.device))
+
+        self.assertEqual(self.client.requests, [(0, 8)])
+        self.assertEqual(self.poll.address_holes.for_device(self.device), {"hr": set()})
+
+    def test_stored_holes_of_a_changed_device_are_forgotten(self):
+        """
+        GIVEN stored holes of a device
+        WHEN the reader starts the device with a changed definition
+        THEN the holes are forgotten, also in the stored file.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "layout.json")
+            self.poll.address_holes.open(path)
+            self.poll.poll_device = MagicMock()
+            self.poll._start_polling_device(self.device)
+            plan = self.poll.poll_plans["holey"]
+            self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+
+            self.poll.address_holes = AddressHoles(path)
+            self.poll._start_polling_device(self.device)
+            self.assertEqual(
+                self.poll.address_holes.for_device(self.device), {"hr": {4}}
+            )
+            self.poll._start_polling_device(dict(self.device, pollinterval=1))
+
+            self.assertEqual(
+                self.poll.address_holes.for_device(self.device), {"hr": set()}
+            )
+            self.assertEqual(AddressHoles(path).for_device(self.device), {})
+
+
+class SlowClient(FakeHoleClient):
+    """Client of a device which takes 50ms per request"""
+
+    def __init__(self):
+        super().__init__(holes=())
+        self.params = MagicMock()
+
+    def read_holding_registers(self, address, count, slave):
+        time.sleep(0.05)
+        return super().read_holding_registers(address, count, slave)
+
+
+class TestReaderCycleBudget(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.base_config = {
+            "modbus": {"pollinterval": 5, "timeout": 2, "retries": 1},
+            "serial": {"timeout": 0.5},
+        }
+        self.poll.send_tedge_message = MagicMock()
+        self.device = {
+            "name": "slow",
+            "protocol": "TCP",
+            "ip": "127.0.0.1",
+            "port": 502,
+            "address": 1,
+            "cyclebudget": 0.01,
+            "timeout": 0.3,
+            "registers": [
+                {
+                    "number": number,
+                    "startbit": 0,
+                    "nobits": 16,
+                    "measurementmapping": {"templatestring": f'{{"r{number}": %%}}'},
+                }
+                for number in (0, 100, 200)
+            ],
+        }
+        self.client = SlowClient()
+        self.poll.get_modbus_client = MagicMock(return_value=self.client)
+
+    def test_blocks_over_budget_are_deferred_round_robin(self):
+        """
+        GIVEN a device with three blocks and a cycle budget shorter than one request
+        WHEN it is polled repeatedly
+        THEN every poll reads one block, starting with the blocks deferred by the
+        previous poll, so all blocks are read in turns.
+        """
+        plan = self.poll._build_poll_plan(self.device)
+        view, poll_model, _ = plan.view(plan.due(0))
+
+        for _ in range(4):
+            self.poll.get_data_from_device(view, poll_model, plan, plan.due(0))
+
+        self.assertEqual(self.client.requests, [(0, 1), (100, 1), (200, 1), (0, 1)])
+        self.assertEqual(plan.deferred, 2)
+
+    def test_partial_results_are_published(self):
+        """
+        GIVEN a device whose cycle budget is used up by the first block
+        WHEN it is polled
+        THEN the registers of the read block are published, the others are not.
+        """
+        plan = self.poll._build_poll_plan(self.device)
+        self.poll.poll_scheduler = MagicMock()
+
+        self.poll.poll_device(self.device, plan, ModbusMapper(self.device))
+
+        payloads = [
+            json.loads(call.args[0].data)
+            for call in self.poll.send_tedge_message.call_args_list
+        ]
+        self.assertEqual(payloads, [{"r0": 0}])
+
+    def test_timeout_and_retries_of_device_and_bus(self):
+        """
+        GIVEN timeouts set for the device and retries set for all devices
+        WHEN the device is polled
+        THEN its client uses the timeout of the device and the default retries
+        and an RTU device without timeout uses the timeout of the serial bus.
+        """
+        plan = self.poll._build_poll_plan(self.device)
+        self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+
+        self.assertEqual(self.client.params.timeout, 0.3)
+        self.assertEqual(self.client.params.retries, 1)
+        rtu = {"name": "rtu", "protocol": "RTU", "port": "/dev/ttyS0"}
+        self.assertEqual(self.poll._device_setting(rtu, "timeout"), 0.5)
+
+
+class TestReaderPooledConnections(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.base_config = {"modbus": {"pollinterval": 5}}
+        self.poll.send_tedge_message = MagicMock()
+        self.device = {
+            "name": "pooled",
+            "protocol": "TCP",
+            "ip": "127.0.0.1",
+            "port": 502,
+            "address": 1,
+            "registers": [
+                {"number": 0, "startbit": 0, "nobits": 16, "name": "setpoint"}
+            ],
+        }
+        self.poll.devices = [self.device]
+        self.client = FakeHoleClient(holes=())
+        self.client.write_register = MagicMock(
+            return_value=MagicMock(isError=MagicMock(return_value=False))
+        )
+        self.poll.get_modbus_client = MagicMock(return_value=self.client)
+
+    def test_write_command_uses_polling_connection(self):
+        """
+        GIVEN a device which has been polled
+        WHEN a modbus_SetRegister command for it is executed
+        THEN the write is sent in-process with the pooled client of its bus.
+        """
+        plan = self.poll._build_poll_plan(self.device)
+        self.poll.get_data_from_device(*plan.view(plan.due(0))[:2])
+
+        payload = {"status": "executing", "metrics": [{"name": "setpoint", "value": 7}]}
+        self.poll._handle_subscribed_message(
+            "te/device/pooled///cmd/modbus_SetRegister/c8y-mapper-1",
+            json.dumps(payload),
+        )
+        self.assertTrue(self.poll.commands.join(timeout=5))
+
+        self.poll.get_modbus_client.assert_called_once()
+        self.client.write_register.assert_called_once_with(address=0, value=7, slave=1)
+        message = self.poll.send_tedge_message.call_args[0][0]
+        self.assertEqual(json.loads(message.data)["status"], "successful")
+
+    def test_failed_write_is_reported(self):
+        self.client.write_register.side_effect = ConnectionError("gone")
+        payload = {"status": "executing", "metrics": [{"name": "setpoint", "value": 7}]}
+        self.poll._handle_subscribed_message(
+            "te/device/pooled///cmd/modbus_SetRegister/c8y-mapper-1",
+            json.dumps(payload),
+        )
+        self.assertTrue(self.poll.commands.join(timeout=5))
+
+        message = self.poll.send_tedge_message.call_args[0][0]
+        self.assertEqual(json.loads(message.data)["status"], "failed")
+
+    def test_full_queue_rejects_command(self):
+        """
+        GIVEN a command queue which is full
+        WHEN another command is received
+        THEN it is rejected with a failed status instead of being queued.
+        """
+        self.poll.commands.configure(1, 1)
+        release = threading.Event()
+        self.poll.commands.submit("busy", release.wait)
+        payload = {"status": "executing", "metrics": [{"name": "setpoint", "value": 7}]}
+        self.poll._handle_subscribed_message(
+            "te/device/pooled///cmd/modbus_SetRegister/c8y-mapper-1",
+            json.dumps(payload),
+        )
+        release.set()
+
+        message = self.poll.send_tedge_message.call_args[0][0]
+        self.assertEqual(json.loads(message.data)["status"], "failed")
+        self.assertIn("queue is full", json.loads(message.data)["reason"])
+        self.client.write_register.assert_not_called()
+
+    def test_serial_settings_of_a_shared_port_must_match(self):
+        """
+        GIVEN two RTU devices on the same serial port with different baudrates
+        WHEN they are started
+        THEN the first device is polled, the second is neither polled
+        nor written with the client of the first device.
+        """
+        serial = {"protocol": "RTU", "port": "/dev/ttyUSB0", "stopbits": 1}
+        serial.update(parity="N", databits=8, address=1)
+        first = dict(serial, name="first", baudrate=9600)
+        second = dict(serial, name="second", baudrate=19200, address=2)
+        self.poll.devices = [first, second]
+        self.poll.poll_device = MagicMock()
+
+        self.poll._plan_buses()
+        for device in (first, second):
+            self.poll._start_polling_device(device)
+
+        self.assertEqual(list(self.poll.poll_plans), ["first"])
+        with self.assertRaises(ValueError):
+            with self.poll._session(second):
+                pass
+        self.poll.get_modbus_client.assert_not_called()
+
+
+class TestReaderCachedBitfieldWrites(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.poll_scheduler = MagicMock()
+        self.poll.base_config = {"modbus": {"pollinterval": 5, "writecacheage": 10}}
+        self.poll.send_tedge_message = MagicMock()
+        self.device = {
+            "name": "bits",
+            "protocol": "TCP",
+            "ip": "127.0.0.1",
+            "port": 502,
+            "address": 1,
+            "registers": [{"number": 0, "startbit": 4, "nobits": 4, "name": "mode"}],
+        }
+        self.poll.devices = [self.device]
+        self.client = FakeHoleClient(holes=())
+        self.client.mask_write_register = MagicMock(
+            return_value=ExceptionResponse(22, ModbusExceptions.IllegalFunction)
+        )
+        self.client.write_register = MagicMock(
+            return_value=MagicMock(isError=MagicMock(return_value=False))
+        )
+        self.poll.get_modbus_client = MagicMock(return_value=self.client)
+
+    def test_bitfield_write_uses_polled_value(self):
+        """
+        GIVEN a device without Mask Write Register support which was just polled
+        WHEN a bitfield of a polled register is written
+        THEN the polled value is used instead of reading the register again.
+        """
+        plan = self.poll._build_poll_plan(self.device)
+        self.poll.poll_device(self.device, plan, ModbusMapper(self.device))
+        self.client.requests.clear()
+
+        payload = {"status": "executing", "metrics": [{"name": "mode", "value": 5}]}
+        self.poll._process_write_command(
+            "modbus_SetRegister",
+            payload,
+            "te/device/bits///cmd/modbus_SetRegister/c8y-mapper-1",
+        )
+
+        self.assertEqual(payload["status"], "successful")
+        self.assertEqual(self.client.requests, [])
+        self.client.write_register.assert_called_once_with(
+            address=0, value=0x50, slave=1
+        )
+        self.assertEqual(
+            self.poll.write_capabilities,
+            {"TCP://127.0.0.1:502/1": {"mask_write": False}},
+        )
+
+
+class TestReaderWriteConfirmation(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.poll_scheduler = MagicMock()
+        self.poll.base_config = {"modbus": {"pollinterval": 5, "writeconfirm": True}}
+        self.poll.send_tedge_message = MagicMock()
+        self.device = {
+            "name": "confirmed",
+            "protocol": "TCP",
+            "ip": "127.0.0.1",
+            "port": 502,
+            "address": 1,
+            "registers": [
+                {
+                    "number": 0,
+                    "startbit": 0,
+                    "nobits": 16,
+                    "signed": False,
+                    "name": "setpoint",
+                    "on_change": True,
+                    "measurementmapping": {"templatestring": '{"setpoint": %%}'},
+                }
+            ],
+        }
+        self.poll.devices = [self.device]
+        self.client = FakeHoleClient(holes=())
+        self.client.readwrite_registers = MagicMock(
+            return_value=ReadHoldingRegistersResponse([7])
+        )
+        self.poll.get_modbus_client = MagicMock(return_value=self.client)
+
+    def test_confirmed_value_is_published_once(self):
+        """
+        GIVEN a device with write confirmation and an on_change register
+        WHEN the register is written
+        THEN the confirmed value is published right away and the next poll
+        reading the same value does not publish it again.
+        """
+        self.poll.mappers = {"confirmed": ModbusMapper(self.device)}
+        payload = {"status": "executing", "metrics": [{"name": "setpoint", "value": 7}]}
+        self.poll._process_write_command(
+            "modbus_SetRegister",
+            payload,
+            "te/device/confirmed///cmd/modbus_SetRegister/c8y-mapper-1",
+        )
+
+        self.assertEqual(payload["status"], "successful")
+        measurements = [
+            call[0][0]
+            for call in self.poll.send_tedge_message.call_args_list
+            if "/m/" in call[0][0].topic
+        ]
+        self.assertEqual(len(measurements), 1)
+        self.assertEqual(json.loads(measurements[0].data), {"setpoint": 7})
+
+        self.poll.send_tedge_message.reset_mock()
+        self.client.read_holding_registers = MagicMock(
+            return_value=ReadHoldingRegistersResponse([7])
+        )
+        plan = self.poll._build_poll_plan(self.device)
+        self.poll.poll_device(self.device, plan, self.poll.mappers["confirmed"])
+        self.poll.send_tedge_message.assert_not_called()
+
+    def test_confirmed_value_is_mapped_under_the_mapper_lock(self):
+        """
+        GIVEN a device which may be polled at the same time
+        WHEN a confirmed value is mapped on a command worker
+        THEN the mapper is locked while it is mapped.
+        """
+        mapper = ModbusMapper(self.device)
+        self.poll.mappers = {"confirmed": mapper}
+        locked = []
+        self.poll._map_registers = MagicMock(
+            side_effect=lambda *args: locked.append(mapper.lock.locked())
+        )
+
+        self.poll._publish_confirmed(self.device, "hr", {0: 7})
+
+        self.assertEqual(locked, [True])
+        self.assertFalse(mapper.lock.locked())
+
+
+class TestReaderConfigWatcher(unittest.TestCase):
+
+    def test_atomically_replaced_config_is_reloaded(self):
+        """
+        GIVEN the configuration file watcher
+        WHEN devices.toml is replaced by renaming a temporary file onto it
+        THEN the configuration is reloaded once, other moves are ignored.
+        """
+        poller = MagicMock()
+        handler = ModbusPoll.ConfigFileChangedHandler(poller)
+
+        handler.on_moved(FileMovedEvent("/cfg/tmpab12cd", "/cfg/devices.toml"))
+        handler.on_moved(FileMovedEvent("/cfg/devices.toml", "/cfg/devices.bak"))
+
+        poller.reload_config.assert_called_once_with("/cfg/devices.toml")
+
+    def test_unchanged_config_is_not_reread(self):
+        """
+        GIVEN a configuration which was read
+        WHEN several events report a change but the files did not change
+        THEN the configuration is not reread again.
+        """
+        with tempfile.TemporaryDirectory() as config_dir:
+            for name in ("modbus.toml", "devices.toml"):
+                with open(os.path.join(config_dir, name), "w", encoding="utf8"):
+                    pass
+            poll = ModbusPoll(config_dir=config_dir)
+            poll.loaded_versions = poll.config_versions()
+
+            with patch.object(poll, "reread_config") as mock_reread:
+                poll.reload_config(os.path.join(config_dir, "devices.toml"))
+                poll.reload_config()
+                mock_reread.assert_not_called()
+
+                with open(
+                    os.path.join(config_dir, "devices.toml"), "w", encoding="utf8"
+                ) as file:
+                    file.write("[[device]]\n")
+                poll.reload_config()
+                mock_reread.assert_called_once()
+
+    def test_change_notification_reloads_in_worker(self):
+        """
+        GIVEN a running reader
+        WHEN the config store notifies a change of devices.toml
+        THEN the configuration is reloaded by a command worker.
+        """
+        poll = ModbusPoll(config_dir="/cfg")
+        poll.commands = MagicMock()
+
+        poll._handle_subscribed_message(
+            "tedge-modbus-plugin/config/changed",
+            json.dumps({"file": "devices.toml", "version": 3}),
+        )
+
+        poll.commands.submit.assert_called_once_with(
+            "config", poll.reload_config, "/cfg/devices.toml"
+        )
+
+
+class TestReaderDeviceFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_dir = self.tmpdir.name
+        self.devices_dir = os.path.join(self.config_dir, "devices.d")
+        os.mkdir(self.devices_dir)
+        self.write(
+            "modbus.toml",
+            '[modbus]\npollinterval = 2\nloglevel = "INFO"\n[serial]\nbaudrate = 9600\n',
+        )
+        self.write("devices.toml", self.device_toml("main", "[[device]]\n"))
+        self.write("devices.d/meter1.toml", self.device_toml("meter1"))
+        self.write("devices.d/meter2.toml", self.device_toml("meter2"))
+
+        self.poll = ModbusPoll(config_dir=self.config_dir)
+        self.poll.poll_scheduler = MagicMock()
+        self.poll.poll_scheduler.queue = []
+        with patch.object(self.poll, "connect_to_tedge"), patch(
+            "tedge_modbus.reader.reader.time.sleep"
+        ), patch.object(self.poll, "poll_device"):
+            self.poll.reread_config()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.config_dir, name), "w", encoding="utf8") as file:
+            file.write(content)
+        # a new modification time for every write
+        mtime = os.stat(os.path.join(self.config_dir, name)).st_mtime_ns
+        self.mtime = max(getattr(self, "mtime", 0), mtime) + 1_000_000_000
+        os.utime(os.path.join(self.config_dir, name), ns=(self.mtime, self.mtime))
+
+    @staticmethod
+    def device_toml(name, header="", number=0):
+        return (
+            f'{header}name = "{name}"\nprotocol = "TCP"\nip = "127.0.0.1"\n'
+            f"port = 502\naddress = 1\n"
+            f'[[{"device." if header else ""}registers]]\nnumber = {number}\n'
+            f'startbit = 0\nnobits = 16\nsigned = false\nname = "value"\n'
+        )
+
+    def test_device_files_are_merged(self):
+        """
+        GIVEN devices.toml and a devices directory with one device per file
+        WHEN the configuration is read
+        THEN the devices of all files are polled.
+        """
+        self.assertEqual(
+            [device["name"] for device in self.poll.devices],
+            ["main", "meter1", "meter2"],
+        )
+        self.assertEqual(set(self.poll.poll_plans), {"main", "meter1", "meter2"})
+
+    def test_changed_device_file_reschedules_only_its_device(self):
+        """
+        GIVEN polled devices of several device files
+        WHEN one device file changes
+        THEN only the device of that file is rescheduled.
+        """
+        plans = dict(self.poll.poll_plans)
+        self.write("devices.d/meter2.toml", self.device_toml("meter2", number=7))
+
+        with patch.object(self.poll, "poll_device") as mock_poll:
+            self.poll.reload_device_file(os.path.join(self.devices_dir, "meter2.toml"))
+
+        self.assertEqual(mock_poll.call_count, 1)
+        self.assertEqual(mock_poll.call_args[0][0]["name"], "meter2")
+        self.assertTrue(plans["meter2"].stopped)
+        self.assertFalse(plans["meter1"].stopped)
+        self.assertIs(self.poll.poll_plans["main"], plans["main"])
+        meter2 = self.poll.device_index.device("meter2")
+        self.assertEqual(meter2["registers"][0]["number"], 7)
+
+    def test_removed_device_file_stops_its_device(self):
+        """
+        GIVEN polled devices of several device files
+        WHEN a device file is deleted
+        THEN its device is not polled anymore, the others are not affected.
+        """
+        plan = self.poll.poll_plans["meter1"]
+        os.remove(os.path.join(self.devices_dir, "meter1.toml"))
+
+        with patch.object(self.poll, "poll_device") as mock_poll:
+            self.poll.reload_device_file(os.path.join(self.devices_dir, "meter1.toml"))
+
+        mock_poll.assert_not_called()
+        self.assertTrue(plan.stopped)
+        self.assertEqual(
+            [device["name"] for device in self.poll.devices], ["main", "meter2"]
+        )
+
+    def test_unchanged_device_file_is_not_reloaded(self):
+        """
+        GIVEN polled devices of several device files
+        WHEN an event reports a device file which did not change
+        THEN nothing is rescheduled.
+        """
+        with patch.object(self.poll, "poll_device") as mock_poll:
+            self.poll.reload_device_file(os.path.join(self.devices_dir, "meter1.toml"))
+
+        mock_poll.assert_not_called()
+
+
+class TestReaderCompiledConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_dir = self.tmpdir.name
+        self.cache = os.path.join(self.config_dir, "cache", "compiled.pickle")
+        self.write(
+            "modbus.toml",
+            f'[modbus]\npollinterval = 2\nloglevel = "INFO"\n'
+            f'compiledcache = "{self.cache}"\n[serial]\nbaudrate = 9600\n',
+        )
+        self.write(
+            "devices.toml",
+            '[[device]]\nname = "meter"\nprotocol = "TCP"\nip = "127.0.0.1"\n'
+            "port = 502\naddress = 1\n[[device.registers]]\nnumber = 0\n"
+            'startbit = 0\nnobits = 16\nsigned = false\nname = "value"\n',
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.config_dir, name), "w", encoding="utf8") as file:
+            file.write(content)
+
+    def start(self):
+        poll = ModbusPoll(config_dir=self.config_dir)
+        poll.poll_scheduler = MagicMock()
+        poll.poll_scheduler.queue = []
+        with patch.object(poll, "connect_to_tedge"), patch(
+            "tedge_modbus.reader.reader.time.sleep"
+        ), patch.object(poll, "poll_device"):
+            poll.reread_config()
+        return poll
+
+    def test_unchanged_config_is_loaded_compiled(self):
+        """
+        GIVEN a compiled configuration cache
+        WHEN the reader starts again with unchanged configuration files
+        THEN devices.toml is not parsed and the compiled poll plans are used.
+        """
+        self.start()
+        self.assertTrue(os.path.exists(self.cache))
+
+        with patch.object(ModbusPoll, "read_device_definition") as mock_read, patch(
+            "tedge_modbus.reader.reader.PollPlan"
+        ) as mock_plan:
+            poll = self.start()
+
+        mock_read.assert_not_called()
+        mock_plan.assert_not_called()
+        self.assertEqual([device["name"] for device in poll.devices], ["meter"])
+        plan = poll.poll_plans["meter"]
+        self.assertIs(plan.holes, poll.address_holes.for_device(poll.devices[0]))
+        self.assertIs(plan.device, poll.devices[0])
+
+    def test_changed_config_is_compiled_again(self):
+        """
+        GIVEN a compiled configuration cache
+        WHEN devices.toml changed before the reader starts again
+        THEN the devices are read from the changed file.
+        """
+        self.start()
+        self.write(
+            "devices.toml",
+            '[[device]]\nname = "other"\nprotocol = "TCP"\nip = "127.0.0.1"\n'
+            "port = 502\naddress = 2\n",
+        )
+
+        poll = self.start()
+
+        self.assertEqual([device["name"] for device in poll.devices], ["other"])
+
+    def test_writable_cache_is_not_loaded(self):
+        """
+        GIVEN a compiled configuration cache writable by others
+        WHEN the reader starts again
+        THEN the cache is not unpickled and the configuration is compiled again.
+        """
+        self.start()
+        os.chmod(self.cache, 0o666)
+
+        with patch("tedge_modbus.reader.compiled_config.pickle.load") as mock_load:
+            poll = self.start()
+
+        mock_load.assert_not_called()
+        self.assertEqual([device["name"] for device in poll.devices], ["meter"])
+
+
+class TestReaderShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_dir = self.tmpdir.name
+        with open(os.path.join(self.config_dir, "modbus.toml"), "w") as file:
+            file.write(
+                '[modbus]\npollinterval = 2\nloglevel = "INFO"\n[serial]\nbaudrate = 9600\n'
+            )
+        with open(os.path.join(self.config_dir, "devices.toml"), "w") as file:
+            for name, ip in (
+                ("gw1", "10.0.0.1"),
+                ("gw2", "10.0.0.1"),
+                ("pm", "10.0.0.2"),
+            ):
+                file.write(
+                    f'[[device]]\nname = "{name}"\nprotocol = "TCP"\nip = "{ip}"\n'
+                    f"port = 502\naddress = 1\n"
+                )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, shard):
+        poll = ModbusPoll(config_dir=self.config_dir, shard=shard)
+        poll.poll_scheduler = MagicMock()
+        poll.poll_scheduler.queue = []
+        with patch.object(poll, "connect_to_tedge"), patch(
+            "tedge_modbus.reader.reader.time.sleep"
+        ), patch.object(poll, "poll_device"), patch.object(
+            poll, "register_service"
+        ) as mock_register:
+            poll.reread_config()
+        return poll, mock_register
+
+    def test_shards_poll_disjoint_buses(self):
+        """
+        GIVEN devices on two TCP endpoints
+        WHEN the configuration is read by two shards
+        THEN every device is polled by exactly one shard
+        and devices of one endpoint are polled by the same shard
+        and only the first shard registers the service.
+        """
+        first, first_register = self.read((0, 2))
+        second, second_register = self.read((1, 2))
+
+        names = [
+            sorted(device["name"] for device in poll.devices)
+            for poll in (first, second)
+        ]
+        self.assertEqual(sorted(names), [["gw1", "gw2"], ["pm"]])
+        first_register.assert_called_once()
+        second_register.assert_not_called()
+
+    def test_shard_without_devices_stops_polling(self):
+        """
+        GIVEN a shard polling a device
+        WHEN the devices are reassigned and the shard is left without devices
+        THEN the shard stops polling its old devices.
+        """
+        poll, _ = self.read((1, 2))
+        self.assertTrue(poll.devices)
+        with open(os.path.join(self.config_dir, "devices.toml"), "w") as file:
+            file.write(
+                '[[device]]\nname = "gw1"\nprotocol = "TCP"\nip = "10.0.0.1"\n'
+                "port = 502\naddress = 1\n"
+            )
+        poll.poll_scheduler.queue = ["old poll"]
+
+        with patch.object(poll, "connect_to_tedge"), patch(
+            "tedge_modbus.reader.reader.time.sleep"
+        ), patch.object(poll, "register_service"):
+            poll.reread_config()
+
+        self.assertEqual(poll.devices, [])
+        poll.poll_scheduler.cancel.assert_called_once_with("old poll")
+
+    def test_commands_are_handled_by_the_owning_shard(self):
+        """
+        GIVEN two shards
+        WHEN commands of a child device and of the main device are received
+        THEN a child device command is only handled by the shard polling it
+        and a main device command only by the first shard.
+        """
+        polls = [self.read((index, 2))[0] for index in range(2)]
+        owner = polls[0].shard_of["pm"]
+
+        for index, poll in enumerate(polls):
+            self.assertEqual(
+                poll._owns_topic("te/device/pm///cmd/modbus_SetRegister/1"),
+                index == owner,
+            )
+            self.assertEqual(
+                poll._owns_topic("te/device/main///cmd/c8y_ModbusDevice/1"),
+                index == 0,
+            )
+
+
+class TestReaderOperations(unittest.TestCase):
+
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_base_definition")
+    @patch("tedge_modbus.reader.reader.ModbusPoll.read_device_definition")
+    def setUp(self, mock_read_device, mock_read_base):
+        mock_read_base.return_value = {"thinedge": {}, "modbus": {}}
+        mock_read_device.return_value = {}
+
+        self.poll = ModbusPoll(config_dir="/tmp/mock_config")
+        self.poll.send_tedge_message = MagicMock()
+
+    @patch("tedge_modbus.reader.reader.load_operation")
+    def test_operation_is_executed_in_process(self, mock_load_operation):
+        """
+        GIVEN a Cloud Fieldbus operation mapped to a command of the main device
+        WHEN the command is executing
+        THEN the operation handler is run in-process with the command payload
+        and the command is marked as successful.
+        """
+        payload = {"status": "executing", "transmitRate": 10, "pollingRate": 2}
+        topic = "te/device/main///cmd/c8y_ModbusConfiguration/c8y-mapper-1"
+        self.poll._handle_subscribed_message(topic, json.dumps(payload))
+        self.assertTrue(self.poll.commands.join(timeout=5))
+
+        mock_load_operation.assert_called_once_with("c8y_ModbusConfiguration")
+        arguments, context = mock_load_operation.return_value.run.call_args[0]
+        self.assertEqual(
+            json.loads(arguments[0]), {"transmitRate": 10, "pollingRate": 2}
+        )
+        self.assertEqual(str(context.base_config_path), "/tmp/mock_config/modbus.toml")
+        message = self.poll.send_tedge_message.call_args[0][0]
+        self.assertEqual(message.topic, topic)
+        self.assertEqual(json.loads(message.data)["status"], "successful")
+
+    @patch("tedge_modbus.reader.reader.load_operation")
+    def test_failed_operation_is_reported(self, mock_load_operation):
+        mock_load_operation.return_value.run.side_effect = ValueError("bad input")
+        topic = "te/device/main///cmd/c8y_ModbusDevice/c8y-mapper-1"
+        self.poll._handle_subscribed_message(topic, '{"status": "executing"}')
+        self.assertTrue(self.poll.commands.join(timeout=5))
+
+        message = self.poll.send_tedge_message.call_args[0][0]
+        self.assertEqual(json.loads(message.data)["status"], "failed")
+        self.assertIn("bad input", json.loads(message.data)["reason"])
+
+    @patch("tedge_modbus.reader.reader.load_operation")
+    def test_operation_publishes_with_the_reader_client(self, mock_load_operation):
+        """
+        GIVEN an in-process operation that publishes a message
+        WHEN the operation is run
+        THEN the message is queued for the MQTT client of the reader
+        instead of opening a connection of its own.
+        """
+        self.poll.publisher = MagicMock()
+        mock_load_operation.return_value.run.side_effect = (
+            lambda arguments, context: context.publisher(
+                "te/device/main///twin/c8y_ModbusConfiguration",
+                "{}",
+                qos=1,
+                retain=True,
+            )
+        )
+        topic = "te/device/main///cmd/c8y_ModbusConfiguration/c8y-mapper-1"
+        self.poll._handle_subscribed_message(topic, '{"status": "executing"}')
+        self.assertTrue(self.poll.commands.join(timeout=5))
+
+        self.poll.publisher.put.assert_called_once_with(
+            "te/device/main///twin/c8y_ModbusConfiguration", "{}", retain=True, qos=1
+        )
@@ -0,0 +1,160 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+from tedge_modbus.reader.shards import (
+    HEALTH_TOPIC,
+    RESTART_DELAY,
+    ShardSupervisor,
+    assign_shards,
+)
+
+
+def tcp_device(name, ip, points=1, port=502):
+    return {
+        "name": name,
+        "protocol": "TCP",
+        "ip": ip,
+        "port": port,
+        "registers": [{"number": number} for number in range(points)],
+    }
+
+
+def rtu_device(name, port, points=1):
+    return {
+        "name": name,
+        "protocol": "RTU",
+        "port": port,
+        "registers": [{"number": number} for number in range(points)],
+    }
+
+
+class TestAssignShards(unittest.TestCase):
+
+    def test_devices_of_a_bus_stay_in_one_shard(self):
+        """
+        GIVEN several devices on the same serial port and TCP endpoint
+        WHEN they are assigned to shards
+        THEN all devices of a bus are in the same shard.
+        """
+        devices = [
+            rtu_device("rtu1", "/dev/ttyS0"),
+            rtu_device("rtu2", "/dev/ttyS0"),
+            tcp_device("gw1", "10.0.0.1"),
+            tcp_device("gw2", "10.0.0.1"),
+            tcp_device("other", "10.0.0.2"),
+        ]
+
+        shards = assign_shards(devices, 2)
+
+        self.assertEqual(shards["rtu1"], shards["rtu2"])
+        self.assertEqual(shards["gw1"], shards["gw2"])
+        self.assertEqual(set(shards), {device["name"] for device in devices})
+
+    def test_buses_are_balanced_by_points(self):
+        """
+        GIVEN buses with different numbers of registers
+        WHEN they are assigned to two shards
+        THEN both shards poll about the same number of registers.
+        """
+        devices = [
+            tcp_device("big", "10.0.0.1", points=12),
+            tcp_device("medium", "10.0.0.2", points=6),
+            tcp_device("small1", "10.0.0.3", points=3),
+            tcp_device("small2", "10.0.0.4", points=1),
+        ]
+
+        shards = assign_shards(devices, 2)
+
+        self.assertEqual(shards["medium"], shards["small1"])
+        self.assertEqual(shards["medium"], shards["small2"])
+        self.assertNotEqual(shards["big"], shards["medium"])
+
+    def test_assignment_does_not_depend_on_order(self):
+        """
+        GIVEN the same devices in a different order
+        WHEN they are assigned to shards
+        THEN every device gets the same shard, so all workers agree.
+        """
+        devices = [tcp_device(f"dev{index}", f"10.0.0.{index}") for index in range(6)]
+
+        self.assertEqual(
+            assign_shards(devices, 3), assign_shards(list(reversed(devices)), 3)
+        )
+
+
+class TestShardSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch("tedge_modbus.reader.shards.mqtt_publish")
+        self.mock_publish = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.supervisor = ShardSupervisor(MagicMock(), 2, {"hostname": "broker"})
+        self.processes = []
+        self.supervisor.context = MagicMock()
+        self.supervisor.context.Process.side_effect = self.new_process
+
+    def new_process(self, **kwargs):
+        process = MagicMock(pid=100 + len(self.processes), exitcode=None)
+        process.is_alive.return_value = True
+        process.kwargs = kwargs
+        self.processes.append(process)
+        return process
+
+    def test_workers_are_started_per_shard(self):
+        """
+        GIVEN a supervisor of two shards
+        WHEN it checks its workers for the first time
+        THEN a worker is started for every shard with its index
+        and the health of all shards is published.
+        """
+        self.supervisor.check(now=0)
+
+        self.assertEqual(
+            [process.kwargs["args"] for process in self.processes], [(0, 2), (1, 2)]
+        )
+        kwargs = self.mock_publish.call_args[1]
+        self.assertEqual(kwargs["topic"], HEALTH_TOPIC)
+        self.assertEqual(kwargs["hostname"], "broker")
+        self.assertTrue(kwargs["retain"])
+        health = json.loads(kwargs["payload"])
+        self.assertEqual(health["status"], "up")
+        self.assertEqual(health["shards"]["1"]["pid"], 101)
+
+    def test_crashed_worker_is_restarted_after_delay(self):
+        """
+        GIVEN running workers
+        WHEN a worker exits
+        THEN the health is reported down
+        and the worker is restarted after the restart delay.
+        """
+        self.supervisor.check(now=0)
+        self.processes[1].is_alive.return_value = False
+        self.processes[1].exitcode = 1
+
+        self.supervisor.check(now=10)
+        health = json.loads(self.mock_publish.call_args[1]["payload"])
+        self.assertEqual(health["status"], "down")
+        self.assertEqual(health["shards"]["1"]["status"], "down")
+        self.assertEqual(len(self.processes), 2)
+
+        self.supervisor.check(now=10 + RESTART_DELAY)
+        self.assertEqual(len(self.processes), 3)
+        self.assertEqual(self.processes[2].kwargs["args"], (1, 2))
+        health = json.loads(self.mock_publish.call_args[1]["payload"])
+        self.assertEqual(health["status"], "up")
+        self.assertEqual(health["shards"]["1"]["restarts"], 1)
+
+    def test_unchanged_health_is_not_published_again(self):
+        self.supervisor.check(now=0)
+        self.supervisor.check(now=1)
+
+        self.assertEqual(self.mock_publish.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
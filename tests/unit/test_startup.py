@@ -0,0 +1,89 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import subprocess
+import unittest
+
+# cumulative import time budget of the entry points in seconds, generous on
+# purpose as the tests run on machines of very different speed
+READER_BUDGET = float(os.environ.get("TEDGE_MODBUS_READER_IMPORT_BUDGET", "1.5"))
+OPERATIONS_BUDGET = float(
+    os.environ.get("TEDGE_MODBUS_OPERATIONS_IMPORT_BUDGET", "0.5")
+)
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter and get the cumulative import
+    time in seconds of every imported module"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=parent_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+class TestStartupImports(unittest.TestCase):
+
+    def test_reader_does_not_import_write_handlers(self):
+        """
+        GIVEN the reader module
+        WHEN it is imported
+        THEN the write handlers are not imported
+        and the import stays within the startup budget.
+        """
+        times = import_times("tedge_modbus.reader.reader")
+
+        for module in (
+            "tedge_modbus.operations.set_coil",
+            "tedge_modbus.operations.set_register",
+            "tedge_modbus.operations.write_plan",
+            "requests",
+        ):
+            self.assertNotIn(module, times)
+        self.assertLess(times["tedge_modbus.reader.reader"], READER_BUDGET)
+
+    def test_operations_entry_point_does_not_import_handlers(self):
+        """
+        GIVEN the operations entry point
+        WHEN it is imported
+        THEN no operation handler nor its heavy dependencies are imported
+        and the import stays within the startup budget.
+        """
+        times = import_times("tedge_modbus.operations.__main__")
+
+        for module in (
+            "tedge_modbus.operations.c8y_coils",
+            "tedge_modbus.operations.c8y_modbus_device",
+            "tedge_modbus.operations.set_register",
+            "requests",
+            "paho.mqtt.client",
+            "pymodbus",
+        ):
+            self.assertNotIn(module, times)
+        self.assertLess(times["tedge_modbus.operations.__main__"], OPERATIONS_BUDGET)
+
+    def test_file_operation_does_not_import_network_dependencies(self):
+        """
+        GIVEN the handler of the c8y_Coils operation which only writes a file
+        WHEN it is imported
+        THEN neither the MQTT, HTTP nor Modbus libraries are imported.
+        """
+        times = import_times("tedge_modbus.operations.c8y_coils")
+
+        for module in ("requests", "paho.mqtt.client", "pymodbus"):
+            self.assertNotIn(module, times)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,362 @@
+import os
+import sys
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, parent_dir)
+import unittest
+from unittest.mock import MagicMock
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from tedge_modbus.operations import set_coil, set_register
+from tedge_modbus.operations.write_plan import (
+    check_results,
+    coalesce,
+    write_coil_batch,
+    write_register_batch,
+)
+
+
+def ok():
+    return MagicMock(isError=MagicMock(return_value=False))
+
+
+DEVICE = {
+    "name": "plc",
+    "protocol": "TCP",
+    "ip": "127.0.0.1",
+    "port": 502,
+    "address": 1,
+    "registers": [
+        {"number": 10, "startbit": 0, "nobits": 16, "name": "setpoint_a"},
+        {"number": 11, "startbit": 0, "nobits": 16, "name": "setpoint_b"},
+        {"number": 12, "startbit": 0, "nobits": 4, "name": "mode"},
+        {"number": 12, "startbit": 4, "nobits": 4, "name": "level"},
+        {
+            "number": 20,
+            "startbit": 0,
+            "nobits": 32,
+            "name": "ratio",
+            "datatype": "float",
+        },
+    ],
+    "coils": [
+        {"number": 0, "name": "pump"},
+        {"number": 1, "name": "valve"},
+        {"number": 5, "name": "fan"},
+    ],
+}
+TOPIC = "te/device/plc///cmd/modbus_SetRegister/c8y-mapper-1"
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def test_adjacent_addresses_are_grouped(self):
+        runs = coalesce({3: "c", 1: "a", 2: "b", 7: "d"}, max_count=10)
+        self.assertEqual(runs, [(1, ["a", "b", "c"]), (7, ["d"])])
+
+    def test_runs_are_limited(self):
+        runs = coalesce(dict.fromkeys(range(5), 0), max_count=2)
+        self.assertEqual([start for start, _ in runs], [0, 2, 4])
+
+
+class TestRegisterBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.write_register.return_value = ok()
+        self.client.write_registers.return_value = ok()
+        self.client.mask_write_register.return_value = ExceptionResponse(
+            22, ModbusExceptions.IllegalFunction
+        )
+        self.client.read_holding_registers.return_value = ReadHoldingRegistersResponse(
+            [0xFF00]
+        )
+
+    def resolve(self, *metrics):
+        payload = {
+            "metrics": [{"name": name, "value": value} for name, value in metrics]
+        }
+        return set_register.resolve_params(payload, TOPIC, [DEVICE])
+
+    def test_all_metrics_are_written_in_one_transaction(self):
+        """
+        GIVEN a command with several metrics of adjacent registers
+        WHEN it is written
+        THEN the registers are written with a single write_registers request
+        and every metric is reported as successful.
+        """
+        params = self.resolve(("setpoint_b", 2), ("setpoint_a", 1))
+        results = set_register.write(self.client, params)
+
+        self.client.write_registers.assert_called_once_with(
+            address=10, values=[1, 2], slave=1
+        )
+        self.client.read_holding_registers.assert_not_called()
+        self.assertEqual(
+            [result["status"] for result in results], ["successful", "successful"]
+        )
+
+    def test_bitfields_of_one_register_are_merged(self):
+        """
+        GIVEN two bitfield metrics in the same register
+        WHEN they are written
+        THEN the register is read once and written once with both bitfields.
+        """
+        params = self.resolve(("mode", 3), ("level", 5), ("setpoint_b", 9))
+        set_register.write(self.client, params)
+
+        self.client.read_holding_registers.assert_called_once_with(
+            address=12, count=1, slave=1
+        )
+        self.client.write_registers.assert_called_once_with(
+            address=11, values=[9, 0xFF53], slave=1
+        )
+
+    def test_bitfields_use_mask_write(self):
+        """
+        GIVEN a device which supports Mask Write Register
+        WHEN two bitfields of a register are written
+        THEN a single mask write is sent without reading the register and the
+        support is remembered.
+        """
+        self.client.mask_write_register.return_value = ok()
+        capabilities = {}
+        params = self.resolve(("mode", 3), ("level", 5))
+        results = set_register.write(self.client, params, capabilities=capabilities)
+
+        self.client.mask_write_register.assert_called_once_with(
+            address=12, and_mask=0xFF00, or_mask=0x53, unit=1
+        )
+        self.client.read_holding_registers.assert_not_called()
+        self.client.write_register.assert_not_called()
+        self.assertEqual(capabilities, {"mask_write": True})
+        self.assertEqual(
+            [result["status"] for result in results], ["successful", "successful"]
+        )
+
+    def test_unsupported_mask_write_is_remembered(self):
+        """
+        GIVEN a device which rejects Mask Write Register
+        WHEN bitfields are written twice
+        THEN the first write falls back to read-modify-write and the second
+        one does not try the mask write again.
+        """
+        capabilities = {}
+        params = self.resolve(("mode", 3))
+        set_register.write(self.client, params, capabilities=capabilities)
+        self.assertEqual(capabilities, {"mask_write": False})
+        self.client.write_register.assert_called_once_with(
+            address=12, value=0xFF03, slave=1
+        )
+
+        self.client.mask_write_register.reset_mock()
+        set_register.write(self.client, params, capabilities=capabilities)
+        self.client.mask_write_register.assert_not_called()
+
+    def test_failing_mask_write_falls_back_to_read_modify_write(self):
+        """
+        GIVEN a device which fails Mask Write Register with another exception
+        WHEN bitfields are written repeatedly
+        THEN the mask write is given up after 3 failures in a row
+        and further writes use read-modify-write.
+        """
+        self.client.mask_write_register.return_value = ExceptionResponse(
+            22, ModbusExceptions.SlaveFailure
+        )
+        capabilities = {}
+        params = self.resolve(("mode", 3))
+        for _ in range(3):
+            results = set_register.write(self.client, params, capabilities=capabilities)
+            self.assertEqual(results[0]["status"], "failed")
+        self.client.write_register.assert_not_called()
+        self.assertFalse(capabilities["mask_write"])
+
+        self.client.mask_write_register.reset_mock()
+        results = set_register.write(self.client, params, capabilities=capabilities)
+
+        self.client.mask_write_register.assert_not_called()
+        self.client.write_register.assert_called_once_with(
+            address=12, value=0xFF03, slave=1
+        )
+        self.assertEqual(results[0]["status"], "successful")
+
+    def test_cached_value_replaces_read(self):
+        params = self.resolve(("mode", 3))
+        set_register.write(
+            self.client,
+            params,
+            capabilities={"mask_write": False},
+            cached_value={12: 0x1230}.get,
+        )
+        self.client.read_holding_registers.assert_not_called()
+        self.client.write_register.assert_called_once_with(
+            address=12, value=0x1233, slave=1
+        )
+
+    def test_per_metric_results(self):
+        params = self.resolve(("setpoint_a", 1), ("unknown", 1), ("mode", 99))
+        results = set_register.write(self.client, params)
+
+        self.assertEqual(
+            [(result["name"], result["status"]) for result in results],
+            [("setpoint_a", "successful"), ("unknown", "failed"), ("mode", "failed")],
+        )
+        self.client.write_register.assert_called_once_with(address=10, value=1, slave=1)
+        with self.assertRaisesRegex(RuntimeError, "Failed to write 2 of 3 metrics"):
+            check_results(results)
+
+    def test_failed_transaction_fails_its_metrics_only(self):
+        self.client.write_register.return_value = ExceptionResponse(
+            6, ModbusExceptions.IllegalAddress
+        )
+        params = self.resolve(("setpoint_a", 1), ("ratio", 1.5))
+        results = set_register.write(self.client, params)
+
+        self.client.write_registers.assert_called_once()
+        self.assertEqual(
+            [result["status"] for result in results], ["failed", "successful"]
+        )
+
+    def test_no_matching_metric_is_an_error(self):
+        with self.assertRaises(ValueError):
+            self.resolve(("unknown", 1))
+
+
+class TestCoilBatch(unittest.TestCase):
+
+    def test_adjacent_coils_are_written_together(self):
+        client = MagicMock()
+        client.write_coil.return_value = ok()
+        client.write_coils.return_value = ok()
+        payload = {
+            "metrics": [
+                {"name": "valve", "value": 0},
+                {"name": "pump", "value": 1},
+                {"name": "fan", "value": 1},
+                {"name": "heater", "value": 1},
+            ]
+        }
+        params = set_coil.resolve_params(
+            payload, "te/device/plc///cmd/modbus_SetCoil/c8y-mapper-1", [DEVICE]
+        )
+        results = write_coil_batch(client, params["slave_id"], params["writes"])
+
+        client.write_coils.assert_called_once_with(
+            address=0, values=[True, False], slave=1
+        )
+        client.write_coil.assert_called_once_with(address=5, value=True, slave=1)
+        self.assertEqual(
+            [result["status"] for result in results],
+            ["successful", "successful", "successful", "failed"],
+        )
+
+    def test_unread_register_fails_bitfields(self):
+        client = MagicMock()
+        client.read_holding_registers.return_value = ExceptionResponse(
+            3, ModbusExceptions.IllegalAddress
+        )
+        results = write_register_batch(
+            client,
+            1,
+            [
+                {
+                    "name": "mode",
+                    "register": 12,
+                    "start_bit": 0,
+                    "num_bits": 4,
+                    "write_value": 1,
+                    "words": None,
+                }
+            ],
+        )
+        self.assertEqual(results[0]["status"], "failed")
+        client.write_register.assert_not_called()
+
+
+class TestWriteConfirmation(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.write_register.return_value = ok()
+        self.client.write_registers.return_value = ok()
+        self.client.read_holding_registers.return_value = ReadHoldingRegistersResponse(
+            [1, 2]
+        )
+
+    def test_read_write_multiple_confirms_in_one_request(self):
+        """
+        GIVEN a device which supports Read/Write Multiple Registers
+        WHEN registers are written with confirmation
+        THEN they are written and read back with a single request.
+        """
+        self.client.readwrite_registers.return_value = ReadHoldingRegistersResponse(
+            [1, 2]
+        )
+        capabilities = {}
+        confirmed = {}
+        params = set_register.resolve_params(
+            {
+                "metrics": [
+                    {"name": "setpoint_a", "value": 1},
+                    {"name": "setpoint_b", "value": 2},
+                ]
+            },
+            TOPIC,
+            [DEVICE],
+        )
+        set_register.write(
+            self.client, params, capabilities=capabilities, confirmed=confirmed
+        )
+
+        self.client.readwrite_registers.assert_called_once_with(
+            read_address=10,
+            read_count=2,
+            write_address=10,
+            write_registers=[1, 2],
+            unit=1,
+        )
+        self.client.write_registers.assert_not_called()
+        self.assertEqual(confirmed, {10: 1, 11: 2})
+        self.assertEqual(capabilities, {"read_write": True})
+
+    def test_confirmation_falls_back_to_read(self):
+        self.client.readwrite_registers.return_value = ExceptionResponse(
+            23, ModbusExceptions.IllegalFunction
+        )
+        capabilities = {}
+        confirmed = {}
+        params = set_register.resolve_params(
+            {
+                "metrics": [
+                    {"name": "setpoint_a", "value": 1},
+                    {"name": "setpoint_b", "value": 2},
+                ]
+            },
+            TOPIC,
+            [DEVICE],
+        )
+        set_register.write(
+            self.client, params, capabilities=capabilities, confirmed=confirmed
+        )
+
+        self.client.write_registers.assert_called_once()
+        self.client.read_holding_registers.assert_called_once_with(
+            address=10, count=2, slave=1
+        )
+        self.assertEqual(confirmed, {10: 1, 11: 2})
+        self.assertEqual(capabilities, {"read_write": False})
+
+    def test_coils_are_read_back(self):
+        self.client.write_coils.return_value = ok()
+        self.client.read_coils.return_value = MagicMock(
+            isError=MagicMock(return_value=False),
+            bits=[True, False, False, False, False, False, False, False],
+        )
+        confirmed = {}
+        writes = [
+            {"name": "pump", "coil_number": 0, "value": 1},
+            {"name": "valve", "coil_number": 1, "value": 0},
+        ]
+        write_coil_batch(self.client, 1, writes, confirmed)
+        self.client.read_coils.assert_called_once_with(address=0, count=2, slave=1)
+        self.assertEqual(confirmed, {0: True, 1: False})